@@ -30,6 +30,7 @@ INSTALLED_APPS = [
 
 # Middleware
 MIDDLEWARE = [
+    'utils.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -119,11 +120,31 @@ if ENABLE_DJANGO_TOOLBAR:
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
+    },
+    # Shared by all worker processes, used as the L2 tier of ExpireLruCache (see utils/common/expire_lru_cache.py)
+    # Replace it with memcached or redis in production, e.g.:
+    # 'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache', 'LOCATION': '127.0.0.1:11211',
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        'KEY_PREFIX': 'tms',
+    },
 }
 
 # Session expires when browser closes
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
+# Number of rows created in one transaction when importing waybills from a file (see wuliu/waybill_import.py)
+WAYBILL_IMPORT_CHUNK_SIZE = 500
+
+# Request instrumentation (see utils/middleware.py), the percentiles are shown at settings/request_metrics
+# Requests slower than REQUEST_METRICS_SLOW_TIME seconds or making more than REQUEST_METRICS_SLOW_QUERY_NUM queries
+# are logged with their REQUEST_METRICS_TOP_SQL_NUM slowest SQL statements
+REQUEST_METRICS_SLOW_TIME = 1
+REQUEST_METRICS_SLOW_QUERY_NUM = 100
+REQUEST_METRICS_TOP_SQL_NUM = 5
+# Number of recent requests of each view kept for the percentiles
+REQUEST_METRICS_SAMPLES_PER_VIEW = 1000
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -1,6 +1,7 @@
 from ._common import (
     UnescapedDjangoJSONEncoder, SortableModelChoiceField,
     traceback_log, traceback_and_detail_log,
-    validate_comma_separated_integer_list_and_split, model_to_dict_, del_session_item
+    validate_comma_separated_integer_list_and_split, model_to_dict_, del_session_item,
+    ModelDictSerializer,
 )
 from .expire_lru_cache import ExpireLruCache
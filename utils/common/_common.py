@@ -4,6 +4,7 @@ import logging
 import traceback
 from django.utils import timezone
 from django.db.models import Model
+from django.core.validators import validate_comma_separated_integer_list
 
 
 def del_session_item(request, key):
@@ -66,6 +67,10 @@ def validate_comma_separated_integer_list_and_split(string: str, auto_strip=True
     :param auto_strip: If True, strip the string first (default)
     :return: list
     """
+    if auto_strip:
+        string = string.strip()
+    validate_comma_separated_integer_list(string)
+    return string.split(",")
 
 def model_to_dict_(instance: Model) -> dict:
     """ Django has a built-in django.forms.models.model_to_dict method (hereinafter referred to as the original model_to_dict method)
@@ -74,4 +79,71 @@ def model_to_dict_(instance: Model) -> dict:
     But what we want is a "model to dictionary" method that should include all fields of the model.
     So we wrote a new model_to_dict_ method based on the original model_to_dict method.
     Compared to the original model_to_dict method, it lacks the fields and exclude parameters, because we don't need them for now.
+    The field list of each model is only built once (see ModelDictSerializer).
     """
+    return ModelDictSerializer.of(type(instance)).instance_to_dict(instance)
+
+class ModelDictSerializer:
+
+    """ Precompiled "model to dictionary" serializer
+    The field accessor list and the choice labels of the model are built once in __init__, instead of walking _meta for every object.
+    Besides model instances, it also converts the rows of QuerySet.values(*serializer.values_fields) directly,
+    which skips instantiating the models when serializing a large number of rows.
+    Dictionary keys are the same as model_to_dict_: field names, foreign keys hold the id of the related object.
+    """
+
+    _serializers = {}
+
+    def __init__(self, model, fields=None, exclude=()):
+        """
+        :param model: Model class
+        :param fields: Names of the fields that are included, all fields by default
+        :param exclude: Names of the fields that are left out
+        """
+        opts = model._meta
+
+        def _included(f):
+            return f.name not in exclude and (fields is None or f.name in fields)
+
+        self.model = model
+        # (key of the output dictionary, attribute name / key of the values() row)
+        self.fields = tuple((f.name, f.attname) for f in opts.concrete_fields if _included(f))
+        self.many_to_many_fields = tuple(f for f in opts.many_to_many if _included(f))
+        self.values_fields = tuple(attname for _, attname in self.fields)
+        # {field name: {value: label}}
+        self.choices = {
+            f.name: {value: str(label) for value, label in f.flatchoices}
+            for f in opts.concrete_fields if f.choices and _included(f)
+        }
+
+    @classmethod
+    def of(cls, model, fields=None) -> "ModelDictSerializer":
+        """ Return the shared serializer of the model, it is built on first use
+        :param fields: Names of the fields that are included, all fields by default
+        """
+        key = (model, None if fields is None else tuple(fields))
+        try:
+            return cls._serializers[key]
+        except KeyError:
+            return cls._serializers.setdefault(key, cls(model, fields=fields))
+
+    def instance_to_dict(self, instance: Model) -> dict:
+        """ Convert a model instance, many-to-many fields are included like the original model_to_dict method (one query each) """
+        dic = {name: getattr(instance, attname) for name, attname in self.fields}
+        for f in self.many_to_many_fields:
+            dic[f.name] = f.value_from_object(instance)
+        return dic
+
+    def row_to_dict(self, row: dict) -> dict:
+        """ Convert a row of QuerySet.values(*self.values_fields) """
+        return {name: row[attname] for name, attname in self.fields}
+
+    def iter_dicts(self, queryset):
+        """ Convert every row of the queryset, the models are not instantiated """
+        row_to_dict = self.row_to_dict
+        for row in queryset.values(*self.values_fields).iterator(chunk_size=2000):
+            yield row_to_dict(row)
+
+    def choice_label(self, field_name: str, value) -> str:
+        """ Display label of a choices field, the same as get_FOO_display() """
+        return self.choices[field_name].get(value, value)
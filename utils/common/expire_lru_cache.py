@@ -1,8 +1,12 @@
 from functools import wraps
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import threading
 import logging
+import hashlib
+import time
 
+from django.core.cache import caches, InvalidCacheBackendError
+from django.db.models import Model
 from django.utils import timezone
 
 
@@ -10,58 +14,296 @@ _logger = logging.getLogger(__name__)
 
 ValueAndType = namedtuple("ValueAndType", ["value", "type"])
 
+# Same fields as functools.lru_cache's cache_info(), plus the number of evicted entries
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize", "evictions"])
+
+class _CacheItem:
+
+    __slots__ = ["result", "expire_at", "count"]
+
+    def __init__(self, result, expire_at):
+        self.result = result
+        # A time.monotonic() value, not affected by system clock adjustments
+        self.expire_at = expire_at
+        self.count = 0
+
+class _InFlight:
+
+    """ A recomputation in progress, other threads can wait for it instead of recomputing the same key """
+
+    __slots__ = ["event", "thread_id", "invalidated"]
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.thread_id = threading.get_ident()
+        # Set by invalidate() while recomputing, the result may be based on outdated data and must not be stored
+        self.invalidated = False
+
 class ExpireLruCache:
 
     """ A simple cache decorator with expiration support. In this project, it is used to decorate methods that frequently access the database and do not require real-time data.
     Like functools.lru_cache in the standard library, the decorated function cannot use unhashable parameters.
     The parameter expire_time is the expiration time and must be of type datetime.timedelta. The default is 3 minutes.
+    The parameter maxsize is the maximum number of cached entries, when exceeded, the least recently used entry will be evicted.
+    If maxsize is None, the cache can grow without bound (expired entries are still purged). The default is 128.
+    If stale_while_revalidate is True, when an entry has expired and another thread is already recomputing it,
+    the expired value is returned immediately instead of waiting for the recomputation. The default is False.
     If enable_log is True, a log will be recorded each time the cache is accessed [function name, parameters, cache access count].
+    The parameter shared_cache is an alias in settings.CACHES (e.g. "shared"). If set, results are also stored in that cache,
+    so that all worker processes share them: the in-process dict becomes the L1 tier and the shared cache the L2 tier.
+    Results are pickled by the cache backend, so they must be picklable (model instances are fine).
+    The parameter local_expire_time is the expiration time of the L1 tier when shared_cache is set,
+    a short value limits how long processes may disagree with each other. The default is the same as expire_time.
+    The parameter version is part of the keys in the shared cache, bump it when the decorated function changes its return value,
+    so that processes running the new code do not read values pickled by the old code.
+    The decorated function has an invalidate(*args, **kwargs) method to remove a single entry,
+    e.g. when the data it depends on has changed (see wuliu/signals.py).
+    Note: An instance can decorate multiple functions, in which case these functions share the same storage space (and maxsize).
+
+    Cache hits do not wait for the lock: the entry is read without it, and the LRU reorder is done only if the lock is free
+    (skipped otherwise), so the hits counter in cache_info() and the LRU order are approximate under heavy concurrency.
+    When an entry is missing or expired, only one thread calls the decorated function for that key,
+    the other threads wait for its result (or get the stale value, see stale_while_revalidate).
     """
 
-    def __init__(self, expire_time=timezone.timedelta(minutes=3), enable_log=False):
+    def __init__(self, expire_time=timezone.timedelta(minutes=3), maxsize=128, stale_while_revalidate=False,
+                 shared_cache=None, local_expire_time=None, version=1, enable_log=False):
         assert isinstance(expire_time, timezone.timedelta), "expire_time parameter must be of type datetime.timedelta"
+        assert maxsize is None or (isinstance(maxsize, int) and maxsize > 0), "maxsize parameter must be a positive integer or None"
+        assert local_expire_time is None or isinstance(local_expire_time, timezone.timedelta), (
+            "local_expire_time parameter must be of type datetime.timedelta"
+        )
         self.expire_time = expire_time
+        self.maxsize = maxsize
+        self.stale_while_revalidate = stale_while_revalidate
+        self.shared_cache = shared_cache
+        self.local_expire_time = min(local_expire_time, expire_time) if local_expire_time else expire_time
+        self.version = version
         self.enable_log = enable_log
-        self._dic = {}
+        self._expire_seconds = expire_time.total_seconds()
+        self._local_expire_seconds = self.local_expire_time.total_seconds()
+        # Resolved on first use, because settings.CACHES may not be ready when the decorator is applied
+        self._shared_cache_backend = None
+        # key: (func, args, kwargs), value: _CacheItem
+        # Ordered from the least recently used to the most recently used
+        self._dic = OrderedDict()
+        # key: (func, args, kwargs), value: _InFlight
+        self._in_flight = {}
         self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._latest_purge_time = time.monotonic()
 
     @staticmethod
     def _print_log(func, args, kwargs, count):
         _logger.info("%s: function name: %s, args: (%s), get cache count: %s" % (
             __name__,
             func.__name__,
-            ", ".join([*[str(arg) for arg in args], *["%s=%s" % (k, v) for k, v in kwargs]]),
+            ", ".join([*[str(arg) for arg in args], *["%s=%s" % (k, v) for k, v in kwargs.items()]]),
             count,
         ))
 
-    def __call__(self, func):
-        @wraps(func)
-        def _func(*args, **kwargs):
-            # Each parameter of the decorated function must be hashable
-            hashable_args = tuple((ValueAndType(value=arg, type=type(arg)) for arg in args))
-            hashable_kwargs = frozenset((
-                (k, ValueAndType(value=v, type=type(v))) for k, v in kwargs.items()
-            ))
-            key_ = hash((func, hashable_args, hashable_kwargs))
+    @staticmethod
+    def _make_key(func, args, kwargs):
+        # Each parameter of the decorated function must be hashable
+        hashable_args = tuple((ValueAndType(value=arg, type=type(arg)) for arg in args))
+        hashable_kwargs = frozenset((
+            (k, ValueAndType(value=v, type=type(v))) for k, v in kwargs.items()
+        ))
+        return func, hashable_args, hashable_kwargs
+
+    @staticmethod
+    def _make_shared_key_part(value) -> str:
+        # Model instances are identified by their primary key, not by their (pickled) content
+        if isinstance(value, Model):
+            return "%s:%s" % (value._meta.label_lower, value.pk)
+        return "%s:%r" % (type(value).__qualname__, value)
+
+    def _make_shared_key(self, func, args, kwargs) -> str:
+        """ Generate a key for the shared cache which is stable across processes """
+        parts = [
+            *[self._make_shared_key_part(arg) for arg in args],
+            *["%s=%s" % (k, self._make_shared_key_part(v)) for k, v in sorted(kwargs.items())],
+        ]
+        return "expire_lru_cache:%s.%s:v%s:%s" % (
+            func.__module__, func.__qualname__, self.version, hashlib.md5("\x1f".join(parts).encode()).hexdigest(),
+        )
+
+    def _get_shared_cache_backend(self):
+        if self.shared_cache is None:
+            return None
+        if self._shared_cache_backend is None:
+            try:
+                self._shared_cache_backend = caches[self.shared_cache]
+            except InvalidCacheBackendError:
+                _logger.error("%s: cache alias %r is not configured, shared cache disabled" % (__name__, self.shared_cache))
+                self.shared_cache = None
+        return self._shared_cache_backend
+
+    def _shared_get(self, shared_key):
+        """ Get (result, remaining seconds) from the shared cache, return None if missing or expired """
+        backend = self._get_shared_cache_backend()
+        if backend is None:
+            return None
+        try:
+            payload = backend.get(shared_key)
+        except Exception:
+            # The shared cache is only an optimization, never let it break the caller
+            _logger.warning("%s: failed to read shared cache key %s" % (__name__, shared_key), exc_info=True)
+            return None
+        if payload is None:
+            return None
+        expire_at, result = payload
+        remaining = expire_at - time.time()
+        if remaining <= 0:
+            return None
+        return result, remaining
+
+    def _shared_set(self, shared_key, result):
+        backend = self._get_shared_cache_backend()
+        if backend is None:
+            return
+        try:
+            # The shared cache is read by other processes, so store the wall clock deadline with the result
+            backend.set(shared_key, (time.time() + self._expire_seconds, result), timeout=self._expire_seconds)
+        except Exception:
+            _logger.warning("%s: failed to write shared cache key %s" % (__name__, shared_key), exc_info=True)
+
+    def _hit(self, key_, item, func, args, kwargs):
+        # Reordering must not happen while another thread iterates over the dict (see _purge_expired),
+        # if the lock is busy the reorder is skipped, the entry just stays a bit less recently used
+        if self._lock.acquire(blocking=False):
+            try:
+                self._dic.move_to_end(key_)
+            except KeyError:
+                # Evicted by another thread in the meantime, the value we hold is still valid
+                pass
+            finally:
+                self._lock.release()
+        self._hits += 1
+        item.count += 1
+        if self.enable_log:
+            self._print_log(func, args, kwargs, item.count)
+        return item.result
+
+    def _purge_expired(self, now):
+        """ Remove all expired entries which are not being recomputed, must be called with the lock held """
+        for key_ in [k for k, v in list(self._dic.items()) if v.expire_at <= now and k not in self._in_flight]:
+            del self._dic[key_]
+        self._latest_purge_time = now
+
+    def _set(self, key_, result, now, expire_seconds):
+        """ Store the result and evict the least recently used entries if necessary, must be called with the lock held """
+        # Periodically purge all expired entries, so that entries which are never accessed again do not stay forever
+        if self._latest_purge_time + self._local_expire_seconds <= now:
+            self._purge_expired(now)
+        self._dic[key_] = _CacheItem(result, now + expire_seconds)
+        self._dic.move_to_end(key_)
+        if self.maxsize is not None:
+            while len(self._dic) > self.maxsize:
+                self._dic.popitem(last=False)
+                self._evictions += 1
+
+    def _get_or_compute(self, key_, func, args, kwargs):
+        """ Slow path: the entry is missing or expired """
+        with self._lock:
+            item = self._dic.get(key_)
+            if item is not None and item.expire_at > time.monotonic():
+                # Refreshed by another thread while we were waiting for the lock
+                return self._hit(key_, item, func, args, kwargs)
+            in_flight = self._in_flight.get(key_)
+            if in_flight is None:
+                in_flight = self._in_flight[key_] = _InFlight()
+                if item is not None and not self.stale_while_revalidate:
+                    # Lazy purge: the entry has expired, nobody is allowed to use it anymore
+                    del self._dic[key_]
+                self._misses += 1
+                is_leader = True
+            elif in_flight.thread_id == threading.get_ident():
+                # The decorated function calls itself with the same arguments, do not wait for ourselves
+                self._misses += 1
+                return func(*args, **kwargs)
+            elif item is not None and self.stale_while_revalidate:
+                return self._hit(key_, item, func, args, kwargs)
+            else:
+                is_leader = False
+        if not is_leader:
+            in_flight.event.wait()
+            item = self._dic.get(key_)
+            if item is not None:
+                return self._hit(key_, item, func, args, kwargs)
+            # The recomputation failed (or the cache was cleared), call the decorated function by ourselves
             with self._lock:
-                if key_ in self._dic.keys():
-                    if self._dic[key_]["latest_update_time"] + self.expire_time > timezone.now():
-                        self._dic[key_]["count"] += 1
-                        if self.enable_log:
-                            self._print_log(func, args, kwargs, self._dic[key_]["count"])
-                        return self._dic[key_]["result"]
-            result = func(*args, **kwargs)
+                self._misses += 1
+            return func(*args, **kwargs)
+        try:
+            shared_key = self._make_shared_key(func, args, kwargs) if self.shared_cache is not None else None
+            shared_item = self._shared_get(shared_key) if shared_key is not None else None
+            if shared_item is not None:
+                result, remaining = shared_item
+                expire_seconds = min(self._local_expire_seconds, remaining)
+            else:
+                result = func(*args, **kwargs)
+                expire_seconds = self._local_expire_seconds
+                if shared_key is not None and not in_flight.invalidated:
+                    self._shared_set(shared_key, result)
             with self._lock:
-                self._dic[key_] = {
-                    "result": result,
-                    "latest_update_time": timezone.now(),
-                    "count": 0,
-                }
+                if not in_flight.invalidated:
+                    self._set(key_, result, time.monotonic(), expire_seconds)
             return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key_, None)
+            in_flight.event.set()
+
+    def _invalidate(self, func, args, kwargs):
+        key_ = self._make_key(func, args, kwargs)
+        with self._lock:
+            self._dic.pop(key_, None)
+            in_flight = self._in_flight.get(key_)
+            if in_flight is not None:
+                in_flight.invalidated = True
+        if self._get_shared_cache_backend() is not None:
+            shared_key = self._make_shared_key(func, args, kwargs)
+            try:
+                self._shared_cache_backend.delete(shared_key)
+            except Exception:
+                _logger.warning("%s: failed to delete shared cache key %s" % (__name__, shared_key), exc_info=True)
+
+    def cache_info(self) -> CacheInfo:
+        """ Report cache statistics, like functools.lru_cache """
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self.maxsize, len(self._dic), self._evictions)
+
+    def cache_clear(self):
+        """ Clear the cache and statistics, like functools.lru_cache
+        Note: only the in-process (L1) tier is cleared, entries in the shared cache expire by themselves.
+        """
+        with self._lock:
+            self._dic.clear()
+            self._hits = self._misses = self._evictions = 0
+            self._latest_purge_time = time.monotonic()
+
+    def __call__(self, func):
+        @wraps(func)
+        def _func(*args, **kwargs):
+            key_ = self._make_key(func, args, kwargs)
+            # Fast path, without the lock
+            item = self._dic.get(key_)
+            if item is not None and item.expire_at > time.monotonic():
+                return self._hit(key_, item, func, args, kwargs)
+            return self._get_or_compute(key_, func, args, kwargs)
+        def invalidate(*args, **kwargs):
+            """ Remove the cached result of this function called with these arguments (from both tiers) """
+            self._invalidate(func, args, kwargs)
+        _func.cache_info = self.cache_info
+        _func.cache_clear = self.cache_clear
+        _func.invalidate = invalidate
         return _func
 
 '''
-# Function decorator version of ExpireLruCache. The effect is exactly the same as the class decorator version, but the readability is not as good. For reference only.
+# Function decorator version of the original ExpireLruCache (without maxsize and statistics). The readability is not as good. For reference only.
 
 def ExpireLruCache(expire_time=timezone.timedelta(minutes=3), enable_log=False):
 
@@ -1,7 +1,9 @@
+import tempfile
+
 from openpyxl import Workbook
-from openpyxl.styles import Border, Side, Alignment, Font
-from openpyxl.writer.excel import save_virtual_workbook
-import itertools
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Border, Side, Alignment, Font, NamedStyle
+from openpyxl.utils import get_column_letter
 
 # Define commonly used fonts
 _FONT_TITLE = Font(size=14, bold=True)
@@ -14,10 +16,18 @@ _RIGHT = Alignment(horizontal='right', vertical='center')
 
 # Define commonly used border style
 _BD = Side(style='thin')
+_ALL_BORDER = Border(left=_BD, top=_BD, right=_BD, bottom=_BD)
+
+# Converters of the column data types (trs_types)
+_VALUE_CONVERTERS = {
+    "str": str,
+    "int": int,
+    "float": float,
+}
 
 def add_all_border(cell_):
     """ Add thin border to all sides of the cell """
-    cell_.border = Border(left=_BD, top=_BD, right=_BD, bottom=_BD)
+    cell_.border = _ALL_BORDER
 
 def cell_center(cell_):
     """ Set cell alignment to center horizontally and vertically """
@@ -27,52 +37,85 @@ def cell_right(cell_):
     """ Set cell alignment to right horizontally and center vertically """
     cell_.alignment = _RIGHT
 
-def gen_workbook(title, thead, trs, trs_types=()):
-    wb = Workbook()
-    ws = wb.active
-    ws.append([title, ])
-    ws.append(thead)
-    for tr in trs:
-        _tr = []
+def _gen_named_styles():
+    """ Named styles of the title, header and value cells (centered, with thin border)
+    Cells only reference the shared style by name, instead of copying font, alignment and border into every cell
+    """
+    return [
+        NamedStyle(name=name, font=font, alignment=_CENTER, border=_ALL_BORDER)
+        for name, font in (("export_title", _FONT_TITLE), ("export_header", _FONT_HEADER), ("export_value", _FONT_VALUE))
+    ]
+
+def _cell_width(value) -> float:
+    """ Display width of the cell value, non-ascii (e.g. Chinese) characters are twice as wide """
+    value = str(value)
+    if value.isascii():
+        return len(value) * 1.3
+    return sum(1.3 if ord(char) <= 256 else 2.6 for char in value)
+
+def _columns_width(thead, trs) -> list:
+    """ Calculate the width of each column in a single pass over the header and rows """
+    widths = [0] * len(thead)
+    for tr in [thead, *trs]:
         for index, value in enumerate(tr):
-            try:
-                value_type = trs_types[index]
-            except IndexError:
-                value_type = "str"
-            if value_type == "str":
-                value = str(value)
-            elif value_type == "int":
-                value = int(value)
-            elif value_type == "float":
-                value = float(value)
-            else:
-                raise ValueError("Unrecognized column data type: " + str(value_type))
-            _tr.append(value)
-        ws.append(_tr)
-    # Merge first row (title)
-    ws.merge_cells("A1:%s1" % ws[2][-1].column_letter)
-    # Set all cells to center alignment and add border
-    for cell in itertools.chain.from_iterable(ws.rows):
-        cell_center(cell)
-        add_all_border(cell)
-    # Set font for each row
-    ws['A1'].font = _FONT_TITLE
-    for cell in ws[2]:
-        cell.font = _FONT_HEADER
-    for cell in itertools.chain.from_iterable(list(ws.rows)[2:]):
-        cell.font = _FONT_VALUE
-    # Adjust column width
-    for col in ws.columns:
-        max_len_set = set()
-        for cell in col:
-            cell_len = 0
-            if not cell.value:
+            if not value:
                 continue
-            for char in str(cell.value):
-                if ord(char) <= 256:
-                    cell_len += 1.3
-                else:
-                    cell_len += 2.6
-            max_len_set.add(cell_len)
-        ws.column_dimensions[col[1].column_letter].width = max(max_len_set)
-    return save_virtual_workbook(wb)
+            width = _cell_width(value)
+            if index >= len(widths):
+                widths.extend([0] * (index - len(widths) + 1))
+            if width > widths[index]:
+                widths[index] = width
+    return widths
+
+def gen_workbook(title, thead, trs, trs_types=()):
+    """ Generate the excel file of a table
+    Use the write-only mode of openpyxl, rows are streamed into a temporary file instead of being kept in memory
+    :param title: Table title, it is written to the merged first row
+    :param thead: List of header names
+    :param trs: Iterable of rows (lists of values)
+    :param trs_types: Data type ("str", "int" or "float") of each column, "str" by default
+    :return: Temporary file (seeked to the beginning), it is deleted after being closed
+    """
+    trs = trs if isinstance(trs, (list, tuple)) else list(trs)
+    widths = _columns_width(thead, trs)
+    converters = []
+    for index in range(len(widths)):
+        value_type = trs_types[index] if index < len(trs_types) else "str"
+        try:
+            converters.append(_VALUE_CONVERTERS[value_type])
+        except KeyError:
+            raise ValueError("Unrecognized column data type: " + str(value_type))
+
+    wb = Workbook(write_only=True)
+    for style in _gen_named_styles():
+        wb.add_named_style(style)
+    ws = wb.create_sheet()
+    # Column widths and merged cells must be set before the first row is written
+    for index, width in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(index)].width = width or None
+    if widths:
+        ws.merged_cells.add("A1:%s1" % get_column_letter(len(widths)))
+
+    def _cell(value, style):
+        cell = WriteOnlyCell(ws, value)
+        cell.style = style
+        return cell
+
+    try:
+        ws.append([_cell(title, "export_title")])
+        ws.append([_cell(value, "export_header") for value in thead])
+        for tr in trs:
+            ws.append([_cell(converter(value), "export_value") for converter, value in zip(converters, tr)])
+    except Exception:
+        # Close the unfinished sheet stream
+        ws.close()
+        raise
+
+    file = tempfile.TemporaryFile(suffix=".xlsx")
+    try:
+        wb.save(file)
+    except Exception:
+        file.close()
+        raise
+    file.seek(0)
+    return file
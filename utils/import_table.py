@@ -0,0 +1,47 @@
+import csv
+import io
+import os
+
+from openpyxl import load_workbook
+
+# Extensions of the table files that can be read
+TABLE_FILE_EXTENSIONS = (".csv", ".xlsx")
+
+def _is_empty_row(values) -> bool:
+    return all(value is None or (isinstance(value, str) and not value.strip()) for value in values)
+
+def _iter_csv_rows(file, encoding):
+    text_file = io.TextIOWrapper(file, encoding=encoding, newline="")
+    try:
+        yield from csv.reader(text_file)
+    finally:
+        # Do not close the underlying file together with the wrapper
+        if not file.closed:
+            text_file.detach()
+
+def _iter_xlsx_rows(file):
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        yield from wb.active.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+def iter_table_rows(file, file_name: str, encoding="utf-8-sig"):
+    """ Read the rows of a table file lazily, the whole file is never loaded into memory
+    Excel files are read in the read-only mode of openpyxl (first worksheet), csv files with the csv module.
+    Empty rows are skipped.
+    :param file: Binary file object
+    :param file_name: File name, the format is determined by its extension (see TABLE_FILE_EXTENSIONS)
+    :param encoding: Encoding of csv files
+    :return: Generator of (row number starting from 1, list of cell values)
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == ".csv":
+        rows = _iter_csv_rows(file, encoding)
+    elif extension == ".xlsx":
+        rows = _iter_xlsx_rows(file)
+    else:
+        raise ValueError("Unsupported file format: %s" % (extension or file_name))
+    for row_number, values in enumerate(rows, start=1):
+        if not _is_empty_row(values):
+            yield row_number, list(values)
@@ -0,0 +1,178 @@
+import contextvars
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.template.base import Template
+
+_logger = logging.getLogger(__name__)
+
+# Metrics of the request being processed, contextvars are copied into the threads of sync_to_async,
+# so queries of async views (and of sync views run by an ASGI server) are attributed to the right request
+_current_metrics = contextvars.ContextVar("request_metrics", default=None)
+
+# {view name: deque of (wall time, db time, query num, template time)}, recent requests of this process
+_samples = {}
+_samples_lock = threading.Lock()
+
+class _RequestMetrics:
+
+    """ Metrics of one request """
+
+    __slots__ = ["query_num", "db_time", "slowest_queries", "template_time", "template_depth", "_top_sql_num"]
+
+    def __init__(self, top_sql_num):
+        self.query_num = 0
+        self.db_time = 0.0
+        # Min-heap of (duration, sql), keeps the top_sql_num slowest statements
+        self.slowest_queries = []
+        self.template_time = 0.0
+        self.template_depth = 0
+        self._top_sql_num = top_sql_num
+
+    def add_query(self, sql, duration):
+        self.query_num += 1
+        self.db_time += duration
+        if len(self.slowest_queries) < self._top_sql_num:
+            heapq.heappush(self.slowest_queries, (duration, sql))
+        elif self._top_sql_num and duration > self.slowest_queries[0][0]:
+            heapq.heapreplace(self.slowest_queries, (duration, sql))
+
+def _record_query(execute, sql, params, many, context):
+    """ Database execute wrapper (see connection.execute_wrapper), times the query if a request is being measured """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - start)
+
+def _install_execute_wrapper(sender, connection, **kwargs):
+    # Connections are created per thread (and again after reconnecting), the wrapper is added once to each of them
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+_original_template_render = Template.render
+
+def _timed_template_render(self, context):
+    """ Template.render measuring the rendering time, nested renders (include, inclusion tags) are only counted once """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return _original_template_render(self, context)
+    metrics.template_depth += 1
+    start = time.perf_counter()
+    try:
+        return _original_template_render(self, context)
+    finally:
+        metrics.template_depth -= 1
+        if metrics.template_depth == 0:
+            metrics.template_time += time.perf_counter() - start
+
+def _percentile(sorted_values, percent):
+    """ Nearest-rank percentile of a sorted list """
+    index = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+def get_request_metrics_summary() -> dict:
+    """ Percentiles (p50, p90, p99, max) of the recent requests of each view in this process, times are in milliseconds
+    :return: {view name: {"count": n, "wall_time": {...}, "db_time": {...}, "query_num": {...}, "template_time": {...}}}
+    """
+    with _samples_lock:
+        samples = {view_name: list(view_samples) for view_name, view_samples in _samples.items()}
+    summary = {}
+    for view_name, view_samples in sorted(samples.items()):
+        view_summary = {"count": len(view_samples)}
+        for index, metric in enumerate(("wall_time", "db_time", "query_num", "template_time")):
+            if metric == "query_num":
+                values = sorted(sample[index] for sample in view_samples)
+            else:
+                values = sorted(round(sample[index] * 1000, 3) for sample in view_samples)
+            view_summary[metric] = {
+                "p50": _percentile(values, 50),
+                "p90": _percentile(values, 90),
+                "p99": _percentile(values, 99),
+                "max": values[-1],
+            }
+        summary[view_name] = view_summary
+    return summary
+
+class RequestMetricsMiddleware:
+
+    """ Lightweight request instrumentation, cheap enough for production
+    Records the query count, total database time, template rendering time and wall time of every request by view name
+    (see get_request_metrics_summary), and logs the requests over the thresholds with their slowest SQL statements.
+    Queries are timed with an execute wrapper (see connection.execute_wrapper) installed on every database connection,
+    templates by wrapping Template.render. Settings (all optional):
+        REQUEST_METRICS_SLOW_TIME: Wall time (seconds) over which a request is logged, default 1
+        REQUEST_METRICS_SLOW_QUERY_NUM: Query count over which a request is logged, default 100
+        REQUEST_METRICS_TOP_SQL_NUM: Number of the slowest SQL statements logged, default 5
+        REQUEST_METRICS_SAMPLES_PER_VIEW: Number of recent requests of each view kept for the percentiles, default 1000
+    Put it first in MIDDLEWARE so that the other middlewares are measured too.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_time = getattr(settings, "REQUEST_METRICS_SLOW_TIME", 1)
+        self.slow_query_num = getattr(settings, "REQUEST_METRICS_SLOW_QUERY_NUM", 100)
+        self.top_sql_num = getattr(settings, "REQUEST_METRICS_TOP_SQL_NUM", 5)
+        self.samples_per_view = getattr(settings, "REQUEST_METRICS_SAMPLES_PER_VIEW", 1000)
+        connection_created.connect(_install_execute_wrapper, dispatch_uid="request_metrics_execute_wrapper")
+        # Connections opened before the middleware was loaded
+        from django.db import connections
+        for connection in connections.all(initialized_only=True):
+            _install_execute_wrapper(None, connection)
+        Template.render = _timed_template_render
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = _RequestMetrics(self.top_sql_num)
+        token = _current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        self._finish(request, metrics, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        metrics = _RequestMetrics(self.top_sql_num)
+        token = _current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        self._finish(request, metrics, time.perf_counter() - start)
+        return response
+
+    def _finish(self, request, metrics: _RequestMetrics, wall_time: float):
+        resolver_match = getattr(request, "resolver_match", None)
+        view_name = resolver_match.view_name if resolver_match else "<unresolved>"
+        with _samples_lock:
+            view_samples = _samples.get(view_name)
+            if view_samples is None:
+                view_samples = _samples[view_name] = deque(maxlen=self.samples_per_view)
+            view_samples.append((wall_time, metrics.db_time, metrics.query_num, metrics.template_time))
+        if wall_time <= self.slow_time and metrics.query_num <= self.slow_query_num:
+            return
+        _logger.warning(
+            "Slow request: %s %s (%s), wall time %.1fms, %d queries in %.1fms, template rendering %.1fms",
+            request.method, request.path, view_name,
+            wall_time * 1000, metrics.query_num, metrics.db_time * 1000, metrics.template_time * 1000,
+        )
+        for duration, sql in sorted(metrics.slowest_queries, reverse=True):
+            _logger.warning("    %.1fms: %s", duration * 1000, sql)
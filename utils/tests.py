@@ -0,0 +1,63 @@
+import random
+import sys
+import threading
+import time
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from utils.common import ExpireLruCache
+
+
+class ExpireLruCacheTests(SimpleTestCase):
+
+    def test_concurrent_hits_and_purges(self):
+        """ Cache hits reorder the entries while other threads purge the expired ones, no thread may see the dict mutated """
+        cache = ExpireLruCache(expire_time=timezone.timedelta(milliseconds=5), maxsize=1024)
+
+        @cache
+        def square(n):
+            return n * n
+
+        errors = []
+        deadline = time.monotonic() + 3
+
+        def worker():
+            rand = random.Random()
+            try:
+                while time.monotonic() < deadline:
+                    n = rand.randrange(2000)
+                    self.assertEqual(square(n), n * n)
+            except Exception as exc:
+                errors.append(exc)
+
+        # Switch threads as often as possible, so that hits happen in the middle of the purges
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=worker) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        self.assertEqual(errors, [])
+        self.assertLessEqual(square.cache_info().currsize, 1024)
+
+    def test_lru_order(self):
+        cache = ExpireLruCache(maxsize=2)
+
+        @cache
+        def identity(n):
+            return n
+
+        identity(1)
+        identity(2)
+        # 1 becomes the most recently used, so 2 is evicted
+        identity(1)
+        identity(3)
+        self.assertEqual(identity.cache_info().evictions, 1)
+        misses = identity.cache_info().misses
+        identity(1)
+        self.assertEqual(identity.cache_info().misses, misses)
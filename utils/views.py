@@ -1,7 +1,7 @@
 import json
 
 from django.conf import settings
-from django.http import HttpResponseBadRequest, HttpResponse
+from django.http import HttpResponseBadRequest, FileResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
@@ -28,9 +28,14 @@ def export_excel(request):
         if settings.DEBUG:
             raise
         return HttpResponseBadRequest()
-    # Cannot use FileResponse or StreamingHttpResponse, which is strange
-    response = HttpResponse(gen_workbook(table_title, table_header, table_rows, table_rows_value_type))
-    response["Content-Type"] = "application/octet-stream"
-    # Must be encoded as ansi here, otherwise the filename will be garbled if it contains Chinese characters
-    response["Content-Disposition"] = ('attachment; filename="%s.xlsx"' % table_title).encode("ansi")
-    return response
+    try:
+        file = gen_workbook(table_title, table_header, table_rows, table_rows_value_type)
+    except (ValueError, TypeError):
+        if settings.DEBUG:
+            raise
+        return HttpResponseBadRequest()
+    # The workbook is written to a temporary file, FileResponse streams it in chunks and closes (deletes) it afterwards.
+    # The filename is encoded by FileResponse (RFC 5987), so Chinese characters are not garbled
+    return FileResponse(
+        file, as_attachment=True, filename="%s.xlsx" % table_title, content_type="application/octet-stream",
+    )
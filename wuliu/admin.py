@@ -3,6 +3,17 @@ from django.contrib import admin
 from . import models
 
 
+def _department_name_display(model, field_name: str):
+    """ Generate a list_display method showing the name of a department foreign key
+    The name is read from DepartmentRegistry, so the change list does not query the department of every row.
+    """
+    def _display(obj):
+        dept_id = getattr(obj, field_name + "_id")
+        return models.Department.get_name_by_id(dept_id) if dept_id is not None else None
+    _display.short_description = model._meta.get_field(field_name).verbose_name
+    _display.admin_order_field = field_name
+    return _display
+
 class PermissionGroupAdmin(admin.ModelAdmin):
     list_display = ["print_name", "name", "tree_str"]
     list_filter = ["father", ]
@@ -22,7 +33,9 @@ class DepartmentAdmin(admin.ModelAdmin):
 
 class UserAdmin(admin.ModelAdmin):
     readonly_fields = ["create_time"]
-    list_display = ["name", "department", "create_time", "administrator", "enabled"]
+    list_display = [
+        "name", _department_name_display(models.User, "department"), "create_time", "administrator", "enabled"
+    ]
     list_filter = ["enabled"]
 
 class CustomerAdmin(admin.ModelAdmin):
@@ -60,7 +73,10 @@ class WaybillAdmin(admin.ModelAdmin):
         "cargo_num", "status", "drop_reason"
     ]
     list_display = [
-        "get_full_id", "src_department", "dst_department", "fee", "fee_type",
+        "get_full_id",
+        _department_name_display(models.Waybill, "src_department"),
+        _department_name_display(models.Waybill, "dst_department"),
+        "fee", "fee_type",
         "create_time", "status", "cargo_price_status"
     ]
     list_filter = ["create_time"]
@@ -76,11 +92,28 @@ class TransportOutAdmin(admin.ModelAdmin):
         "src_department", "dst_department", "status", "waybills"
     ]
     list_display = [
-        "get_full_id", "truck", "driver_name", "src_department", "dst_department",
+        "get_full_id", "truck", "driver_name",
+        _department_name_display(models.TransportOut, "src_department"),
+        _department_name_display(models.TransportOut, "dst_department"),
         "start_time", "end_time", "status"
     ]
     list_filter = ["create_time", "start_time", "end_time"]
 
+class DailyDepartmentStatsAdmin(admin.ModelAdmin):
+    list_display = [
+        "date", _department_name_display(models.DailyDepartmentStats, "department"),
+        "created_num", "created_fee", "departed_num", "departed_fee",
+        "goods_yard_arrived_num", "goods_yard_arrived_fee", "arrived_num", "arrived_fee", "signed_for_num", "signed_for_fee",
+    ]
+    list_filter = ["date", "department"]
+
+    # Maintained automatically, see DailyDepartmentStats
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
 admin.site.register(models.Settings)
 admin.site.register(models.Department, DepartmentAdmin)
 admin.site.register(models.User, UserAdmin)
@@ -91,3 +124,4 @@ admin.site.register(models.Truck, TruckAdmin)
 admin.site.register(models.TransportOut, TransportOutAdmin)
 admin.site.register(models.Permission, PermissionAdmin)
 admin.site.register(models.PermissionGroup, PermissionGroupAdmin)
+admin.site.register(models.DailyDepartmentStats, DailyDepartmentStatsAdmin)
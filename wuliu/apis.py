@@ -1,22 +1,32 @@
-# from django.http import JsonResponse  # Unused import removed
+import datetime
+import math
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
 # from django.views import View         # Unused import removed
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_GET
 from django.utils import timezone
-from django.db.models import Q
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.contrib import messages
 
 # Import your models and utility functions
-from .models import Waybill, TransportOut, DepartmentPayment, CargoPricePayment
+from .models import (
+    Waybill, WaybillStateMachine, TransportOut, DepartmentPayment, CargoPricePayment, Department, DepartmentRegistry,
+    StandardFeeCalculator, Customer, Truck, User, Permission,
+)
 # from .decorators import _api_login_required, _api_check_permission  # Uncomment if available
-from .utils import (
+from .common import (
     is_logged_user_is_goods_yard,
-    validate_comma_separated_integer_list_and_split,
     get_logged_user,
 )
+from utils.common import UnescapedDjangoJSONEncoder, ModelDictSerializer, validate_comma_separated_integer_list_and_split
 from .action_api import ActionApi  # Uncomment if available
 
+# Max number of objects that can be requested at once in the batch mode (ids=1,2,3) of the get_*_info apis
+GET_INFO_MAX_IDS = 100
+
 def api_json_response(message_text="unknown", code=400, **kwargs):
     """ Return a standard ajax json response format """
     response = {
@@ -24,7 +34,7 @@ def api_json_response(message_text="unknown", code=400, **kwargs):
         "message": message_text,
         "data": kwargs
     }
-    return response
+    return JsonResponse(response, encoder=UnescapedDjangoJSONEncoder)
 
 @csrf_exempt
 @require_POST
@@ -33,34 +43,192 @@ def check_old_password(request):
     # Access request to avoid unused argument error
     return api_json_response("Not implemented", code=501)
 
-# The following API stubs are left as not implemented
-def get_customer_info(request):
-    """ Get customer details """
-    return api_json_response("Not implemented", code=501)
-
-def get_department_info(request):
-    """ Get department details """
-    return api_json_response("Not implemented", code=501)
+async def _aget_session_user(request) -> dict:
+    """ Read the logged-in user from the session, loading the session may query the database so it runs in a thread """
+    return await sync_to_async(request.session.get)("user")
+
+def _async_api_login_required(func):
+    """ Decorator of the async apis, return a 401 json response if the user is not logged in """
+    @wraps(func)
+    async def login_check(request, *args, **kwargs):
+        if not await _aget_session_user(request):
+            return api_json_response("Not logged in!", code=401)
+        return await func(request, *args, **kwargs)
+    return login_check
+
+def _async_api_check_administrator(func):
+    """ Decorator of the async apis, return a 403 json response if the logged-in user is not an administrator """
+    @wraps(func)
+    async def admin_check(request, *args, **kwargs):
+        if not (await sync_to_async(get_logged_user)(request)).administrator:
+            return api_json_response("Permission denied!", code=403)
+        return await func(request, *args, **kwargs)
+    return admin_check
+
+def _parse_info_request(request, name: str, allowed_fields) -> tuple:
+    """ Parse the parameters of the get_*_info apis
+    :param name: Object name, the id of a single object is passed as "<name>_id"
+    :param allowed_fields: Fields that can be requested with "fields=a,b,c" (all of them by default), "id" is always included
+    :return: (list of ids or None, id of the single object or None, list of fields)
+    Raise ValueError or ValidationError if the parameters are invalid
+    """
+    fields = request.GET.get("fields", "").strip()
+    if fields:
+        fields = ["id", *(f for f in fields.split(",") if f != "id")]
+        if not set(fields) <= set(allowed_fields):
+            raise ValueError("Unknown fields")
+    else:
+        fields = list(allowed_fields)
+    ids = request.GET.get("ids")
+    if ids is not None:
+        ids = list(dict.fromkeys(map(int, validate_comma_separated_integer_list_and_split(ids))))
+        if len(ids) > GET_INFO_MAX_IDS:
+            raise ValueError("Too many ids")
+        return ids, None, fields
+    return None, int(request.GET[name + "_id"]), fields
+
+async def _objects_info_response(request, name: str, queryset, allowed_fields, convert=None):
+    """ Shared implementation of the async get_*_info apis
+    Single mode: ?<name>_id=1, return {"<name>_info": {...}}
+    Batch mode: ?ids=1,2,3, return {"<name>_info_list": [...] (in the order of ids), "not_found_ids": [...]}
+    Field projection: ?fields=a,b, only these columns are selected
+    :param convert: Optional callable to post-process each values() row
+    """
+    try:
+        ids, obj_id, fields = _parse_info_request(request, name, allowed_fields)
+    except (KeyError, ValueError, ValidationError):
+        return api_json_response("Invalid request format!")
+    queryset = queryset.values(*fields)
+    convert = convert or (lambda row: row)
+    if ids is None:
+        try:
+            row = await queryset.aget(pk=obj_id)
+        except ObjectDoesNotExist:
+            return api_json_response("The object does not exist!", code=404)
+        return api_json_response("Success", code=200, **{name + "_info": convert(row)})
+    rows = {row["id"]: row async for row in queryset.filter(pk__in=ids)}
+    return api_json_response(
+        "Success", code=200, **{
+            name + "_info_list": [convert(rows[i]) for i in ids if i in rows],
+            "not_found_ids": [i for i in ids if i not in rows],
+        }
+    )
 
-def get_waybills_info(request):
-    """ Get waybill details """
-    return api_json_response("Not implemented", code=501)
+_CUSTOMER_INFO_FIELDS = (
+    "id", "name", "phone", "enabled", "bank_name", "bank_number", "credential_num", "address", "is_vip", "score",
+)
+_TRUCK_INFO_FIELDS = ("id", "number_plate", "driver_name", "driver_phone", "enabled")
+_USER_INFO_FIELDS = ("id", "name", "enabled", "administrator", "department_id", "create_time")
+_DEPARTMENT_INFO_FIELDS = (
+    "id", "name", "father_department_id", "unit_price", "enable_src", "enable_dst", "enable_cargo_price",
+    "is_branch_group", "is_branch", "is_goods_yard", "tree_str",
+)
 
-def get_truck_info(request):
+@require_GET
+@_async_api_login_required
+async def get_customer_info(request):
+    """ Get customer details """
+    return await _objects_info_response(request, "customer", Customer.objects.all(), _CUSTOMER_INFO_FIELDS)
+
+@require_GET
+@_async_api_login_required
+async def get_department_info(request):
+    """ Get department details
+    Departments are read from DepartmentRegistry (kept in memory), so the database is usually not queried at all.
+    """
+    try:
+        ids, dept_id, fields = _parse_info_request(request, "department", _DEPARTMENT_INFO_FIELDS)
+    except (KeyError, ValueError, ValidationError):
+        return api_json_response("Invalid request format!")
+    department_registry = await sync_to_async(DepartmentRegistry.current)()
+
+    def _department_info(dept_id_):
+        info = department_registry.get(dept_id_)
+        return {field: getattr(info, field) for field in fields}
+
+    if ids is None:
+        try:
+            return api_json_response("Success", code=200, department_info=_department_info(dept_id))
+        except Department.DoesNotExist:
+            return api_json_response("The object does not exist!", code=404)
+    return api_json_response(
+        "Success", code=200,
+        department_info_list=[_department_info(i) for i in ids if i in department_registry.departments],
+        not_found_ids=[i for i in ids if i not in department_registry.departments],
+    )
+
+@require_GET
+@_async_api_login_required
+async def get_waybills_info(request):
+    """ Get waybill details
+    Besides the model fields (foreign keys as "<name>_id"), the waybill number "id_", the department names
+    and the choice labels (status / status_id etc., same as waybill_to_dict) are added when the related fields are selected.
+    """
+    serializer = ModelDictSerializer.of(Waybill)
+    department_registry = await sync_to_async(DepartmentRegistry.current)()
+
+    def _convert(row):
+        if "return_waybill_id" in row:
+            row["id_"] = Waybill.format_full_id(row["id"], row["return_waybill_id"])
+        for field in ("src_department", "dst_department"):
+            if field + "_id" in row:
+                row[field + "_name"] = department_registry.get(row[field + "_id"]).name
+        for field in ("status", "fee_type", "cargo_price_status"):
+            if field in row:
+                row[field + "_id"] = row[field]
+                row[field] = serializer.choice_label(field, row[field])
+        return row
+
+    return await _objects_info_response(
+        request, "waybill", Waybill.objects.all(), serializer.values_fields, convert=_convert,
+    )
+
+@require_GET
+@_async_api_login_required
+async def get_truck_info(request):
     """ Get truck details """
-    return api_json_response("Not implemented", code=501)
-
-def get_user_info(request):
-    """ Get user details """
-    return api_json_response("Not implemented", code=501)
-
-def get_user_permission(request):
-    """ Get permissions owned by the user """
-    return api_json_response("Not implemented", code=501)
-
-def gen_standard_fee(request):
-    """ Given shipping department id, arrival department id, total cargo volume and weight, calculate standard freight """
-    return api_json_response("Not implemented", code=501)
+    return await _objects_info_response(request, "truck", Truck.objects.all(), _TRUCK_INFO_FIELDS)
+
+@require_GET
+@_async_api_login_required
+@_async_api_check_administrator
+async def get_user_info(request):
+    """ Get user details (administrators only) """
+    return await _objects_info_response(request, "user", User.objects.all(), _USER_INFO_FIELDS)
+
+@require_GET
+@_async_api_login_required
+@_async_api_check_administrator
+async def get_user_permission(request):
+    """ Get permissions owned by the user (administrators only) """
+    try:
+        user_id = int(request.GET["user_id"])
+    except (KeyError, ValueError):
+        return api_json_response("Invalid request format!")
+    perms = [name async for name in Permission.objects.filter(user__id=user_id).values_list("name", flat=True)]
+    return api_json_response("Success", code=200, perms=perms)
+
+@require_GET
+@_async_api_login_required
+async def gen_standard_fee(request):
+    """ Given shipping department id, arrival department id, total cargo volume and weight, calculate standard freight
+    See StandardFeeCalculator for the formula.
+    """
+    try:
+        src_dept_id = int(request.GET["src_dept_id"])
+        dst_dept_id = int(request.GET["dst_dept_id"])
+        cargo_volume = float(request.GET["cargo_volume"])
+        cargo_weight = float(request.GET["cargo_weight"])
+    except (KeyError, ValueError):
+        return api_json_response("Invalid request format!")
+    if not (math.isfinite(cargo_volume) and math.isfinite(cargo_weight)) or cargo_volume < 0 or cargo_weight < 0:
+        return api_json_response("Invalid request format!")
+    calculator = await sync_to_async(StandardFeeCalculator.current)()
+    try:
+        standard_fee = calculator.fee(src_dept_id, dst_dept_id, cargo_volume, cargo_weight)
+    except ValueError:
+        return api_json_response("Waybills cannot be shipped between these departments!")
+    return api_json_response("Success", code=200, standard_fee=standard_fee)
 
 def remove_waybill_when_add_transport_out(request):
     """ Remove waybill when adding a new transport out """
@@ -78,14 +246,70 @@ def add_waybill_when_edit_cargo_price_payment(request):
     """ Add waybill when editing cargo price payment """
     return api_json_response("Not implemented", code=501)
 
-# The rest of the classes (DropWaybill, DropTransportOut, StartTransportOut, etc.) should be implemented as needed.
-# For now, provide a minimal stub for StartTransportOut to avoid "Expected indented block" error.
-
-class StartTransportOut:
+# The rest of the classes (DropWaybill, DropTransportOut, etc.) should be implemented as needed.
+
+def _waybill_state_machine(request, timezone_now) -> WaybillStateMachine:
+    """ WaybillStateMachine operating as the logged-in user """
+    return WaybillStateMachine(
+        operation_user_id=request.session["user"]["id"],
+        operation_dept_id=request.session["user"]["department_id"],
+        time=timezone_now,
+    )
+
+def _apply_waybill_changes(request, timezone_now, changes: dict, abort_message: str, **kwargs):
+    """ Apply the validated changes (see WaybillStateMachine.apply)
+    If some waybills were changed concurrently since they were validated, the operation is aborted instead of failing
+    """
+    try:
+        return _waybill_state_machine(request, timezone_now).apply(changes, **kwargs)
+    except WaybillStateMachine.TransitionError as exc:
+        raise ActionApi.AbortException(abort_message) from exc
+
+class StartTransportOut(ActionApi):
     """ Dispatch transport out """
-    pass
 
-# Remove duplicate/unreachable code and ensure all methods/classes have proper bodies or are stubbed.
+    need_permissions = ("manage_transport_out", )
+
+    def actions(self):
+        to_id = self.request.POST.get("transport_out_id")
+        if not to_id:
+            raise ActionApi.AbortException("Invalid request format!")
+        try:
+            to_obj = TransportOut.objects.get(id=to_id)
+        except (ValueError, TransportOut.DoesNotExist) as exc:
+            raise ActionApi.AbortException("The transport out does not exist!") from exc
+        if to_obj.src_department_id != self.request.session["user"]["department_id"]:
+            raise ActionApi.AbortException("Cross-department operation on transport out is prohibited!")
+        # Only transport out in "Cargo Loaded" status can be dispatched
+        if to_obj.status != TransportOut.Statuses.Ready:
+            raise ActionApi.AbortException('Only transport out in "Cargo Loaded" status can be dispatched!')
+        waybill_ids = list(to_obj.waybills.values_list("id", flat=True))
+        if not waybill_ids:
+            raise ActionApi.AbortException("There are no waybills in this transport out!")
+        # Waybills loaded by the goods yard leave the goods yard, the others leave the branch
+        if is_logged_user_is_goods_yard(self.request):
+            waybills_status = Waybill.Statuses.GoodsYardDeparted
+        else:
+            waybills_status = Waybill.Statuses.Departed
+        changes = {waybills_status: waybill_ids}
+        try:
+            WaybillStateMachine.check(changes)
+        except WaybillStateMachine.TransitionError as exc:
+            raise ActionApi.AbortException("There are waybills with abnormal status in this transport out!") from exc
+        self._private_dic = {"to_obj": to_obj, "changes": changes, "timezone_now": timezone.now()}
+
+    def write_database(self):
+        to_obj = self._private_dic["to_obj"]
+        timezone_now = self._private_dic["timezone_now"]
+        TransportOut.objects.filter(id=to_obj.id).update(status=TransportOut.Statuses.OnTheWay, start_time=timezone_now)
+        _apply_waybill_changes(
+            self.request, timezone_now, self._private_dic["changes"],
+            "There are waybills with abnormal status in this transport out!",
+            operation_info={"transport_out_id": to_obj.id},
+        )
+
+    def actions_after_success(self):
+        messages.success(self.request, "Operation successful")
 
 class ConfirmArrival(ActionApi):
     """ Confirm arrival """
@@ -98,30 +322,41 @@ class ConfirmArrival(ActionApi):
             raise ActionApi.AbortException("Invalid request format!")
         try:
             to_obj = TransportOut.objects.get(id=to_id)
-        except TransportOut.DoesNotExist as exc:
+        except (ValueError, TransportOut.DoesNotExist) as exc:
             raise ActionApi.AbortException("The transport out does not exist!") from exc
         if to_obj.dst_department_id != self.request.session["user"]["department_id"]:
             raise ActionApi.AbortException("Cross-department operation on transport out is prohibited!")
         # Only transport out in "On The Way" status can be confirmed as arrived
         if to_obj.status != TransportOut.Statuses.OnTheWay:
             raise ActionApi.AbortException('Only transport out in "On The Way" status can be confirmed as arrived!')
-        # Ensure all waybills in the transport out have the same status and are in "Departed" or "Goods Yard Departed" status
+        # All waybills in the transport out must be in "Departed" (arriving at the goods yard)
+        # or "Goods Yard Departed" (arriving at the branch) status
+        if is_logged_user_is_goods_yard(self.request):
+            waybills_status = Waybill.Statuses.GoodsYardArrived
+        else:
+            waybills_status = Waybill.Statuses.Arrived
+        waybill_ids = list(to_obj.waybills.values_list("id", flat=True))
+        # An empty transport out can not be confirmed as arrived
+        if not waybill_ids:
+            raise ActionApi.AbortException("There are waybills with abnormal status in this transport out!")
+        changes = {waybills_status: waybill_ids}
         try:
-            waybills_status = to_obj.waybills.order_by("status").values("status").distinct()
-            assert len(waybills_status) == 1
-            waybills_status = waybills_status[0]["status"]
-            if is_logged_user_is_goods_yard(self.request):
-                assert waybills_status == Waybill.Statuses.Departed.value
-            else:
-                assert waybills_status == Waybill.Statuses.GoodsYardDeparted.value
-        except AssertionError as exc:
+            WaybillStateMachine.check(changes)
+        except WaybillStateMachine.TransitionError as exc:
             raise ActionApi.AbortException("There are waybills with abnormal status in this transport out!") from exc
         self._private_dic = {
-            "to_obj": to_obj, "waybills_status": waybills_status,
+            "to_obj": to_obj, "changes": changes, "timezone_now": timezone.now(),
         }
 
     def write_database(self):
-        # ... unchanged
+        to_obj = self._private_dic["to_obj"]
+        timezone_now = self._private_dic["timezone_now"]
+        TransportOut.objects.filter(id=to_obj.id).update(status=TransportOut.Statuses.Arrived, end_time=timezone_now)
+        _apply_waybill_changes(
+            self.request, timezone_now, self._private_dic["changes"],
+            "There are waybills with abnormal status in this transport out!",
+            operation_info={"transport_out_id": to_obj.id},
+        )
 
     def actions_after_success(self):
         messages.success(self.request, "Operation successful")
@@ -141,23 +376,53 @@ class ConfirmSignFor(ActionApi):
             sign_for_waybill_ids = validate_comma_separated_integer_list_and_split(sign_for_waybill_ids)
         except ValidationError as exc:
             raise ActionApi.AbortException("Invalid request format!") from exc
-        if Waybill.objects.filter(id__in=sign_for_waybill_ids).count() != len(sign_for_waybill_ids):
-            raise ActionApi.AbortException("There are non-existent waybills in the request!")
+        sign_for_waybill_ids = set(map(int, sign_for_waybill_ids))
+        # Fetch the arrival department and status of all waybills with one query and validate them in memory,
+        # the rows also carry what the daily department statistics need, so write_database does not read the waybills again
+        waybills_dic = {
+            wb_info["id"]: wb_info
+            for wb_info in Waybill.objects.filter(id__in=sign_for_waybill_ids).values(
+                "id", "dst_department_id", "status", "fee", "create_time", "src_department_id",
+            )
+        }
+        non_existent_ids = sign_for_waybill_ids - waybills_dic.keys()
+        if non_existent_ids:
+            raise ActionApi.AbortException(
+                "There are non-existent waybills in the request: %s" % ", ".join(map(str, sorted(non_existent_ids)))
+            )
         # Prohibit signing for waybills whose arrival department does not match the current department, and waybills not in "Arrived" status
-        if Waybill.objects.filter(id__in=sign_for_waybill_ids).filter(
-                ~Q(dst_department__id=self.request.session["user"]["department_id"]) |
-                ~Q(status=Waybill.Statuses.Arrived)).exists():
-            raise ActionApi.AbortException("There are waybills with abnormal status in the request!")
+        department_id = self.request.session["user"]["department_id"]
+        abnormal_ids = [
+            wb_id for wb_id, wb_info in sorted(waybills_dic.items())
+            if wb_info["dst_department_id"] != department_id or wb_info["status"] != Waybill.Statuses.Arrived
+        ]
+        if abnormal_ids:
+            raise ActionApi.AbortException(
+                "There are waybills with abnormal status in the request: %s" % ", ".join(map(str, abnormal_ids))
+            )
         timezone_now = timezone.now()
         self._private_dic = {
-            "sign_for_waybill_ids": sign_for_waybill_ids,
+            "sign_for_waybill_ids": sorted(sign_for_waybill_ids),
+            "waybills_dic": waybills_dic,
             "sign_for_name": sign_for_name,
             "sign_for_credential_num": sign_for_credential_num,
             "timezone_now": timezone_now,
         }
 
     def write_database(self):
-        # ... unchanged
+        # The waybills have been validated above, update status, sign_for_time and the recipient of all of them at once,
+        # reusing the validated rows. The UPDATE only matches waybills still "Arrived", if some of them were changed
+        # in the meantime the operation is aborted.
+        _apply_waybill_changes(
+            self.request, self._private_dic["timezone_now"],
+            {Waybill.Statuses.SignedFor: self._private_dic["sign_for_waybill_ids"]},
+            "There are waybills with abnormal status in the request!",
+            waybill_fields={Waybill.Statuses.SignedFor: {
+                "sign_for_customer_name": self._private_dic["sign_for_name"],
+                "sign_for_customer_credential_num": self._private_dic["sign_for_credential_num"],
+            }},
+            waybills_info=self._private_dic["waybills_dic"],
+        )
 
     def actions_after_success(self):
         messages.success(self.request, "Operation successful")
@@ -213,6 +478,35 @@ class DropDepartmentPayment(ActionApi):
     def write_database(self):
         self._private_dic["dp_queryset"].delete()
 
+class BatchAddDepartmentPayment(ActionApi):
+    """ Generate payments for all branches over a date range """
+
+    need_permissions = ("manage_department_payment__add_delete", )
+
+    def actions(self):
+        try:
+            dst_department = Department.objects.get(id=self.request.POST.get("dst_department_id", "").strip())
+        except (ValueError, Department.DoesNotExist) as exc:
+            raise ActionApi.AbortException("The receiving department does not exist!") from exc
+        try:
+            start_date = datetime.date.fromisoformat(self.request.POST.get("start_date", "").strip())
+            end_date = datetime.date.fromisoformat(self.request.POST.get("end_date", "").strip())
+        except ValueError as exc:
+            raise ActionApi.AbortException("Invalid request format!") from exc
+        if start_date > end_date:
+            raise ActionApi.AbortException("The start date cannot be later than the end date!")
+        if (end_date - start_date).days > 366:
+            raise ActionApi.AbortException("The date range cannot exceed one year!")
+        self._private_dic = {"dst_department": dst_department, "start_date": start_date, "end_date": end_date}
+
+    def write_database(self):
+        self._private_dic["dp_list"] = DepartmentPayment.bulk_gen(
+            self._private_dic["dst_department"], self._private_dic["start_date"], self._private_dic["end_date"],
+        )
+
+    def actions_after_success(self):
+        self.response_dic["data"]["created_count"] = len(self._private_dic["dp_list"])
+
 class ConfirmReviewDepartmentPayment(ActionApi):
     """ Review payment """
 
@@ -275,8 +569,7 @@ class ConfirmSettleAccountsDepartmentPayment(ActionApi):
             status=DepartmentPayment.Statuses.Settled,
             settle_accounts_time=self._private_dic["timezone_now"],
         )
-        for dp in self._private_dic["dp_queryset"]:
-            dp.update_customer_score_change()
+        DepartmentPayment.settle_customer_scores(self._private_dic["dp_queryset"])
 
     def actions_after_success(self):
         timezone_now = self._private_dic["timezone_now"]
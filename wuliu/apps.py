@@ -12,6 +12,10 @@ class WuliuConfig(AppConfig):
     verbose_name = "Logistics Transportation Management System"
     default_auto_field = "django.db.models.AutoField"
 
+    def ready(self):
+        # Register the cache invalidation signal handlers
+        from . import signals
+
 _request_exception_logger = logging.getLogger(__name__)
 
 @receiver(got_request_exception)
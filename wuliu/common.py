@@ -1,3 +1,4 @@
+from collections import defaultdict
 from functools import wraps
 
 from django.shortcuts import redirect
@@ -5,17 +6,26 @@ from django.http import Http404, HttpResponseForbidden
 from django.utils import timezone
 
 from .models import (
-    User, Waybill, TransportOut, DepartmentPayment, CargoPricePayment, Permission, PermissionGroup,
-    _get_global_settings,
+    User, DepartmentRegistry, Waybill, TransportOut, DepartmentPayment, CargoPricePayment,
+    Permission, PermissionGroup, _get_global_settings,
 )
-from utils.common import ExpireLruCache, model_to_dict_
+from utils.common import ExpireLruCache, ModelDictSerializer, model_to_dict_
 
 
-_EXPIRE_LRU_CACHE_1MIN = ExpireLruCache(expire_time=timezone.timedelta(minutes=1))
+# Shared by the user object cache and the user permission cache, so leave enough room for both
+# Entries are evicted as soon as users or their permissions change (see signals.py), so a long expiration time is safe.
+# The short local_expire_time bounds how long other processes keep using their in-process copy.
+_EXPIRE_LRU_CACHE_USER = ExpireLruCache(
+    expire_time=timezone.timedelta(hours=3), maxsize=1024,
+    shared_cache="shared", local_expire_time=timezone.timedelta(seconds=10),
+)
 
-get_global_settings = ExpireLruCache(expire_time=timezone.timedelta(hours=3))(_get_global_settings)
+get_global_settings = ExpireLruCache(
+    expire_time=timezone.timedelta(hours=12), maxsize=1, stale_while_revalidate=True,
+    shared_cache="shared", local_expire_time=timezone.timedelta(minutes=1),
+)(_get_global_settings)
 
-@_EXPIRE_LRU_CACHE_1MIN
+@_EXPIRE_LRU_CACHE_USER
 def _get_logged_user_by_id(user_id: int) -> User:
     """ Return user model object by user id """
     return User.objects.get(id=user_id)
@@ -28,7 +38,7 @@ def get_logged_user_type(request) -> User.Types:
     """ Get the user type of the logged-in user """
     return get_logged_user(request).get_type
 
-@_EXPIRE_LRU_CACHE_1MIN
+@_EXPIRE_LRU_CACHE_USER
 def _get_user_permissions(user: User) -> set:
     """ Get the permissions owned by the user, note this method returns a set not a QuerySet """
     return set(user.permission.all().values_list("name", flat=True))
@@ -45,20 +55,39 @@ def is_logged_user_is_goods_yard(request) -> bool:
     """ Determine whether the logged-in user belongs to the goods yard """
     return get_logged_user_type(request) == User.Types.GoodsYard
 
-def _gen_permission_tree_list(root_pg_=PermissionGroup.objects.get(father__isnull=True)) -> list:
-    """ Generate a list based on the hierarchical structure of all permission groups and permissions, for frontend rendering """
-    tree_list = []
-    for pg in PermissionGroup.objects.filter(father=root_pg_):
-        tree_list.append({
-            "id": pg.id, "name": pg.name, "print_name": pg.print_name, "children": _gen_permission_tree_list(pg)
-        })
-    for p in Permission.objects.filter(father=root_pg_):
-        tree_list.append({
-            "id": p.id, "name": p.name, "print_name": p.print_name,
-        })
-    return tree_list
-
-PERMISSION_TREE_LIST = _gen_permission_tree_list()
+@ExpireLruCache(
+    expire_time=timezone.timedelta(hours=12), maxsize=1,
+    shared_cache="shared", local_expire_time=timezone.timedelta(minutes=1),
+)
+def get_permission_tree_list() -> list:
+    """ Generate a list based on the hierarchical structure of all permission groups and permissions, for frontend rendering
+    Only two queries are issued (all permission groups and all permissions), the tree is assembled in memory.
+    The result is cached and evicted when a permission or permission group changes (see signals.py).
+    """
+    children_groups = defaultdict(list)
+    children_permissions = defaultdict(list)
+    root_pg_id = None
+    for pg in PermissionGroup.objects.order_by("id").values("id", "name", "print_name", "father_id"):
+        if pg["father_id"] is None:
+            root_pg_id = pg["id"]
+        else:
+            children_groups[pg["father_id"]].append(pg)
+    for p in Permission.objects.order_by("id").values("id", "name", "print_name", "father_id"):
+        children_permissions[p["father_id"]].append(p)
+
+    def _gen_tree_list(pg_id):
+        tree_list = []
+        for pg in children_groups[pg_id]:
+            tree_list.append({
+                "id": pg["id"], "name": pg["name"], "print_name": pg["print_name"], "children": _gen_tree_list(pg["id"])
+            })
+        for p in children_permissions[pg_id]:
+            tree_list.append({
+                "id": p["id"], "name": p["name"], "print_name": p["print_name"],
+            })
+        return tree_list
+
+    return _gen_tree_list(root_pg_id) if root_pg_id is not None else []
 
 def login_required(raise_404=False):
     """ Custom decorator for decorating route methods
@@ -100,22 +129,56 @@ def check_administrator(func):
         return func(request, *args, **kwargs)
     return admin_check
 
-def waybill_to_dict(waybill_obj: Waybill) -> dict:
-    """ Convert Waybill object to dictionary """
-    waybill_dic = model_to_dict_(waybill_obj)
-    waybill_dic["id_"] = waybill_obj.get_full_id
+def _complete_waybill_dict(waybill_dic: dict, department_registry: DepartmentRegistry) -> dict:
+    """ Add the waybill number, department names and choice labels to the dictionary from ModelDictSerializer """
+    serializer = ModelDictSerializer.of(Waybill)
+    waybill_dic["id_"] = Waybill.format_full_id(waybill_dic["id"], waybill_dic["return_waybill"])
+    waybill_dic["src_department_name"] = department_registry.get(waybill_dic["src_department"]).name
+    waybill_dic["dst_department_name"] = department_registry.get(waybill_dic["dst_department"]).name
     waybill_dic["fee_type_id"] = waybill_dic["fee_type"]
-    waybill_dic["fee_type"] = waybill_obj.get_fee_type_display()
+    waybill_dic["fee_type"] = serializer.choice_label("fee_type", waybill_dic["fee_type"])
     waybill_dic["status_id"] = waybill_dic["status"]
-    waybill_dic["status"] = waybill_obj.get_status_display()
-    if waybill_obj.return_waybill is not None:
+    waybill_dic["status"] = serializer.choice_label("status", waybill_dic["status"])
+    return waybill_dic
+
+def waybill_to_dict(waybill_obj: Waybill) -> dict:
+    """ Convert Waybill object to dictionary
+    Department names are read from DepartmentRegistry, so converting a list of waybills does not query their departments.
+    To convert many waybills, use waybills_to_dicts, which also loads the return waybills in batch.
+    """
+    waybill_dic = _complete_waybill_dict(model_to_dict_(waybill_obj), DepartmentRegistry.current())
+    if waybill_obj.return_waybill_id is not None:
         waybill_dic["return_waybill"] = waybill_to_dict(waybill_obj.return_waybill)
     else:
         waybill_dic["return_waybill"] = None
     return waybill_dic
 
+def waybills_to_dicts(waybills, fields=None) -> list:
+    """ Convert the waybills of the queryset to a list of dictionaries (same as waybill_to_dict), keeping the order
+    The rows are read with values(), so no model is instantiated, and the return waybills are loaded with one query.
+    :param fields: If given, only these fields are read (id, return_waybill, src_department, dst_department, status
+                   and fee_type are required), and the return waybills are not loaded, "return_waybill" keeps the id
+    """
+    department_registry = DepartmentRegistry.current()
+    serializer = ModelDictSerializer.of(Waybill, fields)
+    waybill_dics = [_complete_waybill_dict(dic, department_registry) for dic in serializer.iter_dicts(waybills)]
+    if fields is not None:
+        return waybill_dics
+    return_waybill_ids = {dic["return_waybill"] for dic in waybill_dics if dic["return_waybill"] is not None}
+    return_waybill_dics = {}
+    if return_waybill_ids:
+        return_waybill_dics = {
+            dic["id"]: dic for dic in waybills_to_dicts(Waybill.objects.filter(id__in=return_waybill_ids))
+        }
+    for waybill_dic in waybill_dics:
+        if waybill_dic["return_waybill"] is not None:
+            waybill_dic["return_waybill"] = return_waybill_dics[waybill_dic["return_waybill"]]
+    return waybill_dics
+
 def transport_out_to_dict(transport_out_obj: TransportOut) -> dict:
-    """ Convert TransportOut object to dictionary """
+    """ Convert TransportOut object to dictionary
+    Objects from TransportOut.objects.with_waybills_info() do not need an extra query per trip.
+    """
     to_dic = model_to_dict_(transport_out_obj)
     to_dic["id_"] = transport_out_obj.get_full_id
     to_dic["status_id"] = to_dic["status"]
@@ -1,5 +1,6 @@
 from django import forms
 import math
+import os
 
 def _init_form_fields_class(self_: forms.BaseForm):
     """ Set styles for all form fields """
@@ -39,13 +40,15 @@ class ChangePassword(_FormBase):
 # ... (snip, only showing changed labels below for brevity)
 
 from django.forms import ModelForm
+from django.forms.models import ModelChoiceIterator
 from django.utils import timezone
 
 # Import get_global_settings from the appropriate module
 # If utils.py is in the same directory as forms.py
 from wuliu.common import get_global_settings, get_logged_userr  # Adjust the import path as needed
 
-from .models import Waybill, Department  # Import Waybill and Department models from the current app's models
+from utils.import_table import TABLE_FILE_EXTENSIONS
+from .models import Waybill, Department, DepartmentRegistry  # Import Waybill and Department models from the current app's models
 
 # Define DEPARTMENT_GROUP_CHOICES if not already defined elsewhere
 DEPARTMENT_GROUP_CHOICES = {
@@ -55,6 +58,36 @@ DEPARTMENT_GROUP_CHOICES = {
     # Add more groups as needed
 }
 
+class _BranchChoiceIterator(ModelChoiceIterator):
+    """ Iterate the choices of branches from DepartmentRegistry, instead of querying them every time the form is rendered """
+
+    def _branch_ids(self):
+        return DepartmentRegistry.current().branch_ids()
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        registry = DepartmentRegistry.current()
+        for dept_id in self._branch_ids():
+            yield (dept_id, registry.get(dept_id).name)
+
+    def __len__(self):
+        return len(self._branch_ids()) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(self._branch_ids())
+
+class _BranchChoiceField(forms.ModelChoiceField):
+    """ Choice field of branches
+    The choices are read from DepartmentRegistry, the submitted value is still looked up in Department.queryset_is_branch(),
+    so cleaned_data holds a Department object.
+    """
+
+    iterator = _BranchChoiceIterator
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(Department.queryset_is_branch(), *args, **kwargs)
+
 class _ModelFormBase(ModelForm):
     """Base model form class for custom model forms."""
     def __init__(self, *args, **kwargs):
@@ -127,6 +160,16 @@ class WaybillForm(_ModelFormBase):
         }
         # ... (rest unchanged)
 
+class ImportWaybillsForm(_FormBase):
+    file = forms.FileField(label="File (csv / xlsx)")
+    dry_run = forms.BooleanField(label="Only Validate", required=False)
+
+    def clean_file(self):
+        file = self.cleaned_data["file"]
+        if os.path.splitext(file.name)[1].lower() not in TABLE_FILE_EXTENSIONS:
+            raise forms.ValidationError("Only csv and xlsx files are supported")
+        return file
+
 class WaybillSearchForm(_FormBase):
     create_date_start = forms.DateField(
         label="Invoice Date", required=False,
@@ -144,8 +187,8 @@ class WaybillSearchForm(_FormBase):
     sign_for_date_start = forms.DateField(label="Sign Date", required=False)
     sign_for_date_end = forms.DateField(label="To", required=False)
 
-    src_department = forms.ModelChoiceField(Department.queryset_is_branch(), required=False, label="Invoice Department")
-    dst_department = forms.ModelChoiceField(Department.queryset_is_branch(), required=False, label="Arrival Department")
+    src_department = _BranchChoiceField(required=False, label="Invoice Department")
+    dst_department = _BranchChoiceField(required=False, label="Arrival Department")
 
     src_department_group = forms.ChoiceField(
         label="-", required=False, choices=DEPARTMENT_GROUP_CHOICES.items(), initial=0,
@@ -0,0 +1,60 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from wuliu.models import WaybillRouting
+
+
+def _rows_per_row(queryset) -> list:
+    """ Routing rows as the waybill detail page rendered them before: the referenced objects of each row are loaded one by one """
+    return [
+        (wr.time, wr.get_operation_type_display(), wr.operation_dept.name, wr.operation_user.name, wr.gen_print_operation_info())
+        for wr in queryset
+    ]
+
+def _rows_batch(queryset) -> list:
+    """ Routing rows as rendered now (see the waybill_routings_with_operation_info template tag) """
+    return [
+        (wr.time, wr.get_operation_type_display(), wr.operation_dept.name, wr.operation_user.name, wr.gen_print_operation_info())
+        for wr in WaybillRouting.prefetch_operation_info_objects(queryset)
+    ]
+
+class Command(BaseCommand):
+    help = (
+        "Compare the time and the number of queries of rendering waybill routing details row by row and in batch, "
+        "on the latest routings of the database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=500, help="Number of routings rendered, default 500")
+        parser.add_argument("--repeat", type=int, default=5, help="Number of runs of each method, the median is reported")
+
+    def _measure(self, func, ids, repeat):
+        times = []
+        query_num = 0
+        for _ in range(repeat):
+            queryset = WaybillRouting.objects.filter(id__in=ids).order_by("time", "id")
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                rows = func(queryset)
+                times.append(time.perf_counter() - start)
+            query_num = len(queries)
+        return rows, statistics.median(times), query_num
+
+    def handle(self, *args, **options):
+        if options["limit"] < 1 or options["repeat"] < 1:
+            raise CommandError("--limit and --repeat must be positive")
+        ids = list(WaybillRouting.objects.order_by("-id").values_list("id", flat=True)[:options["limit"]])
+        if not ids:
+            raise CommandError("There are no waybill routings, load some data first (e.g. init_data.json)")
+        results = {}
+        for name, func in (("Row by row", _rows_per_row), ("Batch", _rows_batch)):
+            rows, median_time, query_num = self._measure(func, ids, options["repeat"])
+            results[name] = rows
+            self.stdout.write("%-10s %d routings: %8.2f ms, %d queries" % (name, len(rows), median_time * 1000, query_num))
+        if results["Row by row"] != results["Batch"]:
+            raise CommandError("The two methods render different rows")
+        self.stdout.write(self.style.SUCCESS("Done! Both methods render the same rows."))
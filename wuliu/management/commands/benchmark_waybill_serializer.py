@@ -0,0 +1,93 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import F
+from django.db.models.functions import Mod
+from django.test.utils import CaptureQueriesContext
+
+from wuliu.common import waybill_to_dict, waybills_to_dicts
+from wuliu.models import Department, Waybill
+
+
+# cargo_name of the waybills created by --seed, they are deleted again when the command finishes
+_SEED_CARGO_NAME = "__serializer_benchmark_seed__"
+# One of this many seeded waybills is a return waybill
+_SEED_RETURN_EVERY = 10
+
+def _dicts_per_instance(queryset) -> list:
+    """ The waybills converted one by one, each return waybill is loaded by its own (lazy) query """
+    return [waybill_to_dict(wb) for wb in queryset]
+
+class Command(BaseCommand):
+    help = (
+        "Compare the per row cost of converting waybills to dictionaries with waybill_to_dict (model instances) "
+        "and waybills_to_dicts (precompiled serializer on values() rows), on the latest waybills of the database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=10000, help="Number of waybills converted, default 10000")
+        parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each method, the median is reported")
+        parser.add_argument(
+            "--seed", type=int, default=0,
+            help="Create this many temporary waybills (one in %d of them a return waybill) before measuring, "
+                 "they are deleted afterwards. Only use it on a test database." % _SEED_RETURN_EVERY,
+        )
+
+    def _seed(self, num):
+        branch_ids = list(Department.queryset_is_branch().order_by("id").values_list("id", flat=True)[:2])
+        if len(branch_ids) < 2:
+            raise CommandError("At least two branches are required")
+        Waybill.objects.bulk_create([
+            Waybill(
+                src_department_id=branch_ids[i % 2], dst_department_id=branch_ids[1 - i % 2],
+                src_customer_name="seed", src_customer_phone=str(i), dst_customer_name="seed", dst_customer_phone=str(i),
+                cargo_name=_SEED_CARGO_NAME, cargo_num=1, cargo_volume=1, cargo_weight=1,
+                fee=1, fee_type=Waybill.FeeTypes.Now, status=Waybill.Statuses.Created,
+                cargo_price_status=Waybill.CargoPriceStatuses.No,
+            )
+            for i in range(num)
+        ], batch_size=1000)
+        seeded = Waybill.objects.filter(cargo_name=_SEED_CARGO_NAME)
+        first_id = seeded.order_by("id").values_list("id", flat=True).first()
+        # Each return waybill belongs to the seeded waybill right before it
+        seeded.annotate(rest=Mod("id", _SEED_RETURN_EVERY)).filter(rest=0, id__gt=first_id).update(
+            return_waybill_id=F("id") - 1,
+        )
+
+    def _measure(self, func, ids, repeat):
+        times = []
+        query_num = 0
+        for _ in range(repeat):
+            queryset = Waybill.objects.filter(id__in=ids).order_by("id")
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                dicts = func(queryset)
+                times.append(time.perf_counter() - start)
+            query_num = len(queries)
+        return dicts, statistics.median(times), query_num
+
+    def handle(self, *args, **options):
+        if options["limit"] < 1 or options["repeat"] < 1 or options["seed"] < 0:
+            raise CommandError("--limit and --repeat must be positive, --seed must not be negative")
+        if options["seed"]:
+            self.stdout.write("Seeding %d waybills..." % options["seed"])
+            self._seed(options["seed"])
+        try:
+            ids = list(Waybill.objects.order_by("-id").values_list("id", flat=True)[:options["limit"]])
+            if not ids:
+                raise CommandError("There are no waybills, load some data first (e.g. init_data.json) or use --seed")
+            results = {}
+            for name, func in (("Per instance", _dicts_per_instance), ("Serializer", waybills_to_dicts)):
+                dicts, median_time, query_num = self._measure(func, ids, options["repeat"])
+                results[name] = dicts
+                self.stdout.write("%-12s %d waybills: %8.2f ms, %6.1f us/row, %d queries" % (
+                    name, len(dicts), median_time * 1000, median_time * 1e6 / len(dicts), query_num,
+                ))
+        finally:
+            if options["seed"]:
+                Waybill.objects.filter(cargo_name=_SEED_CARGO_NAME).delete()
+        if results["Per instance"] != results["Serializer"]:
+            raise CommandError("The two methods produce different dictionaries")
+        self.stdout.write(self.style.SUCCESS("Done! Both methods produce the same dictionaries."))
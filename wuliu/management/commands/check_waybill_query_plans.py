@@ -0,0 +1,150 @@
+import datetime
+import itertools
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+from wuliu.models import Department, Waybill
+
+
+# cargo_name of the waybills created by --seed, they are deleted again when the command finishes
+_SEED_CARGO_NAME = "__query_plan_seed__"
+_SEED_DAYS = 90
+
+def _search_queries(src_department_id, dst_department_id, today):
+    """ Querysets with the same filters and ordering as the waybill searches, business reports and the welcome page
+    :return: List of (name, queryset)
+    """
+    start_time = timezone.make_aware(datetime.datetime.combine(today - datetime.timedelta(days=30), datetime.time.min))
+    end_time = timezone.make_aware(datetime.datetime.combine(today, datetime.time.max))
+    statuses = Waybill.Statuses
+    return [
+        ("Waybill management of a branch", Waybill.objects.filter(
+            src_department_id=src_department_id, create_time__range=(start_time, end_time),
+        ).order_by("create_time", "id")),
+        ("Receiving report", Waybill.objects.filter(
+            src_department_id=src_department_id, create_time__range=(start_time, end_time),
+        ).order_by("-create_time", "-id")),
+        ("Customer sign for", Waybill.objects.filter(
+            dst_department_id=dst_department_id, status=statuses.Arrived,
+        ).order_by("create_time", "id")),
+        ("Arrival stock report", Waybill.objects.filter(
+            dst_department_id=dst_department_id, status=statuses.Arrived,
+        ).order_by("-create_time", "-id")),
+        ("Arrival report", Waybill.objects.filter(
+            dst_department_id=dst_department_id, arrival_time__range=(start_time, end_time),
+        ).order_by("arrival_time", "id")),
+        ("Sign for report", Waybill.objects.filter(
+            dst_department_id=dst_department_id, sign_for_time__range=(start_time, end_time),
+        ).order_by("sign_for_time", "id")),
+        ("Goods yard stock report", Waybill.objects.filter(
+            status=statuses.GoodsYardArrived,
+        ).order_by("create_time", "id")),
+        ("Waybill search of administrators", Waybill.objects.filter(
+            status=statuses.Created, create_time__range=(start_time, end_time),
+        ).order_by("create_time", "id")),
+        ("Waiting for sign for (welcome)", Waybill.objects.filter(
+            dst_department_id=dst_department_id, status=statuses.Arrived,
+        ).order_by()),
+    ]
+
+def _explain(queryset) -> list:
+    """ Run EXPLAIN on the queryset and return the problems found in the plan (full table scan or filesort) """
+    sql, params = queryset.query.sql_with_params()
+    problems = []
+    with connection.cursor() as cursor:
+        if connection.vendor == "mysql":
+            cursor.execute("EXPLAIN " + sql, params)
+            columns = [col[0].lower() for col in cursor.description]
+            for row in cursor.fetchall():
+                row = dict(zip(columns, row))
+                if row["type"] == "ALL":
+                    problems.append("full table scan on %s" % row["table"])
+                if "filesort" in (row["extra"] or ""):
+                    problems.append("filesort on %s" % row["table"])
+        elif connection.vendor == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            for row in cursor.fetchall():
+                detail = row[-1]
+                if detail.startswith("SCAN ") and " USING " not in detail:
+                    problems.append("full table scan (%s)" % detail)
+                if "TEMP B-TREE FOR ORDER BY" in detail:
+                    problems.append("filesort (%s)" % detail)
+        elif connection.vendor == "postgresql":
+            cursor.execute("EXPLAIN " + sql, params)
+            for (line, ) in cursor.fetchall():
+                line = line.strip().lstrip("-> ")
+                if line.startswith("Seq Scan"):
+                    problems.append("full table scan (%s)" % line)
+                if line.startswith(("Sort ", "Incremental Sort ")):
+                    problems.append("filesort (%s)" % line)
+        else:
+            raise CommandError("Database vendor %s is not supported" % connection.vendor)
+    return problems
+
+class Command(BaseCommand):
+    help = (
+        "Run EXPLAIN on the waybill search and report queries, "
+        "fail if any of them falls back to a full table scan or a filesort"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--seed", type=int, default=0,
+            help="Create this many temporary waybills before checking (deleted afterwards), "
+                 "the optimizer prefers full scans on almost empty tables. Only use it on a test database.",
+        )
+
+    def _seed(self, num, branch_ids):
+        statuses = list(Waybill.Statuses)
+        now = timezone.now()
+        branch_pairs = itertools.cycle(itertools.permutations(branch_ids, 2))
+        waybills = []
+        for i in range(num):
+            src_department_id, dst_department_id = next(branch_pairs)
+            create_time = now - datetime.timedelta(days=i % _SEED_DAYS)
+            status = statuses[i % len(statuses)]
+            waybills.append(Waybill(
+                arrival_time=create_time + datetime.timedelta(days=1) if status >= Waybill.Statuses.Arrived else None,
+                sign_for_time=create_time + datetime.timedelta(days=2) if status == Waybill.Statuses.SignedFor else None,
+                src_department_id=src_department_id, dst_department_id=dst_department_id,
+                src_customer_name="seed", src_customer_phone=str(i), dst_customer_name="seed", dst_customer_phone=str(i),
+                cargo_name=_SEED_CARGO_NAME, cargo_num=1, cargo_volume=1, cargo_weight=1,
+                fee=1, fee_type=Waybill.FeeTypes.Now, status=status, cargo_price_status=Waybill.CargoPriceStatuses.No,
+            ))
+        Waybill.objects.bulk_create(waybills, batch_size=1000)
+        # create_time has auto_now_add, so it is spread over the days with one UPDATE per day afterwards
+        seeded = Waybill.objects.filter(cargo_name=_SEED_CARGO_NAME).annotate(day=Mod("id", _SEED_DAYS))
+        for day in range(1, _SEED_DAYS):
+            seeded.filter(day=day).update(create_time=now - datetime.timedelta(days=day))
+        with connection.cursor() as cursor:
+            if connection.vendor == "mysql":
+                cursor.execute("ANALYZE TABLE %s" % Waybill._meta.db_table)
+            else:
+                cursor.execute("ANALYZE %s" % Waybill._meta.db_table)
+
+    def handle(self, *args, **options):
+        branch_ids = list(Department.queryset_is_branch().order_by("id").values_list("id", flat=True)[:2])
+        if len(branch_ids) < 2:
+            raise CommandError("At least two branches are required")
+        today = timezone.localdate()
+        if options["seed"]:
+            self.stdout.write("Seeding %d waybills..." % options["seed"])
+            self._seed(options["seed"], branch_ids)
+        try:
+            failed_num = 0
+            for name, queryset in _search_queries(branch_ids[0], branch_ids[1], today):
+                problems = _explain(queryset)
+                if problems:
+                    failed_num += 1
+                    self.stdout.write(self.style.ERROR("[FAIL] %s: %s" % (name, "; ".join(problems))))
+                else:
+                    self.stdout.write(self.style.SUCCESS("[OK] %s" % name))
+        finally:
+            if options["seed"]:
+                Waybill.objects.filter(cargo_name=_SEED_CARGO_NAME).delete()
+        if failed_num:
+            raise CommandError("%d of the queries fall back to a full table scan or a filesort" % failed_num)
+        self.stdout.write(self.style.SUCCESS("Done! All query plans use indexes."))
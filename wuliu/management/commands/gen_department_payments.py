@@ -0,0 +1,40 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wuliu.models import Department, DepartmentPayment
+
+
+def _parse_date(string):
+    try:
+        return datetime.date.fromisoformat(string)
+    except ValueError as exc:
+        raise CommandError("Invalid date: %s (expected YYYY-MM-DD)" % string) from exc
+
+class Command(BaseCommand):
+    help = "Generate department payments for all branches (or the given departments) over a date range"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dst-department", type=int, required=True, help="Id of the receiving department")
+        parser.add_argument("--start-date", type=_parse_date, required=True, help="First payment date (YYYY-MM-DD)")
+        parser.add_argument("--end-date", type=_parse_date, required=True, help="Last payment date (YYYY-MM-DD)")
+        parser.add_argument(
+            "--src-department", type=int, action="append", dest="src_departments",
+            help="Id of a payment department, can be repeated, default: all branches",
+        )
+
+    def handle(self, *args, **options):
+        start_date, end_date = options["start_date"], options["end_date"]
+        if start_date > end_date:
+            raise CommandError("--start-date must not be later than --end-date")
+        try:
+            dst_department = Department.objects.get(id=options["dst_department"])
+        except Department.DoesNotExist as exc:
+            raise CommandError("Receiving department %s does not exist" % options["dst_department"]) from exc
+        src_departments = None
+        if options["src_departments"]:
+            src_departments = list(Department.queryset_is_branch().filter(id__in=options["src_departments"]))
+            if len(src_departments) != len(set(options["src_departments"])):
+                raise CommandError("Payment departments must be existing branches")
+        dp_list = DepartmentPayment.bulk_gen(dst_department, start_date, end_date, src_departments)
+        self.stdout.write(self.style.SUCCESS("Done! %s payments created." % len(dp_list)))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.import_table import iter_table_rows
+from wuliu.models import User
+from wuliu.waybill_import import WaybillImporter
+
+
+class Command(BaseCommand):
+    help = "Import waybills from a csv or xlsx file, the first row is the header (see wuliu.waybill_import.WaybillImporter)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="Path of the csv or xlsx file")
+        parser.add_argument("--user", required=True, help="Name of the user recorded as the operator of the waybills")
+        parser.add_argument(
+            "--src-department", type=int,
+            help="Id of the shipping department of all waybills, default: read from the src_department column",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=500, help="Number of rows created in one transaction (default: 500)",
+        )
+        parser.add_argument("--encoding", default="utf-8-sig", help="Encoding of csv files (default: utf-8-sig)")
+        parser.add_argument("--dry-run", action="store_true", help="Only validate the rows, nothing is created")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(name=options["user"])
+        except User.DoesNotExist as exc:
+            raise CommandError("User %s does not exist" % options["user"]) from exc
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+        importer = WaybillImporter(
+            user, src_department_id=options["src_department"], chunk_size=options["chunk_size"],
+            dry_run=options["dry_run"],
+        )
+        try:
+            with open(options["file"], "rb") as file:
+                result = importer.import_rows(iter_table_rows(file, options["file"], encoding=options["encoding"]))
+        except (OSError, ValueError) as exc:
+            raise CommandError(str(exc)) from exc
+        for row_number, message in result["errors"]:
+            self.stderr.write("Row %d: %s" % (row_number, message))
+        if options["dry_run"]:
+            self.stdout.write(self.style.SUCCESS(
+                "Done! %d of %d rows are valid (dry run)." % (result["valid_num"], result["total_num"])
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                "Done! %d of %d waybills imported." % (len(result["waybill_ids"]), result["total_num"])
+            ))
@@ -0,0 +1,68 @@
+import datetime
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from wuliu.models import Waybill, WaybillRouting, DailyDepartmentStats
+
+
+def _parse_date(string):
+    try:
+        return datetime.date.fromisoformat(string)
+    except ValueError as exc:
+        raise CommandError("Invalid date: %s (expected YYYY-MM-DD)" % string) from exc
+
+def _day_start(date):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+class Command(BaseCommand):
+    help = "Rebuild the DailyDepartmentStats rollup from waybills and waybill routings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start-date", type=_parse_date, help="First day to rebuild (YYYY-MM-DD), default: the earliest day")
+        parser.add_argument("--end-date", type=_parse_date, help="Last day to rebuild (YYYY-MM-DD), default: the latest day")
+
+    def handle(self, *args, **options):
+        start_date, end_date = options["start_date"], options["end_date"]
+        if start_date and end_date and start_date > end_date:
+            raise CommandError("--start-date must not be later than --end-date")
+        waybills = Waybill.objects.exclude(status=Waybill.Statuses.Dropped)
+        routings = WaybillRouting.objects.filter(operation_type__in=DailyDepartmentStats.ROUTING_TYPE_FIELDS.keys())
+        stats = DailyDepartmentStats.objects.all()
+        # Days are bounded and computed in Python: the __date lookup and TruncDate return NULL on MySQL
+        # when the time zone tables are not loaded (USE_TZ is True)
+        if start_date:
+            waybills = waybills.filter(create_time__gte=_day_start(start_date))
+            routings = routings.filter(time__gte=_day_start(start_date))
+            stats = stats.filter(date__gte=start_date)
+        if end_date:
+            waybills = waybills.filter(create_time__lt=_day_start(end_date + datetime.timedelta(days=1)))
+            routings = routings.filter(time__lt=_day_start(end_date + datetime.timedelta(days=1)))
+            stats = stats.filter(date__lte=end_date)
+
+        changes = defaultdict(lambda: defaultdict(int))
+        # Voided waybills are simply left out, which is what the incremental maintenance converges to
+        for department_id, create_time, fee in waybills.values_list(
+                "src_department_id", "create_time", "fee").iterator(chunk_size=5000):
+            dic = changes[(department_id, timezone.localdate(create_time))]
+            dic["created_num"] += 1
+            dic["created_fee"] += fee
+        # The current freight of the waybills, the same as the incremental maintenance (see DailyDepartmentStats)
+        for department_id, time_, operation_type, fee in routings.values_list(
+                "operation_dept_id", "time", "operation_type", "waybill__fee").iterator(chunk_size=5000):
+            field_prefix = DailyDepartmentStats.ROUTING_TYPE_FIELDS[operation_type]
+            dic = changes[(department_id, timezone.localdate(time_))]
+            dic[field_prefix + "_num"] += 1
+            dic[field_prefix + "_fee"] += fee
+
+        with transaction.atomic():
+            deleted_count, _ = stats.delete()
+            DailyDepartmentStats.objects.bulk_create([
+                DailyDepartmentStats(department_id=department_id, date=date, **fields)
+                for (department_id, date), fields in changes.items()
+            ], batch_size=1000)
+        self.stdout.write(self.style.SUCCESS(
+            "Done! %s rows deleted, %s rows created." % (deleted_count, len(changes))
+        ))
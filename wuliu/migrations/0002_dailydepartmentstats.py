@@ -0,0 +1,36 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wuliu', '0001_squashed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyDepartmentStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True, verbose_name='Date')),
+                ('created_num', models.IntegerField(default=0, verbose_name='Created Waybills')),
+                ('created_fee', models.IntegerField(default=0, verbose_name='Created Freight')),
+                ('departed_num', models.IntegerField(default=0, verbose_name='Departed Waybills')),
+                ('departed_fee', models.IntegerField(default=0, verbose_name='Departed Freight')),
+                ('arrived_num', models.IntegerField(default=0, verbose_name='Arrived Waybills')),
+                ('arrived_fee', models.IntegerField(default=0, verbose_name='Arrived Freight')),
+                ('signed_for_num', models.IntegerField(default=0, verbose_name='Signed Waybills')),
+                ('signed_for_fee', models.IntegerField(default=0, verbose_name='Signed Freight')),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wuliu.department', verbose_name='Department')),
+            ],
+            options={
+                'verbose_name': 'Daily Department Statistics',
+                'verbose_name_plural': 'Daily Department Statistics',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailydepartmentstats',
+            constraint=models.UniqueConstraint(fields=('department', 'date'), name='unique_daily_department_stats'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wuliu', '0002_dailydepartmentstats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='waybill',
+            index=models.Index(fields=['src_department', 'create_time'], name='wb_src_dept_create_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='waybill',
+            index=models.Index(fields=['dst_department', 'status', 'create_time'], name='wb_dst_dept_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='waybill',
+            index=models.Index(fields=['dst_department', 'arrival_time'], name='wb_dst_dept_arrival_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='waybill',
+            index=models.Index(fields=['dst_department', 'sign_for_time'], name='wb_dst_dept_sign_for_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='waybill',
+            index=models.Index(fields=['status', 'create_time'], name='wb_status_create_time_idx'),
+        ),
+    ]
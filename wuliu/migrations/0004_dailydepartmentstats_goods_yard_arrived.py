@@ -0,0 +1,56 @@
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+# Waybill.Statuses.GoodsYardArrived
+GOODS_YARD_ARRIVED = 3
+
+
+def move_goods_yard_arrivals(apps, schema_editor):
+    """ Arrivals at goods yards were counted in arrived_num, move them to the new goods_yard_arrived_* fields """
+    WaybillRouting = apps.get_model("wuliu", "WaybillRouting")
+    DailyDepartmentStats = apps.get_model("wuliu", "DailyDepartmentStats")
+    changes = defaultdict(lambda: [0, 0])
+    # Dates are computed in Python, TruncDate needs the time zone tables on MySQL
+    for info in WaybillRouting.objects.filter(operation_type=GOODS_YARD_ARRIVED).values(
+            "operation_dept_id", "time", "waybill__fee").iterator():
+        change = changes[(info["operation_dept_id"], timezone.localdate(info["time"]))]
+        change[0] += 1
+        change[1] += info["waybill__fee"]
+    for (department_id, date), (num, fee) in changes.items():
+        DailyDepartmentStats.objects.filter(department_id=department_id, date=date).update(
+            arrived_num=F("arrived_num") - num, arrived_fee=F("arrived_fee") - fee,
+            goods_yard_arrived_num=F("goods_yard_arrived_num") + num,
+            goods_yard_arrived_fee=F("goods_yard_arrived_fee") + fee,
+        )
+
+
+def restore_goods_yard_arrivals(apps, schema_editor):
+    DailyDepartmentStats = apps.get_model("wuliu", "DailyDepartmentStats")
+    DailyDepartmentStats.objects.update(
+        arrived_num=F("arrived_num") + F("goods_yard_arrived_num"),
+        arrived_fee=F("arrived_fee") + F("goods_yard_arrived_fee"),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wuliu', '0003_waybill_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailydepartmentstats',
+            name='goods_yard_arrived_num',
+            field=models.IntegerField(default=0, verbose_name='Goods Yard Arrived Waybills'),
+        ),
+        migrations.AddField(
+            model_name='dailydepartmentstats',
+            name='goods_yard_arrived_fee',
+            field=models.IntegerField(default=0, verbose_name='Goods Yard Arrived Freight'),
+        ),
+        migrations.RunPython(move_goods_yard_arrivals, restore_goods_yard_arrivals),
+    ]
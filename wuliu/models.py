@@ -1,16 +1,17 @@
 import datetime as datetime_
+import itertools
 import math
 from collections import defaultdict
 
-from django.db import models, transaction
-from django.db.models import Count, Sum, Q, F
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, Sum, Q, F, Case, When, Value
 from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.core.validators import MinValueValidator, validate_slug
 from django.core.exceptions import ValidationError
-from django.template.loader import render_to_string
+from django.urls import reverse
 from django.utils.functional import cached_property
-from django.utils.html import strip_tags
+from django.utils.html import format_html, strip_tags
 
 from utils.common.expire_lru_cache import ExpireLruCache
 
@@ -150,14 +151,24 @@ class Department(models.Model):
         self.full_clean()
         super().save(*args, **kwargs)
 
+    def _registry_info(self):
+        """ Registry information of this department, None if the registry does not match this (unsaved or modified) object """
+        info = DepartmentRegistry.current().departments.get(self.pk)
+        if info is None or info.father_department_id != self.father_department_id:
+            return None
+        return info
+
     @cached_property
     def is_goods_yard(self) -> bool:
         """ Is this a goods yard """
-        return self.name == "Goods Yard"
+        return self.name == DepartmentRegistry.GOODS_YARD_NAME
 
     @cached_property
     def is_branch(self) -> bool:
         """ Is this a branch """
+        info = self._registry_info()
+        if info is not None:
+            return info.is_branch
         return self.father_department.is_branch_group if self.father_department else False
 
     is_branch.admin_order_field = "father_department"
@@ -170,17 +181,30 @@ class Department(models.Model):
 
     @classmethod
     def queryset_is_goods_yard(cls):
-        return cls.objects.filter(name="Goods Yard")
+        return cls.objects.filter(name=DepartmentRegistry.GOODS_YARD_NAME)
 
     @staticmethod
-    @ExpireLruCache(expire_time=timezone.timedelta(minutes=5))
     def get_name_by_id(dept_id):
         """ Get department name by id """
-        # Since User's __str__ method frequently needs department name, use a cached class method to reduce overhead
-        return Department.objects.get(id=dept_id).name
+        # Since User's __str__ method frequently needs department name, read it from the department registry
+        return DepartmentRegistry.current().get(dept_id).name
+
+    @staticmethod
+    def get_flags_by_id(dept_id) -> dict:
+        """ Get the shipping/receiving/collection flags of a department by id """
+        # Used by Waybill.clean, so that validating a waybill does not load both departments every time
+        info = DepartmentRegistry.current().get(dept_id)
+        return {
+            "enable_src": info.enable_src,
+            "enable_dst": info.enable_dst,
+            "enable_cargo_price": info.enable_cargo_price,
+        }
 
     @cached_property
     def tree_str(self) -> str:
+        info = self._registry_info()
+        if info is not None and info.name == self.name:
+            return info.tree_str
         return "%s %s" % (
             self.father_department.tree_str+" -" if self.father_department is not None else "",
             self.name,
@@ -191,6 +215,175 @@ class Department(models.Model):
     def __str__(self):
         return str(self.name)
 
+class _DepartmentInfo:
+
+    """ Read-only information of a department kept in DepartmentRegistry """
+
+    __slots__ = [
+        "id", "name", "father_department_id", "unit_price", "enable_src", "enable_dst", "enable_cargo_price",
+        "is_branch_group", "is_branch", "is_goods_yard", "tree_str", "children",
+    ]
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return "<_DepartmentInfo: %s (%s)>" % (self.name, self.id)
+
+class DepartmentRegistry:
+
+    """ In-memory snapshot of all departments, shared by the whole process
+    Departments form a small table that rarely changes but is read constantly (user types, form choices, waybill validation,
+    admin list displays...), so all of them are loaded with one query, and the hierarchy (tree strings, branch and goods yard flags,
+    children lists) is computed once instead of walking father_department with a query per level.
+    The snapshot is cached with ExpireLruCache (also in the shared cache) and evicted when a department changes (see signals.py).
+    Example:
+        registry = DepartmentRegistry.current()
+        registry.get(dept_id).tree_str
+        registry.branch_ids()
+    """
+
+    GOODS_YARD_NAME = "Goods Yard"
+
+    def __init__(self, department_values):
+        """
+        :param department_values: Iterable of department dictionaries (see Department.objects.values())
+        """
+        self.departments = {
+            dic["id"]: _DepartmentInfo(
+                is_branch=False, is_goods_yard=dic["name"] == self.GOODS_YARD_NAME, tree_str="", children=[], **dic
+            )
+            for dic in department_values
+        }
+        # Built on demand by StandardFeeCalculator.current()
+        self._standard_fee_calculator = None
+        for info in self.departments.values():
+            father = self.departments.get(info.father_department_id)
+            if father is not None:
+                father.children.append(info.id)
+                info.is_branch = father.is_branch_group
+
+        def _set_tree_str(info, father_tree_str):
+            info.tree_str = "%s %s" % (father_tree_str + " -" if father_tree_str else "", info.name)
+            for child_id in info.children:
+                _set_tree_str(self.departments[child_id], info.tree_str)
+
+        for info in self.departments.values():
+            if info.father_department_id is None:
+                _set_tree_str(info, "")
+
+    @staticmethod
+    @ExpireLruCache(
+        expire_time=timezone.timedelta(hours=3), maxsize=1,
+        shared_cache="shared", local_expire_time=timezone.timedelta(seconds=10),
+    )
+    def current() -> "DepartmentRegistry":
+        """ Return the registry of the current departments, loaded with one query """
+        return DepartmentRegistry(Department.objects.order_by("id").values(
+            "id", "name", "father_department_id", "unit_price",
+            "enable_src", "enable_dst", "enable_cargo_price", "is_branch_group",
+        ))
+
+    @staticmethod
+    def invalidate():
+        """ Evict the registry, the next call of current() reloads all departments """
+        DepartmentRegistry.current.invalidate()
+
+    def get(self, dept_id) -> _DepartmentInfo:
+        """ Get department information by id, raise Department.DoesNotExist if there is no such department
+        The snapshot can be older than a department just created by another process (see the local expire time of current()),
+        so on a miss the registry is invalidated and reloaded once before giving up.
+        """
+        try:
+            dept_id = int(dept_id)
+        except (TypeError, ValueError):
+            raise Department.DoesNotExist("Department matching id %r does not exist." % (dept_id, ))
+        info = self.departments.get(dept_id)
+        if info is None:
+            DepartmentRegistry.invalidate()
+            info = DepartmentRegistry.current().departments.get(dept_id)
+        if info is None:
+            raise Department.DoesNotExist("Department matching id %r does not exist." % (dept_id, ))
+        return info
+
+    def branch_ids(self) -> list:
+        """ Ids of all branches (departments under a branch group), in name order """
+        return [info.id for info in sorted(self.departments.values(), key=lambda x: x.name) if info.is_branch]
+
+    def goods_yard_ids(self) -> list:
+        """ Ids of all goods yards """
+        return [info.id for info in self.departments.values() if info.is_goods_yard]
+
+    def descendant_ids(self, dept_id) -> list:
+        """ Ids of all departments under the department (excluding itself) """
+        ids = []
+        for child_id in self.get(dept_id).children:
+            ids.append(child_id)
+            ids.extend(self.descendant_ids(child_id))
+        return ids
+
+class StandardFeeCalculator:
+
+    """ Standard freight of waybills
+    standard fee = ceil(unit price of the route * max(cargo volume, cargo weight))
+    The unit price of a route is the mean of the unit_price of the shipping and the receiving department.
+    Unit prices of all routes (branch pairs where the shipping department allows shipping and the receiving department allows arrival)
+    are precomputed into a matrix from DepartmentRegistry. The calculator is kept with the registry snapshot it is built from,
+    so it is rebuilt whenever the registry is reloaded (see current()).
+    Example:
+        calculator = StandardFeeCalculator.current()
+        calculator.fee(src_dept_id, dst_dept_id, cargo_volume, cargo_weight)
+        calculator.fees([(src_dept_id, dst_dept_id, cargo_volume, cargo_weight), ...])
+    """
+
+    def __init__(self, department_registry: DepartmentRegistry):
+        branches = [info for info in department_registry.departments.values() if info.is_branch]
+        # {(src_dept_id, dst_dept_id): unit price}
+        self.price_matrix = {
+            (src.id, dst.id): (src.unit_price + dst.unit_price) / 2
+            for src in branches if src.enable_src
+            for dst in branches if dst.enable_dst and dst.id != src.id
+        }
+
+    @staticmethod
+    def current() -> "StandardFeeCalculator":
+        """ Return the calculator of the current departments
+        It is not cached on its own: a separately cached calculator could be rebuilt from an outdated in-process registry
+        and published to the shared cache again right after a department change. Instead it is built once per registry snapshot.
+        """
+        registry = DepartmentRegistry.current()
+        calculator = getattr(registry, "_standard_fee_calculator", None)
+        if calculator is None:
+            calculator = registry._standard_fee_calculator = StandardFeeCalculator(registry)
+        return calculator
+
+    @staticmethod
+    def _ceil(value: float) -> int:
+        # Round off the float error first, e.g. (1.1 + 1.3) / 2 * 10 is 12.000000000000002, which must not become 13
+        return math.ceil(round(value, 6))
+
+    def fee(self, src_dept_id: int, dst_dept_id: int, cargo_volume: float, cargo_weight: float) -> int:
+        """ Standard freight of a waybill, raise ValueError if waybills cannot be shipped between the departments """
+        try:
+            unit_price = self.price_matrix[src_dept_id, dst_dept_id]
+        except KeyError:
+            raise ValueError("No route from department %r to department %r" % (src_dept_id, dst_dept_id))
+        return self._ceil(unit_price * max(cargo_volume, cargo_weight))
+
+    def fees(self, items) -> list:
+        """ Standard freight of many waybills at once (quotations, bulk imports)
+        :param items: Iterable of (src_dept_id, dst_dept_id, cargo_volume, cargo_weight)
+        :return: List of the standard fees in the same order, None for the items without a route
+        """
+        price_matrix_get = self.price_matrix.get
+        ceil = self._ceil
+        fees = []
+        for src_dept_id, dst_dept_id, cargo_volume, cargo_weight in items:
+            unit_price = price_matrix_get((src_dept_id, dst_dept_id))
+            fees.append(None if unit_price is None else ceil(unit_price * max(cargo_volume, cargo_weight)))
+        return fees
+
 # User
 class User(models.Model):
     name = models.CharField("Username", max_length=32, unique=True)
@@ -228,8 +421,9 @@ class User(models.Model):
         """ Get user type """
         if self.administrator:
             return self.Types.Administrator
-        is_goods_yard = self.department.is_goods_yard
-        is_branch = self.department.is_branch
+        department_info = DepartmentRegistry.current().get(self.department_id)
+        is_goods_yard = department_info.is_goods_yard
+        is_branch = department_info.is_branch
         assert not (is_goods_yard and is_branch), "Goods yard department should not have unit price"
         if is_goods_yard:
             return self.Types.GoodsYard
@@ -262,6 +456,16 @@ class Customer(models.Model):
     def __str__(self):
         return "%s (%s)%s" % (self.name, self.phone, " (VIP Customer)" if self.is_vip else "")
 
+class CargoPricePaymentQuerySet(QuerySet):
+
+    def with_total_fee(self):
+        """ Annotate the payable amounts of each payment (see CargoPricePayment.gen_total_fee) in the same query """
+        return self.annotate(
+            total_cargo_price=Sum("waybill__cargo_price"),
+            total_deduction_fee=Sum("waybill__fee", filter=Q(waybill__fee_type=Waybill.FeeTypes.Deduction)),
+            total_cargo_handling_fee=Sum("waybill__cargo_handling_fee"),
+        )
+
 # Cargo Price Payment
 class CargoPricePayment(models.Model):
     """
@@ -293,20 +497,25 @@ class CargoPricePayment(models.Model):
         verbose_name = "Cargo Price Payment"
         verbose_name_plural = verbose_name
 
+    objects = CargoPricePaymentQuerySet.as_manager()
+
     def gen_total_fee(self) -> dict:
-        """ Calculate payable amounts """
-        total_cargo_price = self.waybill_set.only("cargo_price").aggregate(_=models.Sum("cargo_price"))["_"]
-        total_deduction_fee = self.waybill_set.only("fee").filter(
-                fee_type=Waybill.FeeTypes.Deduction
-            ).aggregate(_=models.Sum("fee"))["_"]
-        total_cargo_handling_fee = self.waybill_set.only(
-                "cargo_handling_fee"
-            ).aggregate(_=models.Sum("cargo_handling_fee"))["_"]
-        return {
-            "cargo_price": total_cargo_price or 0,
-            "deduction_fee": total_deduction_fee or 0,
-            "cargo_handling_fee": total_cargo_handling_fee or 0,
-        }
+        """ Calculate payable amounts
+        If the object comes from CargoPricePayment.objects.with_total_fee(), the annotated values are used without any query.
+        """
+        if hasattr(self, "total_cargo_price"):
+            total_fee_dic = {
+                "cargo_price": self.total_cargo_price,
+                "deduction_fee": self.total_deduction_fee,
+                "cargo_handling_fee": self.total_cargo_handling_fee,
+            }
+        else:
+            total_fee_dic = self.waybill_set.aggregate(
+                cargo_price=Sum("cargo_price"),
+                deduction_fee=Sum("fee", filter=Q(fee_type=Waybill.FeeTypes.Deduction)),
+                cargo_handling_fee=Sum("cargo_handling_fee"),
+            )
+        return {k: v or 0 for k, v in total_fee_dic.items()}
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
@@ -410,24 +619,49 @@ class Waybill(models.Model):
     # Denormalized field: redundant
     cargo_price_status = models.SmallIntegerField("Cargo Price Status", choices=CargoPriceStatuses.choices, db_index=True)
 
+    # Fields read by clean(), saving with update_fields that contains none of them skips clean()
+    CLEAN_FIELDS = frozenset([
+        "src_department", "dst_department", "src_customer", "dst_customer",
+        "fee", "fee_type", "cargo_price", "return_waybill",
+    ])
+    # Fields used to compute the redundant field cargo_price_status
+    CARGO_PRICE_STATUS_FIELDS = frozenset(["cargo_price", "cargo_price_payment", "cargo_price_status"])
+    # Fields counted in DailyDepartmentStats, editing them applies the difference to the statistics
+    STATS_FIELDS = frozenset(["fee", "src_department", "src_department_id"])
+
     class Meta:
         verbose_name = "Waybill"
         verbose_name_plural = verbose_name
+        # Composite indexes for the filters used together by waybill searches, business reports and the welcome page,
+        # run "manage.py check_waybill_query_plans" after changing them
+        indexes = [
+            # Waybills created by a branch (waybill management, receiving report)
+            models.Index(fields=["src_department", "create_time"], name="wb_src_dept_create_time_idx"),
+            # Waybills waiting for sign for / in stock of a branch (customer sign for, arrival stock report)
+            models.Index(fields=["dst_department", "status", "create_time"], name="wb_dst_dept_status_idx"),
+            # Arrival report and sign for report of a branch
+            models.Index(fields=["dst_department", "arrival_time"], name="wb_dst_dept_arrival_time_idx"),
+            models.Index(fields=["dst_department", "sign_for_time"], name="wb_dst_dept_sign_for_time_idx"),
+            # Waybills in a status across all departments (goods yard stock, searches of administrators)
+            models.Index(fields=["status", "create_time"], name="wb_status_create_time_idx"),
+        ]
 
     def clean(self):
+        src_department_flags = Department.get_flags_by_id(self.src_department_id)
+        dst_department_flags = Department.get_flags_by_id(self.dst_department_id)
         custom_validators = [
             # Shipping/Receiving departments must have shipping/receiving permissions
-            (self.src_department.enable_src, "Shipping department does not have shipping permission"),
-            (self.dst_department.enable_dst, "Receiving department does not have receiving permission"),
+            (src_department_flags["enable_src"], "Shipping department does not have shipping permission"),
+            (dst_department_flags["enable_dst"], "Receiving department does not have receiving permission"),
             # Shipping and receiving departments cannot be the same
-            (self.src_department != self.dst_department, "Shipping and receiving departments cannot be the same"),
+            (self.src_department_id != self.dst_department_id, "Shipping and receiving departments cannot be the same"),
             # If sender/receiver is filled, the customer must be enabled
             (self.src_customer.enabled if self.src_customer else True, "Sender is not enabled"),
             (self.dst_customer.enabled if self.dst_customer else True, "Receiver is not enabled"),
             # If using deduction, receiving department must allow collection, and freight cannot exceed cargo price
             (
                 (
-                    self.dst_department.enable_cargo_price
+                    dst_department_flags["enable_cargo_price"]
                     if self.fee_type == self.FeeTypes.Deduction else True
                 ),
                 "Receiving department does not allow collection"
@@ -439,29 +673,72 @@ class Waybill(models.Model):
                 ),
                 "Deducted freight cannot exceed cargo price"
             ),
-            (self.return_waybill != self, "A waybill cannot be its own return waybill"),
+            (
+                self.return_waybill_id is None or self.return_waybill_id != self.id,
+                "A waybill cannot be its own return waybill"
+            ),
         ]
         for validator, error_text in custom_validators:
             if not validator:
                 raise ValidationError(error_text)
 
+    def _clean_update_fields(self, update_fields):
+        """ Validate only the fields that will be written when saving with update_fields
+        Field validation and unique validation are limited to update_fields, and clean() is only called
+        when update_fields contains a field it reads, so that status-only updates do not pay for full validation.
+        """
+        update_fields = set(update_fields)
+        exclude = [
+            field.name for field in self._meta.concrete_fields
+            if field.name not in update_fields and field.attname not in update_fields
+        ]
+        if update_fields.isdisjoint(self.CLEAN_FIELDS):
+            self.clean_fields(exclude=exclude)
+            self.validate_unique(exclude=exclude)
+        else:
+            self.full_clean(exclude=exclude)
+
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
         # Update redundant field cargo_price_status when saving
-        if self.cargo_price:
-            if self.cargo_price_payment and (self.cargo_price_payment.status == CargoPricePayment.Statuses.Paid):
-                self.cargo_price_status = self.CargoPriceStatuses.Paid
+        if update_fields is None or not self.CARGO_PRICE_STATUS_FIELDS.isdisjoint(update_fields):
+            if self.cargo_price:
+                if (self.cargo_price_payment_id is not None
+                        and self.cargo_price_payment.status == CargoPricePayment.Statuses.Paid):
+                    self.cargo_price_status = self.CargoPriceStatuses.Paid
+                else:
+                    self.cargo_price_status = self.CargoPriceStatuses.NotPaid
             else:
-                self.cargo_price_status = self.CargoPriceStatuses.NotPaid
+                self.cargo_price_status = self.CargoPriceStatuses.No
+            if update_fields is not None:
+                update_fields = kwargs["update_fields"] = {*update_fields, "cargo_price_status"}
+        if update_fields is None:
+            self.full_clean()
         else:
-            self.cargo_price_status = self.CargoPriceStatuses.No
-        self.full_clean()
-        super().save(*args, **kwargs)
+            self._clean_update_fields(update_fields)
+        adding = self._state.adding
+        with transaction.atomic():
+            old_values = None
+            if not adding and (update_fields is None or not self.STATS_FIELDS.isdisjoint(update_fields)):
+                old_values = Waybill.objects.select_for_update().filter(id=self.id).values(
+                    "fee", "src_department_id", "create_time", "status",
+                ).first()
+            super().save(*args, **kwargs)
+            if adding:
+                DailyDepartmentStats.record_waybills_created([self])
+            elif old_values is not None:
+                DailyDepartmentStats.record_waybill_changed(old_values, self)
+
+    @staticmethod
+    def format_full_id(waybill_id: int, return_waybill_id: int = None) -> str:
+        """ Waybill number of the waybill id, also usable with values() rows """
+        if return_waybill_id:
+            return "YF" + str(return_waybill_id).zfill(8)
+        return str(waybill_id).zfill(8)
 
     @cached_property
     def get_full_id(self) -> str:
-        if self.return_waybill:
-            return "YF" + str(self.return_waybill_id).zfill(8)
-        return str(self.id).zfill(8)
+        return self.format_full_id(self.id, self.return_waybill_id)
 
     get_full_id.admin_order_field = "pk"
     get_full_id.short_description = "Waybill Number"
@@ -484,6 +761,17 @@ class Truck(models.Model):
     def __str__(self):
         return str(self.number_plate)
 
+class TransportOutQuerySet(QuerySet):
+
+    def with_waybills_info(self):
+        """ Annotate the statistics of loaded waybills of each trip (see TransportOut.gen_waybills_info) in the same query """
+        return self.annotate(
+            total_num=Count("waybills"),
+            total_cargo_num=Sum("waybills__cargo_num"),
+            total_cargo_volume=Sum("waybills__cargo_volume"),
+            total_cargo_weight=Sum("waybills__cargo_weight"),
+        )
+
 # Transport Out (Trip)
 class TransportOut(models.Model):
 
@@ -509,6 +797,8 @@ class TransportOut(models.Model):
         "Status", choices=Statuses.choices, default=Statuses.Ready.value, db_index=True
     )
 
+    objects = TransportOutQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Trip"
         verbose_name_plural = verbose_name
@@ -524,7 +814,16 @@ class TransportOut(models.Model):
     get_full_id.short_description = "Trip Number"
 
     def gen_waybills_info(self):
-        """ Statistics for loaded waybills (count, quantity, total volume, total weight) """
+        """ Statistics for loaded waybills (count, quantity, total volume, total weight)
+        If the object comes from TransportOut.objects.with_waybills_info(), the annotated values are used without any query.
+        """
+        if hasattr(self, "total_num"):
+            return {
+                "total_num": self.total_num,
+                "total_cargo_num": self.total_cargo_num,
+                "total_cargo_volume": self.total_cargo_volume,
+                "total_cargo_weight": self.total_cargo_weight,
+            }
         return self.waybills.only(*"pk cargo_num cargo_volume cargo_weight".split()).aggregate(
             total_num=Count("pk"),
             total_cargo_num=Sum("cargo_num"),
@@ -550,36 +849,293 @@ class WaybillRouting(models.Model):
             self.waybill.get_full_id, self.get_operation_type_display()
         )
 
-    def _template_context(self) -> dict:
-        wr_transport_out = None
-        wr_return_waybill = None
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                DailyDepartmentStats.record_routings([self])
+
+    def _operation_info_objects(self) -> dict:
+        """ Objects referenced by operation_info (and the original waybill of a return waybill), used to generate the detailed text
+        Loaded one by one unless prefetch_operation_info_objects has been called for this object.
+        """
+        if hasattr(self, "_prefetched_operation_info_objects"):
+            return self._prefetched_operation_info_objects
+        transport_out = None
+        return_waybill = None
         if self.operation_type in (Waybill.Statuses.GoodsYardDeparted, Waybill.Statuses.Departed):
-            wr_transport_out_id = self.operation_info.get("transport_out_id")
-            if wr_transport_out_id:
-                wr_transport_out = TransportOut.objects.get(id=wr_transport_out_id)
+            transport_out_id = self.operation_info.get("transport_out_id")
+            if transport_out_id:
+                transport_out = TransportOut.objects.select_related(
+                    "src_department", "dst_department", "truck"
+                ).get(id=transport_out_id)
         elif self.operation_type == Waybill.Statuses.Returned:
-            wr_return_waybill_id = self.operation_info.get("return_waybill_id")
-            if wr_return_waybill_id:
-                wr_return_waybill = Waybill.objects.get(id=wr_return_waybill_id)
-        return {
-            "wr": self,
-            "WB_STATUSES": Waybill.Statuses,
-            "transport_out": wr_transport_out,
-            "return_waybill": wr_return_waybill,
-        }
+            return_waybill_id = self.operation_info.get("return_waybill_id")
+            if return_waybill_id:
+                return_waybill = Waybill.objects.get(id=return_waybill_id)
+        elif self.operation_type == Waybill.Statuses.Created and self.waybill.return_waybill_id:
+            return_waybill = self.waybill.return_waybill
+        return {"transport_out": transport_out, "return_waybill": return_waybill}
+
+    @classmethod
+    def prefetch_operation_info_objects(cls, routings) -> list:
+        """ Load the objects referenced by all routings with two in_bulk queries (trips and waybills), instead of one query per routing
+        If routings is a QuerySet, waybill, operation_dept and operation_user are also loaded with select_related.
+        :return: List of the routings
+        """
+        if isinstance(routings, QuerySet):
+            routings = routings.select_related("waybill", "operation_dept", "operation_user")
+        routings = list(routings)
+        transport_out_ids = set()
+        waybill_ids = set()
+        for wr in routings:
+            if wr.operation_type in (Waybill.Statuses.GoodsYardDeparted, Waybill.Statuses.Departed):
+                transport_out_ids.add(wr.operation_info.get("transport_out_id"))
+            elif wr.operation_type == Waybill.Statuses.Returned:
+                waybill_ids.add(wr.operation_info.get("return_waybill_id"))
+            elif wr.operation_type == Waybill.Statuses.Created:
+                waybill_ids.add(wr.waybill.return_waybill_id)
+        transport_out_ids.discard(None)
+        waybill_ids.discard(None)
+        transport_outs = TransportOut.objects.select_related(
+            "src_department", "dst_department", "truck"
+        ).in_bulk(transport_out_ids) if transport_out_ids else {}
+        waybills = Waybill.objects.in_bulk(waybill_ids) if waybill_ids else {}
+        for wr in routings:
+            if wr.operation_type == Waybill.Statuses.Created:
+                return_waybill = waybills.get(wr.waybill.return_waybill_id)
+            else:
+                return_waybill = waybills.get(wr.operation_info.get("return_waybill_id"))
+            wr._prefetched_operation_info_objects = {
+                "transport_out": transport_outs.get(wr.operation_info.get("transport_out_id")),
+                "return_waybill": return_waybill,
+            }
+        return routings
 
     def gen_print_operation_info(self) -> str:
-        """ Generate detailed text for waybill routing """
-        operation_info_string = render_to_string(
-            "wuliu/_inclusions/_waybill_routing_operation_info.html",
-            self._template_context(),
-        )
-        return operation_info_string.strip()
+        """ Generate detailed text for waybill routing (html) """
+        objects = self._operation_info_objects()
+        transport_out, return_waybill = objects["transport_out"], objects["return_waybill"]
+        return_reason = self.operation_info.get("return_reason") or "Unknown"
+        if self.operation_type == Waybill.Statuses.Created:
+            if return_waybill is not None:
+                return format_html(
+                    '该运单为退货运单，退货原因【{}】，原始运单【<a href="{}">{}</a>】',
+                    return_reason, reverse("wuliu:detail_waybill", args=(return_waybill.id, )), return_waybill.get_full_id,
+                )
+            return format_html(
+                "货物已由【{}】揽收，运单号【{}】", self.operation_user.name, self.waybill.get_full_id,
+            )
+        if self.operation_type in (Waybill.Statuses.Departed, Waybill.Statuses.GoodsYardDeparted):
+            if transport_out is None:
+                return ""
+            return format_html(
+                '货物已由【{}】发往【{}】，车次编号【<a href="{}?transport_out_id={}">{}</a>】，车牌号【{}】驾驶员【{}】电话【{}】',
+                transport_out.src_department, transport_out.dst_department,
+                reverse("wuliu:detail_transport_out"), transport_out.id, transport_out.get_full_id,
+                transport_out.truck.number_plate, transport_out.driver_name, transport_out.driver_phone,
+            )
+        if self.operation_type in (Waybill.Statuses.GoodsYardArrived, Waybill.Statuses.Arrived):
+            return format_html("货物已由【{}】卸车入库", self.operation_user.name)
+        if self.operation_type == Waybill.Statuses.SignedFor:
+            return format_html(
+                "货物已由【{}】签收，签收人身份证号【{}】",
+                self.waybill.sign_for_customer_name, self.waybill.sign_for_customer_credential_num,
+            )
+        if self.operation_type == Waybill.Statuses.Returned:
+            if return_waybill is None:
+                return ""
+            return format_html(
+                '由于【{}】，客户要求退货，退货运单【<a href="{}">{}</a>】',
+                return_reason, reverse("wuliu:detail_waybill", args=(return_waybill.id, )), return_waybill.get_full_id,
+            )
+        if self.operation_type == Waybill.Statuses.Dropped:
+            return format_html("运单已作废，作废原因【{}】", self.waybill.drop_reason)
+        return ""
+
+    @classmethod
+    def gen_print_operation_info_batch(cls, routings) -> list:
+        """ Generate detailed text (html) for many waybill routings, with a constant number of queries
+        :return: List of strings, in the same order as routings
+        """
+        return [wr.gen_print_operation_info() for wr in cls.prefetch_operation_info_objects(routings)]
 
     def gen_print_operation_info_text(self) -> str:
         """ Generate detailed text for waybill routing (remove html tags) """
         return strip_tags(self.gen_print_operation_info())
 
+class WaybillStateMachine:
+
+    """ Move many waybills to new statuses at once
+    The statuses of all waybills are validated with one grouped query (see check), then every target status is applied with
+    one UPDATE, and the waybill routings of all waybills are written with one bulk_create, all in the same transaction.
+    So the number of queries does not depend on the number of waybills (e.g. confirming the arrival of a 300-waybill trip).
+    Example:
+        WaybillStateMachine(user_id, department_id).transition(
+            {Waybill.Statuses.Arrived: waybill_ids}, operation_info={"transport_out_id": transport_out_id},
+        )
+    """
+
+    class TransitionError(Exception):
+        """ Raised when some waybills do not exist or can not be moved to the target status """
+
+        def __init__(self, message, waybill_ids=()):
+            super().__init__(message)
+            self.waybill_ids = sorted(waybill_ids)
+
+    # Target status: the statuses it can be reached from
+    TRANSITIONS = {
+        Waybill.Statuses.Created: frozenset([Waybill.Statuses.Loaded]),
+        Waybill.Statuses.Loaded: frozenset([Waybill.Statuses.Created]),
+        Waybill.Statuses.Departed: frozenset([Waybill.Statuses.Loaded]),
+        Waybill.Statuses.GoodsYardArrived: frozenset([Waybill.Statuses.Departed]),
+        Waybill.Statuses.GoodsYardLoaded: frozenset([Waybill.Statuses.GoodsYardArrived]),
+        Waybill.Statuses.GoodsYardDeparted: frozenset([Waybill.Statuses.GoodsYardLoaded]),
+        Waybill.Statuses.Arrived: frozenset([Waybill.Statuses.GoodsYardDeparted]),
+        Waybill.Statuses.SignedFor: frozenset([Waybill.Statuses.Arrived]),
+        Waybill.Statuses.Returned: frozenset([Waybill.Statuses.Arrived]),
+        Waybill.Statuses.Dropped: frozenset([Waybill.Statuses.Created]),
+    }
+    # Loading and unloading a trip are not recorded in the waybill routing
+    ROUTING_STATUSES = frozenset([
+        Waybill.Statuses.Departed, Waybill.Statuses.GoodsYardArrived, Waybill.Statuses.GoodsYardDeparted,
+        Waybill.Statuses.Arrived, Waybill.Statuses.SignedFor, Waybill.Statuses.Returned, Waybill.Statuses.Dropped,
+    ])
+    # Redundant time fields of Waybill updated together with the status
+    TIME_FIELDS = {
+        Waybill.Statuses.Arrived: "arrival_time",
+        Waybill.Statuses.SignedFor: "sign_for_time",
+    }
+
+    def __init__(self, operation_user_id, operation_dept_id, time=None):
+        """
+        :param operation_user_id: Id of the user who performs the operation
+        :param operation_dept_id: Id of the department of the user
+        :param time: Operation time, default is now
+        """
+        self.operation_user_id = operation_user_id
+        self.operation_dept_id = operation_dept_id
+        self.time = time or timezone.now()
+
+    @classmethod
+    def _normalize_changes(cls, changes: dict) -> dict:
+        normalized = {}
+        seen_ids = set()
+        for target_status, waybill_ids in changes.items():
+            if target_status not in cls.TRANSITIONS:
+                raise ValueError("Waybills can not be moved to status %r" % (target_status, ))
+            waybill_ids = set(waybill_ids)
+            if not seen_ids.isdisjoint(waybill_ids):
+                raise cls.TransitionError(
+                    "A waybill can only be moved to one status at a time!", seen_ids & waybill_ids
+                )
+            seen_ids |= waybill_ids
+            if waybill_ids:
+                normalized[Waybill.Statuses(target_status)] = waybill_ids
+        return normalized
+
+    @classmethod
+    def check(cls, changes: dict):
+        """ Validate that all waybills exist and can be moved to their target status, with one grouped query
+        :param changes: {target status: iterable of waybill ids}
+        :raise WaybillStateMachine.TransitionError: with the ids of the waybills that failed
+        """
+        changes = cls._normalize_changes(changes)
+        if not changes:
+            return
+        all_ids = set(itertools.chain.from_iterable(changes.values()))
+        target_case = Case(
+            *[When(id__in=waybill_ids, then=Value(int(target))) for target, waybill_ids in changes.items()],
+            output_field=models.SmallIntegerField(),
+        )
+        groups = (
+            Waybill.objects.filter(id__in=all_ids).order_by()
+            .annotate(target_status=target_case).values("target_status", "status").annotate(num=Count("id"))
+        )
+        found_num = 0
+        valid = True
+        for group in groups:
+            found_num += group["num"]
+            if group["status"] not in cls.TRANSITIONS[group["target_status"]]:
+                valid = False
+        if found_num == len(all_ids) and valid:
+            return
+        # Only reached on failure: find out exactly which waybills failed
+        statuses = dict(Waybill.objects.filter(id__in=all_ids).values_list("id", "status"))
+        missing_ids = all_ids - statuses.keys()
+        if missing_ids:
+            raise cls.TransitionError("There are non-existent waybills in the request!", missing_ids)
+        raise cls.TransitionError("There are waybills with abnormal status in the request!", [
+            waybill_id
+            for target, waybill_ids in changes.items()
+            for waybill_id in waybill_ids
+            if statuses[waybill_id] not in cls.TRANSITIONS[target]
+        ])
+
+    def apply(self, changes: dict, waybill_fields=None, operation_info=None, operation_info_by_id=None, waybills_info=None) -> list:
+        """ Move the waybills to their target statuses without the grouped check
+        Each UPDATE only matches waybills in an allowed source status, if some waybills were changed concurrently
+        TransitionError is raised and the transaction is rolled back.
+        :param changes: {target status: iterable of waybill ids}
+        :param waybill_fields: {target status: other Waybill fields to update}, e.g. {SignedFor: {"sign_for_customer_name": "..."}}
+        :param operation_info: WaybillRouting.operation_info of all the routings
+        :param operation_info_by_id: {waybill id: operation_info}, overrides operation_info for these waybills
+        :param waybills_info: Rows already read by the caller, passed on to DailyDepartmentStats.record_routings
+        :return: List of the created WaybillRouting objects
+        """
+        changes = self._normalize_changes(changes)
+        operation_info = operation_info or {}
+        operation_info_by_id = operation_info_by_id or {}
+        routings = []
+        with transaction.atomic():
+            for target_status, waybill_ids in changes.items():
+                update_dic = dict((waybill_fields or {}).get(target_status, {}), status=target_status)
+                if target_status in self.TIME_FIELDS:
+                    update_dic[self.TIME_FIELDS[target_status]] = self.time
+                updated_num = Waybill.objects.filter(
+                    id__in=waybill_ids, status__in=self.TRANSITIONS[target_status],
+                ).update(**update_dic)
+                if updated_num != len(waybill_ids):
+                    raise self.TransitionError("There are waybills with abnormal status in the request!")
+                if target_status in self.ROUTING_STATUSES:
+                    routings.extend(
+                        WaybillRouting(
+                            waybill_id=waybill_id,
+                            time=self.time,
+                            operation_type=target_status,
+                            operation_dept_id=self.operation_dept_id,
+                            operation_user_id=self.operation_user_id,
+                            operation_info=operation_info_by_id.get(waybill_id, operation_info),
+                        )
+                        for waybill_id in sorted(waybill_ids)
+                    )
+            if routings:
+                WaybillRouting.objects.bulk_create(routings)
+                # bulk_create does not call WaybillRouting.save, so count the routings here
+                DailyDepartmentStats.record_routings(routings, waybills_info)
+        return routings
+
+    def transition(self, changes: dict, **kwargs) -> list:
+        """ Validate (see check) and apply (see apply, which also takes the keyword arguments) in one transaction """
+        with transaction.atomic():
+            self.check(changes)
+            return self.apply(changes, **kwargs)
+
+class DepartmentPaymentQuerySet(QuerySet):
+
+    def with_total_fee(self):
+        """ Annotate the payable amounts of each payment (see DepartmentPayment.static_gen_total_fee) in the same query """
+        return self.annotate(
+            total_fee_now=Sum("waybills__fee", filter=Q(
+                waybills__src_department=F("src_department"), waybills__fee_type=Waybill.FeeTypes.Now,
+            )),
+            total_fee_sign_for=Sum("waybills__fee", filter=Q(
+                waybills__dst_department=F("src_department"), waybills__fee_type=Waybill.FeeTypes.SignFor,
+            )),
+            total_cargo_price=Sum("waybills__cargo_price", filter=Q(waybills__dst_department=F("src_department"))),
+        )
+
 # Department Payment
 class DepartmentPayment(models.Model):
 
@@ -607,6 +1163,8 @@ class DepartmentPayment(models.Model):
     src_remark = models.CharField("Payment Department Remark", max_length=256, blank=True)
     dst_remark = models.CharField("Receiving Department Remark", max_length=256, blank=True)
 
+    objects = DepartmentPaymentQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Department Payment"
         verbose_name_plural = verbose_name
@@ -621,60 +1179,142 @@ class DepartmentPayment(models.Model):
         def _date_to_datetime_end(_date):
             return timezone.make_aware(timezone.datetime.combine(_date, datetime_.time(23, 59, 59)))
 
-        transport_out_src = TransportOut.objects.filter(
-            src_department=src_department,
-            status__gte=TransportOut.Statuses.OnTheWay,
-            start_time__gte=_date_to_datetime_start(payment_date),
-            start_time__lte=_date_to_datetime_end(payment_date),
-        )
-        # Waybills shipped on the day (pay now)
-        waybills_src = [
-            wb_id
-            for to_obj in transport_out_src
-            for wb_id in to_obj.waybills.filter(fee_type=Waybill.FeeTypes.Now).values_list("id", flat=True)
-        ]
+        # Waybills shipped on the day (pay now), joined through the trips that departed on the day
+        waybills_src = Waybill.objects.filter(
+            transportout__src_department=src_department,
+            transportout__status__gte=TransportOut.Statuses.OnTheWay,
+            transportout__start_time__gte=_date_to_datetime_start(payment_date),
+            transportout__start_time__lte=_date_to_datetime_end(payment_date),
+            fee_type=Waybill.FeeTypes.Now,
+        ).values_list("id", flat=True)
         # Waybills signed for on the day
-        waybills_dst = list(
-            Waybill.objects.filter(
-                dst_department=src_department,
-                status=Waybill.Statuses.SignedFor,
-                sign_for_time__gte=_date_to_datetime_start(payment_date),
-                sign_for_time__lte=_date_to_datetime_end(payment_date),
-            ).values_list("id", flat=True)
-        )
-        return set(waybills_src + waybills_dst)
+        waybills_dst = Waybill.objects.filter(
+            dst_department=src_department,
+            status=Waybill.Statuses.SignedFor,
+            sign_for_time__gte=_date_to_datetime_start(payment_date),
+            sign_for_time__lte=_date_to_datetime_end(payment_date),
+        ).values_list("id", flat=True)
+        # One query regardless of the number of trips (UNION also removes duplicates)
+        return set(waybills_src.union(waybills_dst))
 
     def set_waybills_auto(self):
         """ Set related waybills """
         with transaction.atomic():
             self.waybills.set(self.static_gen_waybills(self.src_department, self.payment_date))
 
+    @classmethod
+    def bulk_gen(cls, dst_department: Department, start_date: datetime_.date, end_date: datetime_.date,
+                 src_departments=None) -> list:
+        """ Generate payments for many departments and days at once, equivalent to calling set_waybills_auto for each of them
+        The waybill sets of all departments and days are computed with two grouped queries,
+        payments and their waybill relations are written with bulk_create in one transaction.
+        Departments and days without waybills, and those which already have a payment to dst_department, are skipped.
+        :param dst_department: Receiving department of the payments
+        :param start_date: First payment date
+        :param end_date: Last payment date
+        :param src_departments: Payment departments, default is all branches
+        :return: List of created payments
+        """
+        if src_departments is None:
+            src_departments = Department.queryset_is_branch()
+        src_department_ids = {dept.id for dept in src_departments}
+        start_datetime = timezone.make_aware(timezone.datetime.combine(start_date, datetime_.time()))
+        end_datetime = timezone.make_aware(timezone.datetime.combine(end_date, datetime_.time(23, 59, 59)))
+        # {(src_department_id, payment_date): {waybill_id, ...}, ...}
+        waybill_ids_dic = defaultdict(set)
+        # Waybills shipped on each day (pay now)
+        waybills_src = Waybill.objects.filter(
+            transportout__src_department_id__in=src_department_ids,
+            transportout__status__gte=TransportOut.Statuses.OnTheWay,
+            transportout__start_time__gte=start_datetime,
+            transportout__start_time__lte=end_datetime,
+            fee_type=Waybill.FeeTypes.Now,
+        ).values_list("transportout__src_department_id", "transportout__start_time", "id")
+        # Waybills signed for on each day
+        waybills_dst = Waybill.objects.filter(
+            dst_department_id__in=src_department_ids,
+            status=Waybill.Statuses.SignedFor,
+            sign_for_time__gte=start_datetime,
+            sign_for_time__lte=end_datetime,
+        ).values_list("dst_department_id", "sign_for_time", "id")
+        # The local day is computed here rather than with TruncDate, which returns NULL on MySQL
+        # when the time zone tables are not loaded (USE_TZ is True)
+        for src_department_id, time_, waybill_id in itertools.chain(waybills_src, waybills_dst):
+            waybill_ids_dic[(src_department_id, timezone.localdate(time_))].add(waybill_id)
+        existing_keys = set(cls.objects.filter(
+            dst_department=dst_department,
+            src_department_id__in=src_department_ids,
+            payment_date__gte=start_date,
+            payment_date__lte=end_date,
+        ).values_list("src_department_id", "payment_date"))
+        for key in existing_keys:
+            waybill_ids_dic.pop(key, None)
+        if not waybill_ids_dic:
+            return []
+        with transaction.atomic():
+            dp_list = cls.objects.bulk_create([
+                cls(src_department_id=src_department_id, dst_department=dst_department, payment_date=payment_date)
+                for src_department_id, payment_date in waybill_ids_dic
+            ], batch_size=500)
+            if any(dp.pk is None for dp in dp_list):
+                # Some database backends (e.g. MySQL) do not return primary keys from bulk_create,
+                # look them up by (src_department, payment_date) instead, the payments which existed before were skipped above
+                dp_list = [
+                    dp for dp in cls.objects.filter(
+                        dst_department=dst_department,
+                        src_department_id__in=src_department_ids,
+                        payment_date__gte=start_date,
+                        payment_date__lte=end_date,
+                    )
+                    if (dp.src_department_id, dp.payment_date) in waybill_ids_dic
+                ]
+            through_model = cls.waybills.through
+            through_model.objects.bulk_create([
+                through_model(departmentpayment_id=dp.pk, waybill_id=waybill_id)
+                for dp in dp_list
+                for waybill_id in waybill_ids_dic[(dp.src_department_id, dp.payment_date)]
+            ], batch_size=1000)
+        return dp_list
+
     @staticmethod
     def static_gen_total_fee(waybills, src_department: Department) -> dict:
         """ Calculate payable amounts """
         if not isinstance(waybills, QuerySet):
             waybills = Waybill.objects.filter(id__in=waybills)
-        # Shipping waybills: pay now
-        fee_now = waybills.only("fee").filter(
-                src_department=src_department, fee_type=Waybill.FeeTypes.Now,
-            ).aggregate(_=models.Sum("fee"))["_"]
-        # Signed waybills: pay on delivery
-        fee_sign_for = waybills.only("fee").filter(
-                dst_department=src_department, fee_type=Waybill.FeeTypes.SignFor,
-            ).aggregate(_=models.Sum("fee"))["_"]
-        # Signed waybills: cargo price
-        cargo_price = waybills.only("cargo_price").filter(
-                dst_department=src_department
-            ).aggregate(_=models.Sum("cargo_price"))["_"]
-        return {
-            "fee_now": fee_now or 0,
-            "fee_sign_for": fee_sign_for or 0,
-            "cargo_price": cargo_price or 0,
-        }
+        total_fee_dic = waybills.aggregate(
+            # Shipping waybills: pay now
+            fee_now=Sum("fee", filter=Q(src_department=src_department, fee_type=Waybill.FeeTypes.Now)),
+            # Signed waybills: pay on delivery
+            fee_sign_for=Sum("fee", filter=Q(dst_department=src_department, fee_type=Waybill.FeeTypes.SignFor)),
+            # Signed waybills: cargo price
+            cargo_price=Sum("cargo_price", filter=Q(dst_department=src_department)),
+        )
+        return {k: v or 0 for k, v in total_fee_dic.items()}
 
     def gen_total_fee(self) -> dict:
-        """ Calculate payable amounts """
-        return self.static_gen_total_fee(self.waybills.all(), self.src_department)
+        """ Calculate payable amounts
+        If the object comes from DepartmentPayment.objects.with_total_fee(), the annotated values are used without any query.
+        """
+        if hasattr(self, "total_fee_now"):
+            return {
+                "fee_now": self.total_fee_now or 0,
+                "fee_sign_for": self.total_fee_sign_for or 0,
+                "cargo_price": self.total_cargo_price or 0,
+            }
+        return self.static_gen_total_fee(self.waybills.all(), self.src_department_id)
+
+    @staticmethod
+    def _is_customer_score_waybill(dp_src_department_id, waybill_info) -> bool:
+        """ Whether the waybill brings score to its sender when settling a payment of department dp_src_department_id """
+        fee_type = waybill_info["fee_type"]
+        # Pay now: payment department should match shipping department
+        # Pay on delivery or deduction: payment department should match receiving department
+        return any([
+            fee_type == Waybill.FeeTypes.Now and dp_src_department_id == waybill_info["src_department_id"],
+            fee_type in (Waybill.FeeTypes.Deduction, Waybill.FeeTypes.SignFor) and (
+                dp_src_department_id == waybill_info["dst_department_id"]
+            ),
+        ])
 
     def gen_customer_score_change(self) -> list:
         """ Calculate customer score changes """
@@ -684,15 +1324,7 @@ class DepartmentPayment(models.Model):
             "src_department_id", "dst_department_id", "src_customer_id", "id", "fee", "fee_type",
         )
         for waybill_info in filtered_waybills_info:
-            fee_type = waybill_info["fee_type"]
-            # Pay now: payment department should match shipping department
-            # Pay on delivery or deduction: payment department should match receiving department
-            if any([
-                fee_type == Waybill.FeeTypes.Now and self.src_department_id == waybill_info["src_department_id"],
-                fee_type in (Waybill.FeeTypes.Deduction, Waybill.FeeTypes.SignFor) and (
-                    self.src_department_id == waybill_info["dst_department_id"]
-                ),
-            ]):
+            if self._is_customer_score_waybill(self.src_department_id, waybill_info):
                 customer_score_change.append({
                     "customer_id": waybill_info["src_customer_id"],
                     "waybill_id": waybill_info["id"],
@@ -700,28 +1332,56 @@ class DepartmentPayment(models.Model):
                 })
         return customer_score_change
 
-    def update_customer_score_change(self):
-        """ Update customer score changes """
-        customer_score_changes = self.gen_customer_score_change()
+    @classmethod
+    def settle_customer_scores(cls, dp_queryset, batch_size=500):
+        """ Update customer scores for many payments at once (see gen_customer_score_change)
+        The waybills of all payments are read with one query, score logs are bulk created,
+        and customer scores are increased with one CASE-based UPDATE per batch of customers.
+        :param dp_queryset: QuerySet of the payments to settle
+        :param batch_size: Number of customers updated per UPDATE statement
+        """
+        customer_score_ratio = _get_global_settings().customer_score_ratio
+        waybills_info = cls.waybills.through.objects.filter(
+            departmentpayment__in=dp_queryset, waybill__src_customer__is_vip=True,
+        ).values(
+            "departmentpayment__src_department_id", "waybill_id",
+            src_department_id=F("waybill__src_department_id"),
+            dst_department_id=F("waybill__dst_department_id"),
+            src_customer_id=F("waybill__src_customer_id"),
+            fee=F("waybill__fee"),
+            fee_type=F("waybill__fee_type"),
+        )
+        score_logs = []
         # Calculate total score increase per customer
         customer_add_score_total = defaultdict(int)
-        for change in customer_score_changes:
-            customer_add_score_total[change["customer_id"]] += change["add_score"]
+        for waybill_info in waybills_info:
+            if not cls._is_customer_score_waybill(waybill_info["departmentpayment__src_department_id"], waybill_info):
+                continue
+            add_score = math.ceil(waybill_info["fee"] * customer_score_ratio)
+            score_logs.append(CustomerScoreLog(
+                customer_id=waybill_info["src_customer_id"],
+                inc_or_dec=True,
+                score=add_score,
+                remark="Waybill Settlement",
+                waybill_id=waybill_info["waybill_id"],
+            ))
+            customer_add_score_total[waybill_info["src_customer_id"]] += add_score
+        customer_add_score_items = list(customer_add_score_total.items())
         with transaction.atomic():
-            CustomerScoreLog.objects.bulk_create([
-                CustomerScoreLog(
-                    customer_id=change["customer_id"],
-                    inc_or_dec=True,
-                    score=change["add_score"],
-                    remark="Waybill Settlement",
-                    waybill=Waybill.objects.get(id=change["waybill_id"])
+            CustomerScoreLog.objects.bulk_create(score_logs, batch_size=batch_size)
+            for i in range(0, len(customer_add_score_items), batch_size):
+                batch = customer_add_score_items[i:i+batch_size]
+                Customer.objects.filter(id__in=[customer_id for customer_id, _ in batch]).update(
+                    score=F("score") + models.Case(
+                        *[models.When(id=customer_id, then=add_score_total) for customer_id, add_score_total in batch],
+                        default=0,
+                        output_field=models.PositiveIntegerField(),
+                    )
                 )
-                for change in customer_score_changes
-            ])
-            for customer_id, add_score_total in customer_add_score_total.items():
-                customer = Customer.objects.get(id=customer_id)
-                customer.score = F("score") + add_score_total
-                customer.save(update_fields=["score", ])
+
+    def update_customer_score_change(self):
+        """ Update customer score changes """
+        self.settle_customer_scores(DepartmentPayment.objects.filter(pk=self.pk))
 
     @cached_property
     def get_full_id(self) -> str:
@@ -759,3 +1419,140 @@ class CustomerScoreLog(models.Model):
         constraints = [
             models.CheckConstraint(check=Q(score__gte=1), name="check_change_score"),
         ]
+
+# Daily Department Statistics
+class DailyDepartmentStats(models.Model):
+    """
+    Rollup of waybill counts and freight per department per day, so that dashboards and reports read O(days) rows instead of scanning waybills.
+    Maintained incrementally by Waybill.save and WaybillRouting.save (callers using bulk_create must call record_waybills_created/record_routings themselves),
+    and can be rebuilt from history with the management command rebuild_daily_department_stats.
+    Freight is always the current freight of the waybills: editing the freight or the shipping department of a waybill
+    moves its counts (see record_waybill_changed), so the incremental rows are the same as the rebuilt ones.
+    - created: waybills created by the department (src_department), voided waybills are subtracted from their creation day
+    - departed: waybills departed from the department (Departed, GoodsYardDeparted)
+    - arrived: waybills arrived at their destination department (Arrived)
+    - goods_yard_arrived: waybills arrived at the goods yard (GoodsYardArrived), counted apart so that arrivals are not counted twice
+    - signed_for: waybills signed for at the department
+    """
+
+    department = models.ForeignKey(Department, verbose_name="Department", on_delete=models.CASCADE)
+    date = models.DateField("Date", db_index=True)
+    created_num = models.IntegerField("Created Waybills", default=0)
+    created_fee = models.IntegerField("Created Freight", default=0)
+    departed_num = models.IntegerField("Departed Waybills", default=0)
+    departed_fee = models.IntegerField("Departed Freight", default=0)
+    arrived_num = models.IntegerField("Arrived Waybills", default=0)
+    arrived_fee = models.IntegerField("Arrived Freight", default=0)
+    goods_yard_arrived_num = models.IntegerField("Goods Yard Arrived Waybills", default=0)
+    goods_yard_arrived_fee = models.IntegerField("Goods Yard Arrived Freight", default=0)
+    signed_for_num = models.IntegerField("Signed Waybills", default=0)
+    signed_for_fee = models.IntegerField("Signed Freight", default=0)
+
+    class Meta:
+        verbose_name = "Daily Department Statistics"
+        verbose_name_plural = verbose_name
+        constraints = [
+            models.UniqueConstraint(fields=["department", "date"], name="unique_daily_department_stats"),
+        ]
+
+    # WaybillRouting.operation_type -> statistics field prefix
+    ROUTING_TYPE_FIELDS = {
+        Waybill.Statuses.Departed: "departed",
+        Waybill.Statuses.GoodsYardDeparted: "departed",
+        Waybill.Statuses.GoodsYardArrived: "goods_yard_arrived",
+        Waybill.Statuses.Arrived: "arrived",
+        Waybill.Statuses.SignedFor: "signed_for",
+    }
+
+    @classmethod
+    def add_changes(cls, changes: dict):
+        """ Apply increments to the statistics
+        :param changes: {(department_id, date): {field_name: increment, ...}, ...}
+        """
+        with transaction.atomic():
+            for (department_id, date), fields in changes.items():
+                fields = {k: v for k, v in fields.items() if v}
+                if not fields:
+                    continue
+                queryset = cls.objects.filter(department_id=department_id, date=date)
+                if queryset.update(**{k: F(k) + v for k, v in fields.items()}):
+                    continue
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(department_id=department_id, date=date, **fields)
+                except IntegrityError:
+                    # Created by a concurrent transaction in the meantime
+                    queryset.update(**{k: F(k) + v for k, v in fields.items()})
+
+    @classmethod
+    def record_waybills_created(cls, waybills):
+        """ Count newly created waybills """
+        changes = defaultdict(lambda: defaultdict(int))
+        for wb in waybills:
+            dic = changes[(wb.src_department_id, timezone.localdate(wb.create_time))]
+            dic["created_num"] += 1
+            dic["created_fee"] += wb.fee
+        cls.add_changes(changes)
+
+    @classmethod
+    def record_waybill_changed(cls, old_values: dict, waybill):
+        """ Apply the difference of an edited waybill (freight, shipping department)
+        :param old_values: Values of the waybill before saving: {"fee", "src_department_id", "create_time", "status"}
+        :param waybill: The saved Waybill object
+        """
+        fee_change = waybill.fee - old_values["fee"]
+        if not fee_change and waybill.src_department_id == old_values["src_department_id"]:
+            return
+        changes = defaultdict(lambda: defaultdict(int))
+        # Voided waybills were already subtracted from their creation day
+        if old_values["status"] != Waybill.Statuses.Dropped:
+            create_date = timezone.localdate(old_values["create_time"])
+            dic = changes[(old_values["src_department_id"], create_date)]
+            dic["created_num"] -= 1
+            dic["created_fee"] -= old_values["fee"]
+            dic = changes[(waybill.src_department_id, create_date)]
+            dic["created_num"] += 1
+            dic["created_fee"] += waybill.fee
+        if fee_change:
+            for department_id, time_, operation_type in WaybillRouting.objects.filter(
+                    waybill_id=waybill.id, operation_type__in=cls.ROUTING_TYPE_FIELDS.keys(),
+            ).values_list("operation_dept_id", "time", "operation_type"):
+                changes[(department_id, timezone.localdate(time_))][cls.ROUTING_TYPE_FIELDS[operation_type] + "_fee"] += fee_change
+        cls.add_changes(changes)
+
+    @classmethod
+    def record_routings(cls, routings, waybills_info=None):
+        """ Count newly created waybill routings (only those types which are counted, see ROUTING_TYPE_FIELDS)
+        :param waybills_info: {waybill id: {"fee": ..., "create_time": ..., "src_department_id": ...}} of all waybills of the routings,
+            read from the database with one query if not given
+        """
+        routings = [
+            wr for wr in routings
+            if wr.operation_type in cls.ROUTING_TYPE_FIELDS or wr.operation_type == Waybill.Statuses.Dropped
+        ]
+        if not routings:
+            return
+        if waybills_info is None:
+            # Load the freight (and creation info for voided waybills) of all waybills in one query
+            waybills_info = {
+                wb_info["id"]: wb_info
+                for wb_info in Waybill.objects.filter(id__in={wr.waybill_id for wr in routings}).values(
+                    "id", "fee", "create_time", "src_department_id",
+                )
+            }
+        changes = defaultdict(lambda: defaultdict(int))
+        for wr in routings:
+            wb_info = waybills_info[wr.waybill_id]
+            if wr.operation_type == Waybill.Statuses.Dropped:
+                dic = changes[(wb_info["src_department_id"], timezone.localdate(wb_info["create_time"]))]
+                dic["created_num"] -= 1
+                dic["created_fee"] -= wb_info["fee"]
+            else:
+                field_prefix = cls.ROUTING_TYPE_FIELDS[wr.operation_type]
+                dic = changes[(wr.operation_dept_id, timezone.localdate(wr.time))]
+                dic[field_prefix + "_num"] += 1
+                dic[field_prefix + "_fee"] += wb_info["fee"]
+        cls.add_changes(changes)
+
+    def __str__(self):
+        return "%s (%s)" % (Department.get_name_by_id(self.department_id), self.date)
@@ -0,0 +1,81 @@
+""" Evict cached objects (see common.py and DepartmentRegistry) as soon as the rows they are built from change
+Evictions run when the transaction commits: evicting earlier would let a concurrent reader reload the old rows
+and publish them to the shared cache again, where they would stay until expiration.
+"""
+
+from functools import partial
+
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import User, Department, DepartmentRegistry, Settings, Permission, PermissionGroup
+from .common import _get_logged_user_by_id, _get_user_permissions, get_global_settings, get_permission_tree_list
+
+
+def _evict_users(user_ids):
+    for user_id in user_ids:
+        _get_logged_user_by_id.invalidate(user_id)
+        # Model instances are compared (and keyed in the shared cache) by primary key
+        _get_user_permissions.invalidate(User(pk=user_id))
+
+def _invalidate_users(user_ids):
+    """ Evict the cached user objects and permission sets of these users when the transaction commits
+    :param user_ids: Iterable of user ids, it is evaluated immediately (the rows may be gone when committing)
+    """
+    transaction.on_commit(partial(_evict_users, list(user_ids)))
+
+def _evict_permission_tree():
+    get_permission_tree_list.invalidate()
+    # The permission tree is also cached as a template fragment in the user permission pages
+    caches["shared"].delete(make_template_fragment_key("full_permission_tree"))
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def _user_changed(sender, instance, **kwargs):
+    _invalidate_users([instance.pk])
+
+@receiver(m2m_changed, sender=User.permission.through)
+def _user_permission_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # user.permission.add/remove/set/clear(...)
+        if action in ("post_add", "post_remove", "post_clear"):
+            _invalidate_users([instance.pk])
+        return
+    # permission.user_set.add/remove/set/clear(...)
+    if action == "pre_clear":
+        # pk_set is None when clearing, remember the affected users before they are gone
+        instance._cleared_user_ids = list(instance.user_set.values_list("id", flat=True))
+    elif action == "post_clear":
+        _invalidate_users(getattr(instance, "_cleared_user_ids", []))
+    elif action in ("post_add", "post_remove"):
+        _invalidate_users(pk_set)
+
+@receiver(post_save, sender=Permission)
+@receiver(pre_delete, sender=Permission)
+def _permission_changed(sender, instance, **kwargs):
+    # Permission sets contain permission names, so renaming or deleting a permission affects all its users.
+    # Deleting a permission removes the m2m rows without sending m2m_changed, hence pre_delete.
+    _invalidate_users(instance.user_set.values_list("id", flat=True))
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=PermissionGroup)
+@receiver(post_delete, sender=PermissionGroup)
+def _permission_tree_changed(sender, instance, **kwargs):
+    transaction.on_commit(_evict_permission_tree)
+
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+def _department_changed(sender, instance, **kwargs):
+    # StandardFeeCalculator is built from the registry, it is rebuilt with it
+    transaction.on_commit(DepartmentRegistry.invalidate)
+    # Cached user objects carry their department (and the user type derived from it)
+    _invalidate_users(User.objects.filter(department_id=instance.pk).values_list("id", flat=True))
+
+@receiver(post_save, sender=Settings)
+@receiver(post_delete, sender=Settings)
+def _settings_changed(sender, instance, **kwargs):
+    transaction.on_commit(get_global_settings.invalidate)
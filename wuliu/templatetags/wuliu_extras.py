@@ -105,21 +105,39 @@ def show_form_input_field_with_append_select(field, field_append, label="", div_
         "div_class": div_class
     }
 
-@register.inclusion_tag('wuliu/_inclusions/_waybill_routing_operation_info.html')
+@register.simple_tag()
 def show_waybill_routing_operation_info(wr: WaybillRouting):
     """ Generate detailed text content for waybill routing
+    Loads the referenced objects of this routing only, use waybill_routings_with_operation_info to render a list.
     :param wr: WaybillRouting object
     """
-    return wr._template_context()
+    return wr.gen_print_operation_info()
+
+@register.simple_tag()
+def waybill_routings_with_operation_info(routings) -> list:
+    """ Pair every waybill routing with its detailed text, the objects referenced by all routings are loaded in batch
+    (see WaybillRouting.prefetch_operation_info_objects), so the number of queries does not depend on the number of rows
+    Example:
+    {% waybill_routings_with_operation_info wb_routing as routing_rows %}
+    {% for rt, operation_info in routing_rows %}
+      {{ rt.operation_dept.name }} {{ operation_info }}
+    {% endfor %}
+    :param routings: WaybillRouting QuerySet or list
+    """
+    return [(wr, wr.gen_print_operation_info()) for wr in WaybillRouting.prefetch_operation_info_objects(routings)]
 
 @register.inclusion_tag('wuliu/_inclusions/_tables/_waybill_table.html')
-def show_waybill_table(waybills_info_list, table_id, have_check_box=True, high_light_fee=False, high_light_dept_id=-1):
+def show_waybill_table(waybills_info_list, table_id, have_check_box=True, high_light_fee=False, high_light_dept_id=-1,
+                       datatable_url="", datatable_form_selector="#form-search_waybill"):
     """ Waybill table
     :param waybills_info_list: Table containing all waybill info dictionaries
     :param table_id: DataTables object id
     :param have_check_box: If False, do not show checkbox
     :param high_light_fee: Highlight the receivable fee cell (used only in department payment list)
     :param high_light_dept_id: Highlight department cell id (used only in department payment list)
+    :param datatable_url: If not empty, waybills_info_list is ignored and the rows are loaded page by page from this url
+                          (see WaybillSearchView.datatable_response)
+    :param datatable_form_selector: CSS selector of the search form submitted together with the DataTables request
     """
     return {
         "waybills_info_list": waybills_info_list,
@@ -127,6 +145,10 @@ def show_waybill_table(waybills_info_list, table_id, have_check_box=True, high_l
         "have_check_box": have_check_box,
         "high_light_fee": high_light_fee,
         "high_light_dept_id": high_light_dept_id,
+        "datatable_url": datatable_url,
+        "datatable_form_selector": datatable_form_selector,
+        # Server-side tables are ordered by create time by default (keyset pagination), others by waybill number
+        "default_order_column": (4 if have_check_box else 3) if datatable_url else 2,
     }
 
 @register.inclusion_tag('wuliu/_inclusions/_tables/_waybill_table_row.html')
@@ -153,6 +175,13 @@ def show_dst_stock_waybill_table(waybills_info_list, table_id):
 
 @register.inclusion_tag('wuliu/_inclusions/_tables/_transport_out_table.html')
 def show_transport_out_table(transport_out_list, table_id):
+    """ Trip table
+    :param transport_out_list: Trips, a queryset gets the waybill statistics of all trips annotated in the same query
+                               (see TransportOut.objects.with_waybills_info), instead of one query per row
+    :param table_id: DataTables object id
+    """
+    if hasattr(transport_out_list, "with_waybills_info") and "total_num" not in transport_out_list.query.annotations:
+        transport_out_list = transport_out_list.with_waybills_info().select_related("src_department", "dst_department", "truck")
     return {
         "transport_out_list": transport_out_list,
         "table_id": table_id,
@@ -160,6 +189,13 @@ def show_transport_out_table(transport_out_list, table_id):
 
 @register.inclusion_tag('wuliu/_inclusions/_tables/_department_payment_table.html')
 def show_department_payment_table(department_payment_list, table_id):
+    """ Department payment table
+    :param department_payment_list: Payments, a queryset gets the payable amounts of all payments annotated in the same query
+                                    (see DepartmentPayment.objects.with_total_fee), instead of one query per row
+    :param table_id: DataTables object id
+    """
+    if hasattr(department_payment_list, "with_total_fee") and "total_fee_now" not in department_payment_list.query.annotations:
+        department_payment_list = department_payment_list.with_total_fee().select_related("src_department", "dst_department")
     return {
         "department_payment_list": department_payment_list,
         "table_id": table_id,
@@ -167,6 +203,13 @@ def show_department_payment_table(department_payment_list, table_id):
 
 @register.inclusion_tag('wuliu/_inclusions/_tables/_cargo_price_payment_table.html')
 def show_cargo_price_payment_table(cargo_price_payment_list, table_id):
+    """ Cargo price payment table
+    :param cargo_price_payment_list: Payments, a queryset gets the payable amounts of all payments annotated in the same query
+                                     (see CargoPricePayment.objects.with_total_fee), instead of one query per row
+    :param table_id: DataTables object id
+    """
+    if hasattr(cargo_price_payment_list, "with_total_fee") and "total_cargo_price" not in cargo_price_payment_list.query.annotations:
+        cargo_price_payment_list = cargo_price_payment_list.with_total_fee().select_related("create_user")
     return {
         "cargo_price_payment_list": cargo_price_payment_list,
         "table_id": table_id,
@@ -179,6 +222,14 @@ def show_customer_score_log_table(customer_score_logs, table_id):
         "table_id": table_id,
     }
 
+@register.inclusion_tag('wuliu/_inclusions/_stats_summary.html')
+def show_stats_summary(stats_summary, title):
+    """ Totals of the searched days from the DailyDepartmentStats rollup (see WaybillSearchView.gen_stats_summary)
+    :param stats_summary: Dictionary from WaybillSearchView.gen_stats_summary, nothing is shown if it is None
+    :param title: Name of the totals, e.g. "开票"
+    """
+    return {"stats_summary": stats_summary, "title": title}
+
 @register.inclusion_tag('wuliu/_inclusions/_sign_for_waybill_info.html')
 def show_sign_for_waybill_info(waybill_info_dic):
     return {"waybill": waybill_info_dic}
@@ -191,11 +242,12 @@ def _show_permission_tree(list_):
 @register.inclusion_tag('wuliu/_inclusions/_full_permission_tree.html')
 def show_full_permission_tree(div_id):
     """ Complete permission tree (with js) """
-    return {"div_id": div_id, "list": PERMISSION_TREE_LIST}
+    return {"div_id": div_id, "list": get_permission_tree_list()}
 
 @register.inclusion_tag('wuliu/_inclusions/_js/_export_table_to_excel.js.html')
 def js_export_table_to_excel(table_id, button_css_selector, skip_td_num=1,
-                             table_title="", table_title_is_js=False, min_time_interval=60):
+                             table_title="", table_title_is_js=False, min_time_interval=60,
+                             ajax_url="", ajax_form_selector=""):
     """ JS implementation code for export (excel table) function, already wrapped by <script> tag, do not add again
     :param table_id: DataTables object id
     :param button_css_selector: CSS selector for the export button (must escape single quotes)
@@ -204,6 +256,9 @@ def js_export_table_to_excel(table_id, button_css_selector, skip_td_num=1,
                         when table_title_is_js is False, it's best not to have special symbols (single/double quotes will be automatically removed)
     :param table_title_is_js: Whether the table_title parameter is a js expression, default is False
     :param min_time_interval: Minimum export time interval, default is 60 seconds
+    :param ajax_url: If not empty (server-side table, see js_init_datatable), the search form and the search box are
+                     submitted to this url, which exports all the rows (see WaybillSearchView.export_response)
+    :param ajax_form_selector: CSS selector of the search form of the server-side table
     """
     if table_title and not table_title_is_js:
         table_title = '"%s"' % table_title.replace('\"', "").replace("\'", "")
@@ -213,18 +268,28 @@ def js_export_table_to_excel(table_id, button_css_selector, skip_td_num=1,
         "skip_td_num": skip_td_num,
         "table_title": table_title,
         "min_time_interval": min_time_interval,
+        "ajax_url": ajax_url,
+        "ajax_form_selector": ajax_form_selector,
     }
 
 @register.inclusion_tag('wuliu/_inclusions/_js/_init_datatable.js.html')
-def js_init_datatable(table_id, have_check_box=True, custom_fixed_columns_left=None):
+def js_init_datatable(table_id, have_check_box=True, custom_fixed_columns_left=None,
+                      ajax_url="", ajax_form_selector="", default_order_column=2):
     """ JS implementation code for initializing DataTable (init, select all, add serial number), already wrapped by <script> tag, do not add again
     :param table_id: id attribute of DataTables object
     :param have_check_box: Whether the second column of the table has a checkbox, default is True
     :param custom_fixed_columns_left: Custom number of columns fixed on the left side of the table,
                                       if None, freeze two columns (if have_check_box is True, also fix the second column's checkbox)
+    :param ajax_url: If not empty, use server-side processing with this url,
+                     the js object {table_id}_server_side (columns, createdRow...) must be defined before
+    :param ajax_form_selector: CSS selector of the form whose fields are submitted together with the server-side request
+    :param default_order_column: Index of the column ordered by default
     """
     return {
         "table_id": table_id,
         "have_check_box": have_check_box,
-        "custom_fixed_columns_left": custom_fixed_columns_left
+        "custom_fixed_columns_left": custom_fixed_columns_left,
+        "ajax_url": ajax_url,
+        "ajax_form_selector": ajax_form_selector,
+        "default_order_column": default_order_column,
     }
@@ -1,3 +1,362 @@
+import datetime
+import io
+from pathlib import Path
+from unittest import mock
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .models import (
+    User, Department, DepartmentRegistry, StandardFeeCalculator, Settings, Waybill, WaybillRouting, WaybillStateMachine,
+    DailyDepartmentStats, DepartmentPayment, CargoPricePayment, TransportOut,
+)
+
+INIT_DATA_FIXTURE = Path(__file__).resolve().parent.parent / "init_data.json"
+from .common import _get_logged_user_by_id, get_global_settings, waybill_to_dict, waybills_to_dicts
+from .waybill_import import WaybillImporter
+
+
+class CacheInvalidationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.department = Department.objects.create(name="Company", unit_price=0)
+        User.objects.create(name="admin", password="x", administrator=True, department=cls.department)
+        cls.user = User.objects.create(name="user", password="x", department=cls.department)
+        Settings.objects.create(company_name="Company", handling_fee_ratio=0.002, customer_score_ratio=1)
+
+    def setUp(self):
+        caches["shared"].clear()
+        _get_logged_user_by_id.cache_clear()
+        get_global_settings.cache_clear()
+
+    def test_user_evicted_on_commit(self):
+        self.assertEqual(_get_logged_user_by_id(self.user.id).name, "user")
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.filter(id=self.user.id).update(name="renamed")
+            User.objects.get(id=self.user.id).save()
+            # Not committed yet, other connections would still read the old row, so the cached object is kept
+            self.assertEqual(_get_logged_user_by_id(self.user.id).name, "user")
+        self.assertEqual(_get_logged_user_by_id(self.user.id).name, "renamed")
+
+    def test_nothing_evicted_on_rollback(self):
+        _get_logged_user_by_id(self.user.id)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.user.save()
+        # The callbacks are dropped when the transaction is rolled back
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(_get_logged_user_by_id.cache_info().currsize, 1)
+
+    def test_settings_evicted_on_commit(self):
+        self.assertEqual(get_global_settings().company_name, "Company")
+        with self.captureOnCommitCallbacks(execute=True):
+            settings_ = Settings.objects.get()
+            settings_.company_name = "Renamed"
+            settings_.save()
+            self.assertEqual(get_global_settings().company_name, "Company")
+        self.assertEqual(get_global_settings().company_name, "Renamed")
+
+    def test_department_registry_reloaded_on_miss(self):
+        DepartmentRegistry.current.cache_clear()
+        registry = DepartmentRegistry.current()
+        # Created without running the on_commit eviction, like a department created by another process
+        department = Department.objects.create(name="New", unit_price=0, father_department=self.department)
+        self.assertNotIn(department.id, registry.departments)
+        self.assertEqual(registry.get(department.id).name, "New")
+        self.assertIn(department.id, DepartmentRegistry.current().get(self.department.id).children)
+        with self.assertRaises(Department.DoesNotExist):
+            registry.get(department.id + 1)
+
+
+class StandardFeeCalculatorTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        root = Department.objects.create(name="Company", unit_price=0)
+        group = Department.objects.create(name="Branches", unit_price=0, father_department=root, is_branch_group=True)
+        cls.src = Department.objects.create(
+            name="A", unit_price=1, father_department=group, enable_src=True, enable_dst=True,
+        )
+        cls.dst = Department.objects.create(
+            name="B", unit_price=2, father_department=group, enable_src=True, enable_dst=True,
+        )
+
+    def setUp(self):
+        caches["shared"].clear()
+        DepartmentRegistry.current.cache_clear()
+
+    def test_follows_registry(self):
+        self.assertEqual(StandardFeeCalculator.current().fee(self.src.id, self.dst.id, 10, 2), 15)
+        self.assertIs(StandardFeeCalculator.current(), StandardFeeCalculator.current())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dst.unit_price = 4
+            self.dst.save()
+        # Rebuilt from the reloaded registry, no separately cached calculator keeps the old prices
+        self.assertEqual(StandardFeeCalculator.current().fee(self.src.id, self.dst.id, 10, 2), 25)
+        with self.assertRaises(ValueError):
+            StandardFeeCalculator.current().fee(self.src.id, self.src.id, 10, 2)
+
+
+class DailyDepartmentStatsTests(TestCase):
+
+    fixtures = [INIT_DATA_FIXTURE]
+
+    def setUp(self):
+        caches["shared"].clear()
+        DepartmentRegistry.current.cache_clear()
+
+    @staticmethod
+    def _day_range(date):
+        start = timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+        return start, start + datetime.timedelta(days=1)
+
+    def test_rollup_matches_waybills(self):
+        """ The rolled up numbers are the same as counting the waybills by their time fields (as the dashboard used to) """
+        call_command("rebuild_daily_department_stats", stdout=io.StringIO())
+        for time_field, stats_field, department_field in (
+                ("arrival_time", "arrived_num", "dst_department_id"),
+                ("sign_for_time", "signed_for_num", "dst_department_id"),
+                ("create_time", "created_num", "src_department_id")):
+            waybills = Waybill.objects.exclude(**{time_field: None})
+            if time_field == "create_time":
+                waybills = waybills.exclude(status=Waybill.Statuses.Dropped)
+            dates = {timezone.localdate(value) for value in waybills.values_list(time_field, flat=True)}
+            self.assertTrue(dates)
+            for date in dates:
+                start, end = self._day_range(date)
+                day_waybills = waybills.filter(**{time_field + "__gte": start, time_field + "__lt": end})
+                stats = DailyDepartmentStats.objects.filter(date=date)
+                with self.subTest(field=stats_field, date=date):
+                    self.assertEqual(
+                        stats.aggregate(num=Sum(stats_field))["num"] or 0, day_waybills.count(),
+                    )
+                    for department_id in set(day_waybills.values_list(department_field, flat=True)):
+                        self.assertEqual(
+                            getattr(stats.filter(department_id=department_id).first(), stats_field, 0),
+                            day_waybills.filter(**{department_field: department_id}).count(),
+                        )
+
+    def test_rebuild_date_range(self):
+        """ Rebuilding some days gives the same rows as a full rebuild, the other days are kept """
+        call_command("rebuild_daily_department_stats", stdout=io.StringIO())
+        rows = set(DailyDepartmentStats.objects.values_list(
+            "department_id", "date", "created_num", "departed_num", "arrived_num", "goods_yard_arrived_num", "signed_for_num",
+        ))
+        DailyDepartmentStats.objects.filter(date__gte=datetime.date(2021, 7, 1)).update(created_num=-1)
+        call_command(
+            "rebuild_daily_department_stats", start_date=datetime.date(2021, 7, 1), end_date=datetime.date(2021, 12, 31),
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(set(DailyDepartmentStats.objects.values_list(
+            "department_id", "date", "created_num", "departed_num", "arrived_num", "goods_yard_arrived_num", "signed_for_num",
+        )), rows)
+
+    def _stats_rows(self):
+        return set(DailyDepartmentStats.objects.values_list(
+            "department_id", "date", "created_num", "created_fee", "departed_num", "departed_fee",
+            "arrived_num", "arrived_fee", "goods_yard_arrived_num", "goods_yard_arrived_fee",
+            "signed_for_num", "signed_for_fee",
+        ).exclude(
+            created_num=0, departed_num=0, arrived_num=0, goods_yard_arrived_num=0, signed_for_num=0,
+        ))
+
+    def test_edited_waybills_match_rebuild(self):
+        """ Editing the freight or the shipping department keeps the rollup the same as a rebuild """
+        call_command("rebuild_daily_department_stats", stdout=io.StringIO())
+        routed_waybill = Waybill.objects.filter(
+            status=Waybill.Statuses.SignedFor, return_waybill__isnull=True, fee_type=Waybill.FeeTypes.Now,
+        ).order_by("id").first()
+        routed_waybill.fee += 7
+        routed_waybill.save()
+        moved_waybill = Waybill.objects.filter(status=Waybill.Statuses.Created).order_by("id").first()
+        with self.captureOnCommitCallbacks(execute=True):
+            moved_waybill.src_department = Department.objects.create(
+                name="Branch", unit_price=1, father_department=Department.objects.get(name="分公司"),
+                enable_src=True, enable_dst=True,
+            )
+        moved_waybill.fee += 3
+        moved_waybill.save()
+        incremental = self._stats_rows()
+        call_command("rebuild_daily_department_stats", stdout=io.StringIO())
+        self.assertEqual(incremental, self._stats_rows())
+
+
+class WaybillStateMachineTests(TestCase):
+
+    fixtures = [INIT_DATA_FIXTURE]
+
+    def setUp(self):
+        caches["shared"].clear()
+        DepartmentRegistry.current.cache_clear()
+        self.user = User.objects.order_by("id").first()
+        self.state_machine = WaybillStateMachine(self.user.id, self.user.department_id)
+
+    def test_goods_yard_arrival_only_from_departed(self):
+        waybill_id = Waybill.objects.order_by("id").values_list("id", flat=True).first()
+        changes = {Waybill.Statuses.GoodsYardArrived: [waybill_id]}
+        Waybill.objects.filter(id=waybill_id).update(status=Waybill.Statuses.GoodsYardLoaded)
+        with self.assertRaises(WaybillStateMachine.TransitionError) as cm:
+            WaybillStateMachine.check(changes)
+        self.assertEqual(cm.exception.waybill_ids, [waybill_id])
+        Waybill.objects.filter(id=waybill_id).update(status=Waybill.Statuses.Departed)
+        WaybillStateMachine.check(changes)
+
+    def test_apply_fails_on_concurrent_change(self):
+        """ A waybill changed between the check and apply makes apply fail, nothing is written """
+        waybill_ids = list(Waybill.objects.filter(status=Waybill.Statuses.Arrived).values_list("id", flat=True)[:2])
+        self.assertEqual(len(waybill_ids), 2)
+        changes = {Waybill.Statuses.SignedFor: waybill_ids}
+        WaybillStateMachine.check(changes)
+        Waybill.objects.filter(id=waybill_ids[0]).update(status=Waybill.Statuses.Returned)
+        routing_num = WaybillRouting.objects.count()
+        with self.assertRaises(WaybillStateMachine.TransitionError):
+            self.state_machine.apply(changes)
+        self.assertEqual(Waybill.objects.get(id=waybill_ids[1]).status, Waybill.Statuses.Arrived)
+        self.assertEqual(WaybillRouting.objects.count(), routing_num)
+
+    def test_apply_reuses_waybills_info(self):
+        """ With the rows read by the caller, the waybills are not selected again to count the routings """
+        waybills_info = {
+            wb_info["id"]: wb_info
+            for wb_info in Waybill.objects.filter(status=Waybill.Statuses.Arrived).values(
+                "id", "fee", "create_time", "src_department_id",
+            )[:3]
+        }
+        waybill_table = connection.ops.quote_name(Waybill._meta.db_table)
+        with CaptureQueriesContext(connection) as queries:
+            routings = self.state_machine.apply(
+                {Waybill.Statuses.SignedFor: waybills_info.keys()}, waybills_info=waybills_info,
+            )
+        self.assertEqual(len(routings), 3)
+        self.assertFalse([
+            query["sql"] for query in queries.captured_queries
+            if query["sql"].startswith("SELECT") and "FROM %s" % waybill_table in query["sql"]
+        ])
+        stats = DailyDepartmentStats.objects.get(department_id=self.user.department_id, date=timezone.localdate())
+        self.assertEqual(stats.signed_for_num, 3)
+        self.assertEqual(stats.signed_for_fee, sum(wb_info["fee"] for wb_info in waybills_info.values()))
+
+
+class DepartmentPaymentTests(TestCase):
+
+    fixtures = [INIT_DATA_FIXTURE]
+
+    def test_bulk_gen_matches_set_waybills_auto(self):
+        start_date, end_date = datetime.date(2021, 5, 1), datetime.date(2021, 12, 31)
+        # The fixture has no payments to this department, so nothing is skipped
+        dst_department = Department.objects.get(name="总部")
+        src_departments = list(Department.queryset_is_branch())
+        dp_list = DepartmentPayment.bulk_gen(dst_department, start_date, end_date, src_departments)
+        created = {(dp.src_department_id, dp.payment_date): set(dp.waybills.values_list("id", flat=True)) for dp in dp_list}
+        expected = {}
+        date = start_date
+        while date <= end_date:
+            for src_department in src_departments:
+                waybill_ids = DepartmentPayment.static_gen_waybills(src_department, date)
+                if waybill_ids:
+                    expected[(src_department.id, date)] = waybill_ids
+            date += datetime.timedelta(days=1)
+        self.assertTrue(expected)
+        self.assertEqual(created, expected)
+
+    def test_with_total_fee(self):
+        """ The annotated amounts are the same as computing them payment by payment """
+        for model in (DepartmentPayment, CargoPricePayment):
+            payments = list(model.objects.order_by("id"))
+            self.assertTrue(payments)
+            with self.assertNumQueries(1):
+                annotated = [payment.gen_total_fee() for payment in model.objects.with_total_fee().order_by("id")]
+            with self.subTest(model=model.__name__):
+                self.assertEqual(annotated, [payment.gen_total_fee() for payment in payments])
+
+
+class TransportOutTests(TestCase):
+
+    fixtures = [INIT_DATA_FIXTURE]
+
+    def test_with_waybills_info(self):
+        """ The annotated statistics are the same as computing them trip by trip """
+        transport_outs = list(TransportOut.objects.order_by("id"))
+        self.assertTrue(transport_outs)
+        with self.assertNumQueries(1):
+            annotated = [to.gen_waybills_info() for to in TransportOut.objects.with_waybills_info().order_by("id")]
+        self.assertEqual(annotated, [to.gen_waybills_info() for to in transport_outs])
+
+
+class WaybillSerializationTests(TestCase):
+
+    fixtures = [INIT_DATA_FIXTURE]
+
+    def setUp(self):
+        caches["shared"].clear()
+        DepartmentRegistry.current.cache_clear()
+
+    def test_waybills_to_dicts(self):
+        """ The same dictionaries as converting the waybills one by one, with the return waybills loaded in one query """
+        waybills = Waybill.objects.order_by("id")
+        self.assertTrue(waybills.filter(return_waybill__isnull=False).exists())
+        expected = [waybill_to_dict(wb) for wb in waybills]
+        with self.assertNumQueries(2):
+            self.assertEqual(waybills_to_dicts(waybills), expected)
+
+    def test_waybills_to_dicts_fields(self):
+        """ Only the given fields are read, in one query, and the return waybills are left as ids """
+        fields = ("id", "return_waybill", "src_department", "dst_department", "status", "fee_type", "fee")
+        waybills = Waybill.objects.order_by("id")
+        expected = waybills_to_dicts(waybills)
+        with self.assertNumQueries(1):
+            waybill_dics = waybills_to_dicts(waybills, fields)
+        self.assertEqual(len(waybill_dics), len(expected))
+        for waybill_dic, expected_dic in zip(waybill_dics, expected):
+            self.assertNotIn("cargo_name", waybill_dic)
+            return_waybill = expected_dic.pop("return_waybill")
+            self.assertEqual(waybill_dic.pop("return_waybill"), return_waybill and return_waybill["id"])
+            self.assertEqual(waybill_dic, {key: expected_dic[key] for key in waybill_dic})
+
+
+class WaybillImportTests(TestCase):
+
+    fixtures = [INIT_DATA_FIXTURE]
+
+    HEADER = ["dst_department", "src_customer_name", "src_customer_phone", "dst_customer_name", "dst_customer_phone",
+              "cargo_name", "cargo_num", "cargo_volume", "cargo_weight", "fee", "fee_type"]
+
+    def setUp(self):
+        caches["shared"].clear()
+        DepartmentRegistry.current.cache_clear()
+        get_global_settings.cache_clear()
+        self.src_department = Department.objects.get(name="测试分公司")
+        self.user = User.objects.create(name="importer", password="x", department=self.src_department)
+
+    def _rows(self, num):
+        rows = [(1, self.HEADER)]
+        for i in range(num):
+            # The same receiver phone every second row, so the waybills are not told apart by the phone alone
+            rows.append((i + 2, ["测试收货点", "sender", "1380000%04d" % i, "receiver", "1390000%04d" % (i % 2),
+                                 "cargo %d" % i, 1, 1.5, 2, 10 + i, "Pay Now"]))
+        return rows
 
-# Create your tests here.
+    def test_import_without_returning_ids(self):
+        """ On backends which do not return the ids of bulk inserted rows (MySQL), the ids are read back with one query """
+        with mock.patch.object(type(connection.features), "can_return_rows_from_bulk_insert", False):
+            with CaptureQueriesContext(connection) as queries:
+                result = WaybillImporter(self.user, src_department_id=self.src_department.id).import_rows(self._rows(5))
+        self.assertEqual(result["errors"], [])
+        self.assertEqual(len(result["waybill_ids"]), 5)
+        waybill_table = connection.ops.quote_name(Waybill._meta.db_table)
+        self.assertEqual(len([
+            query for query in queries.captured_queries if query["sql"].startswith("INSERT INTO %s" % waybill_table)
+        ]), 1)
+        self.assertEqual(
+            list(Waybill.objects.filter(id__in=result["waybill_ids"]).order_by("id").values_list("cargo_name", "fee")),
+            [("cargo %d" % i, 10 + i) for i in range(5)],
+        )
+        routings = WaybillRouting.objects.filter(waybill_id__in=result["waybill_ids"], operation_type=Waybill.Statuses.Created)
+        self.assertEqual(set(routings.values_list("waybill_id", flat=True)), set(result["waybill_ids"]))
+        stats = DailyDepartmentStats.objects.get(department=self.src_department, date=timezone.localdate())
+        self.assertEqual((stats.created_num, stats.created_fee), (5, sum(10 + i for i in range(5))))
@@ -22,10 +22,12 @@ urlpatterns = [
         path("add_user", views.add_user, name="add_user"),
         path("manage_user_permission", views.manage_user_permission, name="manage_user_permission"),
         path("batch_edit_user_permission", views.batch_edit_user_permission, name="batch_edit_user_permission"),
+        path("request_metrics", views.request_metrics, name="request_metrics"),
     ])),
     # Waybill Management
     path("waybill/", include([
         path("add", views.add_waybill, name="add_waybill"),
+        path("import", views.import_waybills, name="import_waybills"),
         path("edit", views.edit_waybill, name="edit_waybill"),
         path("edit.js", views.edit_waybill_js, name="edit_waybill_js"),
         path("manage", views.ManageWaybill.as_view(), name="manage_waybill"),
@@ -117,6 +119,8 @@ urlpatterns = [
                  name="api_modify_remark_department_payment"),
             path("drop", apis.DropDepartmentPayment.as_view(),
                  name="api_drop_department_payment"),
+            path("batch_add", apis.BatchAddDepartmentPayment.as_view(),
+                 name="api_batch_add_department_payment"),
             path("review", apis.ConfirmReviewDepartmentPayment.as_view(),
                  name="api_review_department_payment"),
             path("pay", apis.ConfirmPayDepartmentPayment.as_view(),
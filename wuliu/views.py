@@ -4,16 +4,21 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.conf import settings
 from django.contrib import messages
 from django.utils import timezone
-from django.http import HttpResponseForbidden, HttpResponseBadRequest
+from django.http import HttpResponseForbidden, HttpResponseBadRequest, JsonResponse, FileResponse
 from django.contrib.auth.hashers import check_password
-from django.contrib.auth.decorators import login_required
-from django.db.models import Count, Sum
+from django.db.models import Sum, Q
 import datetime
 from . import forms
+from utils.common import ExpireLruCache, UnescapedDjangoJSONEncoder, ModelDictSerializer
+from utils.export_excel import gen_workbook
+from utils.import_table import iter_table_rows
+from utils.middleware import get_request_metrics_summary
 import sys
 import os
+from wuliu.common import get_logged_user, login_required, check_permission, check_administrator, waybills_to_dicts
 from wuliu.common import get_logged_user_type, is_logged_user_has_perm  # Ensure 'wuliu/utils.py' exists and contains these functions
-from .models import Waybill, TransportOut, User  # Add this import for Waybill, TransportOut, and User models
+from .waybill_import import WaybillImporter
+from .models import Waybill, TransportOut, User, DailyDepartmentStats  # Add this import for Waybill, TransportOut, and User models
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils import get_logged_user_type, is_logged_user_has_perm  # Adjusted import for utils outside the app directory
 
@@ -25,6 +30,68 @@ class WaybillSearchView(View):
     template_name = ""
     need_login = True
     need_permissions = ()
+    # If True, the page is rendered without search results and DataTables loads them page by page
+    # from the same url (see datatable_response), instead of rendering all the rows into the page
+    server_side = False
+    # If not None, the totals of the searched days are read from the DailyDepartmentStats rollup (see gen_stats_summary):
+    # (statistics field prefix, date field of the form without "_start"/"_end", department field of the form)
+    stats_summary = None
+
+    # DataTables column name: fields to order by
+    # Ordering by create_time (the default) or waybill number uses keyset pagination on (create_time, id)
+    DATATABLE_ORDER_FIELDS = {
+        "id_": ("create_time", "id"),
+        "status": ("status", "id"),
+        "create_time": ("create_time", "id"),
+        "arrival_time": ("arrival_time", "id"),
+        "sign_for_time": ("sign_for_time", "id"),
+        "src_department": ("src_department_id", "id"),
+        "dst_department": ("dst_department_id", "id"),
+        "src_customer_name": ("src_customer_name", "id"),
+        "src_customer_phone": ("src_customer_phone", "id"),
+        "dst_customer_name": ("dst_customer_name", "id"),
+        "dst_customer_phone": ("dst_customer_phone", "id"),
+        "cargo_name": ("cargo_name", "id"),
+        "cargo_num": ("cargo_num", "id"),
+        "cargo_volume": ("cargo_volume", "id"),
+        "cargo_weight": ("cargo_weight", "id"),
+        "cargo_price": ("cargo_price", "id"),
+        "cargo_price_status": ("cargo_price_status", "id"),
+        "fee": ("fee", "id"),
+        "fee_type": ("fee_type", "id"),
+    }
+    DATATABLE_KEYSET_COLUMNS = ("id_", "create_time")
+    DATATABLE_MAX_LENGTH = 100
+    # Only the columns shown in the waybill table are read (see waybills_to_dicts)
+    DATATABLE_FIELDS = (
+        "id", "return_waybill", "status", "create_time", "arrival_time", "sign_for_time",
+        "src_department", "dst_department",
+        "src_customer_name", "src_customer_phone", "dst_customer_name", "dst_customer_phone",
+        "cargo_name", "cargo_num", "cargo_volume", "cargo_weight", "cargo_price", "cargo_price_status",
+        "fee", "fee_type",
+    )
+    # (row key, header, value type) of the exported columns, the same as the waybill table without "#" and the checkbox
+    DATATABLE_EXPORT_COLUMNS = (
+        ("id_", "运单号码", "str"),
+        ("status", "运单状态", "str"),
+        ("create_time", "开票日期", "str"),
+        ("arrival_time", "到货日期", "str"),
+        ("sign_for_time", "提货日期", "str"),
+        ("src_department", "发货部门", "str"),
+        ("dst_department", "到达部门", "str"),
+        ("src_customer_name", "发货人", "str"),
+        ("src_customer_phone", "发货人电话", "str"),
+        ("dst_customer_name", "收货人", "str"),
+        ("dst_customer_phone", "收货人电话", "str"),
+        ("cargo_name", "货物名称", "str"),
+        ("cargo_num", "件数", "int"),
+        ("cargo_volume", "体积", "float"),
+        ("cargo_weight", "重量", "float"),
+        ("cargo_price", "代收货款", "int"),
+        ("cargo_price_status", "代收货款状态", "str"),
+        ("fee", "运费", "int"),
+        ("fee_type", "结算方式", "str"),
+    )
 
     def __init__(self, *args, **kwargs):
         assert getattr(self, "template_name"), (
@@ -46,23 +113,194 @@ class WaybillSearchView(View):
 
     def post(self, request, *args, **kwargs):
         form = self.form_class.init_from_request(request, data=request.POST)
+        if request.POST.get("datatable"):
+            return self.datatable_response(request, form)
+        if request.POST.get("export") and self.server_side:
+            return self.export_response(request, form)
         waybill_list = []
+        stats_summary = None
         if form.is_valid():
-            try:
-                waybill_list = form.gen_waybill_list_to_queryset()
-            except:
-                if settings.DEBUG:
-                    raise
+            if self.stats_summary is not None:
+                stats_summary = self.gen_stats_summary(form)
+            if not self.server_side:
+                try:
+                    waybill_list = form.gen_waybill_list_to_queryset()
+                except:
+                    if settings.DEBUG:
+                        raise
         return render(
             request,
             self.template_name,
             {
                 "form": form,
                 "waybill_list": waybill_list,
+                "stats_summary": stats_summary,
+                "datatable_url": request.path if self.server_side else "",
                 "logged_user_type": get_logged_user_type(request),
             }
         )
 
+    @staticmethod
+    def _datatable_row(waybill_dic: dict) -> dict:
+        """ Convert a waybill dictionary (see waybills_to_dicts) to a row of the server-side DataTables response """
+        def _format_time(time_):
+            return timezone.make_naive(time_).strftime("%Y-%m-%d %H:%M:%S") if time_ else ""
+        return {
+            "id": waybill_dic["id"],
+            "id_": waybill_dic["id_"],
+            "status_id": waybill_dic["status_id"],
+            "status": waybill_dic["status"],
+            "create_time": _format_time(waybill_dic["create_time"]),
+            "arrival_time": _format_time(waybill_dic["arrival_time"]),
+            "sign_for_time": _format_time(waybill_dic["sign_for_time"]),
+            "src_department_id": waybill_dic["src_department"],
+            "src_department": waybill_dic["src_department_name"],
+            "dst_department_id": waybill_dic["dst_department"],
+            "dst_department": waybill_dic["dst_department_name"],
+            "src_customer_name": waybill_dic["src_customer_name"],
+            "src_customer_phone": waybill_dic["src_customer_phone"],
+            "dst_customer_name": waybill_dic["dst_customer_name"],
+            "dst_customer_phone": waybill_dic["dst_customer_phone"],
+            "cargo_name": waybill_dic["cargo_name"],
+            "cargo_num": waybill_dic["cargo_num"],
+            "cargo_volume": "%.2f" % waybill_dic["cargo_volume"],
+            "cargo_weight": "%g" % waybill_dic["cargo_weight"],
+            "cargo_price": waybill_dic["cargo_price"],
+            "cargo_price_status_id": waybill_dic["cargo_price_status"],
+            "cargo_price_status": ModelDictSerializer.of(Waybill).choice_label(
+                "cargo_price_status", waybill_dic["cargo_price_status"]
+            ),
+            "fee": waybill_dic["fee"],
+            "fee_type_id": waybill_dic["fee_type_id"],
+            "fee_type": waybill_dic["fee_type"],
+            # Cursor of keyset pagination
+            "cursor": "%s,%d" % (waybill_dic["create_time"].isoformat(), waybill_dic["id"]),
+        }
+
+    def gen_stats_summary(self, form) -> dict:
+        """ Number of waybills and freight of the searched days, read from the DailyDepartmentStats rollup (O(days) rows)
+        Only the date range and the department of the search form are applied, not the other conditions.
+        :return: {"num": ..., "fee": ..., "start_date": ..., "end_date": ..., "department": ...}
+        """
+        field_prefix, date_field, department_field = self.stats_summary
+        start_date = form.cleaned_data.get(date_field + "_start")
+        end_date = form.cleaned_data.get(date_field + "_end")
+        department = form.cleaned_data.get(department_field)
+        stats = DailyDepartmentStats.objects.all()
+        if start_date:
+            stats = stats.filter(date__gte=start_date)
+        if end_date:
+            stats = stats.filter(date__lte=end_date)
+        if department:
+            stats = stats.filter(department=department)
+        summary = stats.aggregate(num=Sum(field_prefix + "_num"), fee=Sum(field_prefix + "_fee"))
+        return {
+            "num": summary["num"] or 0,
+            "fee": summary["fee"] or 0,
+            "start_date": start_date,
+            "end_date": end_date,
+            "department": department,
+        }
+
+    @staticmethod
+    def _filter_search_value(waybills, search_value: str):
+        """ Search box of DataTables: waybill number, customer names and phone numbers, cargo name """
+        search_value = search_value.strip()
+        if not search_value:
+            return waybills
+        search_q = (
+            Q(src_customer_name__contains=search_value) | Q(src_customer_phone__contains=search_value) |
+            Q(dst_customer_name__contains=search_value) | Q(dst_customer_phone__contains=search_value) |
+            Q(cargo_name__contains=search_value)
+        )
+        if search_value.isdigit():
+            search_q |= Q(id=int(search_value))
+        return waybills.filter(search_q)
+
+    def datatable_response(self, request, form):
+        """ Server-side processing of DataTables
+        Paging, ordering and the search box are all done in SQL. When the table is ordered by create time (or waybill number),
+        the client sends the cursor of the last row of the previous page, and the next page is read with keyset pagination
+        on (create_time, id) instead of OFFSET, so deep pages cost the same as the first one.
+        """
+        post = request.POST
+        try:
+            draw = int(post.get("draw", 0))
+            start = max(int(post.get("start", 0)), 0)
+            length = min(max(int(post.get("length", 10)), 1), self.DATATABLE_MAX_LENGTH)
+            order_column = post.get("columns[%d][data]" % int(post.get("order[0][column]", -1)), "create_time")
+        except ValueError:
+            return HttpResponseBadRequest()
+        descending = post.get("order[0][dir]") == "desc"
+        if order_column not in self.DATATABLE_ORDER_FIELDS:
+            order_column = "create_time"
+        response_dic = {"draw": draw, "recordsTotal": 0, "recordsFiltered": 0, "data": []}
+        if not form.is_valid():
+            return JsonResponse(response_dic, encoder=UnescapedDjangoJSONEncoder)
+        try:
+            waybills = form.gen_waybill_list_to_queryset()
+        except ValueError:
+            return JsonResponse(response_dic, encoder=UnescapedDjangoJSONEncoder)
+        response_dic["recordsTotal"] = waybills.count()
+        search_value = post.get("search[value]", "").strip()
+        if search_value:
+            waybills = self._filter_search_value(waybills, search_value)
+            response_dic["recordsFiltered"] = waybills.count()
+        else:
+            response_dic["recordsFiltered"] = response_dic["recordsTotal"]
+        order_fields = self.DATATABLE_ORDER_FIELDS[order_column]
+        waybills = waybills.order_by(
+            *["-" + field if descending else field for field in order_fields]
+        )
+        cursor = post.get("cursor", "")
+        if cursor and order_column in self.DATATABLE_KEYSET_COLUMNS:
+            try:
+                cursor_create_time, cursor_id = cursor.rsplit(",", 1)
+                cursor_create_time = datetime.datetime.fromisoformat(cursor_create_time)
+                cursor_id = int(cursor_id)
+            except ValueError:
+                return HttpResponseBadRequest()
+            if descending:
+                waybills = waybills.filter(
+                    Q(create_time__lt=cursor_create_time) | Q(create_time=cursor_create_time, id__lt=cursor_id)
+                )
+            else:
+                waybills = waybills.filter(
+                    Q(create_time__gt=cursor_create_time) | Q(create_time=cursor_create_time, id__gt=cursor_id)
+                )
+            waybills = waybills[:length]
+        else:
+            waybills = waybills[start:start+length]
+        response_dic["data"] = [
+            self._datatable_row(waybill_dic) for waybill_dic in waybills_to_dicts(waybills, self.DATATABLE_FIELDS)
+        ]
+        return JsonResponse(response_dic, encoder=UnescapedDjangoJSONEncoder)
+
+    def export_response(self, request, form):
+        """ Export all the rows of a server-side table to excel, the browser only holds the current page
+        The rows are filtered by the search form and the search box of DataTables, ordered by create time.
+        """
+        if not form.is_valid():
+            return HttpResponseBadRequest()
+        try:
+            waybills = form.gen_waybill_list_to_queryset()
+        except ValueError:
+            return HttpResponseBadRequest()
+        waybills = self._filter_search_value(waybills, request.POST.get("search[value]", "")).order_by("create_time", "id")
+        table_title = request.POST.get("table_title", "").strip() or "运单"
+        file = gen_workbook(
+            table_title,
+            [header for _, header, _ in self.DATATABLE_EXPORT_COLUMNS],
+            (
+                [row[key] for key, _, _ in self.DATATABLE_EXPORT_COLUMNS]
+                for row in map(self._datatable_row, waybills_to_dicts(waybills, self.DATATABLE_FIELDS))
+            ),
+            [value_type for _, _, value_type in self.DATATABLE_EXPORT_COLUMNS],
+        )
+        return FileResponse(
+            file, as_attachment=True, filename="%s.xlsx" % table_title, content_type="application/octet-stream",
+        )
+
     def dispatch(self, request, *args, **kwargs):
         if self.need_login and not request.session.get("user"):
             return redirect("wuliu:login")
@@ -71,6 +309,49 @@ class WaybillSearchView(View):
                 return HttpResponseForbidden()
         return super().dispatch(request, *args, **kwargs)
 
+class ManageWaybill(WaybillSearchView):
+    template_name = "wuliu/waybill/manage_waybill.html"
+    need_permissions = ("manage_waybill__search", )
+    server_side = True
+
+class SearchWaybillsToTransportOut(WaybillSearchView):
+    template_name = "wuliu/transport_out/search_waybills_to_transport_out.html"
+    need_permissions = ("manage_transport_out__add_edit_delete_start", )
+    server_side = True
+
+class ManageSignFor(WaybillSearchView):
+    template_name = "wuliu/sign_for/manage_sign_for.html"
+    need_permissions = ("manage_sign_for", )
+    server_side = True
+
+class ReportTableSrcWaybill(WaybillSearchView):
+    template_name = "wuliu/report_table/src_waybill.html"
+    need_permissions = ("report_table_src_waybill", )
+    server_side = True
+    stats_summary = ("created", "create_date", "src_department")
+
+class ReportTableDstWaybill(WaybillSearchView):
+    template_name = "wuliu/report_table/dst_waybill.html"
+    need_permissions = ("report_table_dst_waybill", )
+    server_side = True
+    stats_summary = ("arrived", "arrival_date", "dst_department")
+
+class ReportTableSignForWaybill(WaybillSearchView):
+    template_name = "wuliu/report_table/sign_for_waybill.html"
+    need_permissions = ("report_table_sign_for_waybill", )
+    server_side = True
+    stats_summary = ("signed_for", "sign_for_date", "dst_department")
+
+# The stock tables have their own columns (see show_stock_waybill_table) and only list the waybills in stock,
+# so they are still rendered in the page
+class ReportTableStockWaybill(WaybillSearchView):
+    template_name = "wuliu/report_table/stock_waybill.html"
+    need_permissions = ("report_table_stock_waybill", )
+
+class ReportTableDstStockWaybill(WaybillSearchView):
+    template_name = "wuliu/report_table/dst_stock_waybill.html"
+    need_permissions = ("report_table_dst_stock_waybill", )
+
 def _transport_out_detail_view(request, render_path):
     transport_out_id = request.GET.get("transport_out_id")
     if not transport_out_id:
@@ -153,33 +434,32 @@ def logout(request):
     request.COOKIES.clear()
     return redirect("wuliu:login")
 
-@login_required()
-def welcome(request):
-    # messages.debug(request, "Test debug message...")
-    # messages.info(request, "Test info message...")
-    # messages.success(request, "Test success message...")
-    # messages.warning(request, "Test warning message...")
-    # messages.error(request, "Test error message...")
-    logged_user_type = get_logged_user_type(request)
+@ExpireLruCache(expire_time=timezone.timedelta(minutes=1), maxsize=256)
+def _gen_welcome_data(logged_user_type, department_id, today: datetime.date) -> dict:
+    """ Generate the statistics shown on the welcome page
+    The result only depends on the user type and (for branches and goods yards) the department,
+    so it is cached briefly and shared by all users with the same parameters.
+    :param logged_user_type: User.Types
+    :param department_id: Department id of the user, None for administrators and company users
+    :param today: Current local date, part of the cache key so that the statistics roll over at midnight
+    """
     dic = {
         "today": {"waybill": 0, "transport_out": 0, "arrival": 0, "sign_for": 0},
         "wait": {"waybill": 0, "transport_out": 0, "arrival": 0, "sign_for": 0},
     }
-    today_start_datetime = timezone.make_aware(
-        datetime.datetime.combine(datetime.date.today(), datetime.time(0, 0))
-    )
-    today_end_datetime = timezone.make_aware(
-        datetime.datetime.combine(datetime.date.today(), datetime.time(23, 59, 59))
-    )
-    today_weekday = timezone.now().isoweekday()
-    weekdays = [
-        {1: "Mon", 2: "Tue", 3: "Wed", 4: "Thu", 5: "Fri", 6: "Sat", 7: "Sun"}.get(
-            today_weekday-i if today_weekday-i > 0 else today_weekday+7-i
+    # Number of new waybills and freight income for each day in the past 14 days, plus today's departures, arrivals and sign-for,
+    # all read from the daily statistics rollup (at most 14 rows per department) in one grouped query.
+    # Branches and goods yards only count their own department (although goods yards do not have billing rights...)
+    stats = DailyDepartmentStats.objects.filter(date__gte=today - datetime.timedelta(days=13), date__lte=today)
+    if department_id is not None:
+        stats = stats.filter(department_id=department_id)
+    day_info_dic = {
+        day_info["date"]: day_info
+        for day_info in stats.order_by().values("date").annotate(
+            created_num=Sum("created_num"), created_fee=Sum("created_fee"),
+            departed_num=Sum("departed_num"), arrived_num=Sum("arrived_num"), signed_for_num=Sum("signed_for_num"),
         )
-        for i in range(7)[::-1]
-    ]
-    # Number of new waybills and freight income for each day in the past 14 days
-    # Branches and goods yards only count new waybills for their own department (although goods yards do not have billing rights...)
+    }
     if logged_user_type == User.Types.GoodsYard:
         waybill_num_in_past_two_weeks = [0] * 14
         waybill_fee_in_past_two_weeks = [0] * 14
@@ -187,46 +467,23 @@ def welcome(request):
         waybill_num_in_past_two_weeks = []
         waybill_fee_in_past_two_weeks = []
         for i in range(14)[::-1]:
-            queryset = Waybill.objects.only("pk", "fee").filter(
-                    create_time__gte=today_start_datetime - timezone.timedelta(days=i),
-                    create_time__lte=today_end_datetime - timezone.timedelta(days=i),
-                ).exclude(status=Waybill.Statuses.Dropped)
-            if logged_user_type == User.Types.Branch:
-                queryset = queryset.filter(src_department__id=request.session["user"]["department_id"])
-            day_info = queryset.aggregate(fee_total=Sum("fee"), count=Count("pk"))
-            waybill_num_in_past_two_weeks.append(day_info["count"])
-            waybill_fee_in_past_two_weeks.append(day_info["fee_total"] or 0)
+            day_info = day_info_dic.get(today - datetime.timedelta(days=i), {})
+            waybill_num_in_past_two_weeks.append(day_info.get("created_num") or 0)
+            waybill_fee_in_past_two_weeks.append(day_info.get("created_fee") or 0)
+    today_info = day_info_dic.get(today, {})
     # Today's new waybills
     dic["today"]["waybill"] = waybill_num_in_past_two_weeks[-1]
     # Today's departures
-    today_start_datetime = timezone.make_aware(
-        datetime.datetime.combine(datetime.date.today(), datetime.time(0, 0))
-    )
-    today_end_datetime = timezone.make_aware(
-        datetime.datetime.combine(datetime.date.today(), datetime.time(23, 59, 59))
-    )
-    today_transport_out = TransportOut.objects.filter(
-        start_time__gte=today_start_datetime,
-        start_time__lte=today_end_datetime,
-        status__in=(TransportOut.Statuses.OnTheWay, TransportOut.Statuses.Arrived),
-    )
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        today_transport_out = today_transport_out.filter(src_department__id=request.session["user"]["department_id"])
-    dic["today"]["transport_out"] = today_transport_out.aggregate(_=Count("waybills"))["_"] or 0
+    dic["today"]["transport_out"] = today_info.get("departed_num") or 0
     # Today's arrivals
-    today_arrival = Waybill.objects.filter(
-        arrival_time__gte=today_start_datetime, arrival_time__lte=today_end_datetime,
-    )
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        today_arrival = today_arrival.filter(dst_department__id=request.session["user"]["department_id"])
-    dic["today"]["arrival"] = today_arrival.count() or 0
+    dic["today"]["arrival"] = today_info.get("arrived_num") or 0
     # Today's sign-for
-    today_sign_for = Waybill.objects.filter(
-        sign_for_time__gte=today_start_datetime, sign_for_time__lte=today_end_datetime,
-    )
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        today_sign_for = today_sign_for.filter(dst_department__id=request.session["user"]["department_id"])
-    dic["today"]["sign_for"] = today_sign_for.count()
+    dic["today"]["sign_for"] = today_info.get("signed_for_num") or 0
+    # Pending sign-for
+    wait_sign_for = Waybill.objects.filter(status=Waybill.Statuses.Arrived)
+    if department_id is not None:
+        wait_sign_for = wait_sign_for.filter(dst_department__id=department_id)
+    dic["wait"]["sign_for"] = wait_sign_for.count()
     # Pending orders
     dic["wait"]["waybill"] = 0
     # Pending departures
@@ -236,7 +493,7 @@ def welcome(request):
             ).count()
     elif logged_user_type == User.Types.Branch:
         dic["wait"]["transport_out"] = Waybill.objects.filter(
-                src_department__id=request.session["user"]["department_id"],
+                src_department__id=department_id,
                 status__in=(Waybill.Statuses.Created, Waybill.Statuses.Loaded),
             ).count()
     else:
@@ -245,20 +502,46 @@ def welcome(request):
             ).count()
     # Pending arrivals
     wait_arrival = TransportOut.objects.filter(status=TransportOut.Statuses.OnTheWay)
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        wait_arrival = wait_arrival.filter(dst_department__id=request.session["user"]["department_id"])
+    if department_id is not None:
+        wait_arrival = wait_arrival.filter(dst_department__id=department_id)
     dic["wait"]["arrival"] = wait_arrival.count()
-    # Pending sign-for
-    wait_sign_for = Waybill.objects.filter(status=Waybill.Statuses.Arrived)
-    if logged_user_type not in (User.Types.Administrator, User.Types.Company):
-        wait_sign_for = wait_sign_for.filter(dst_department__id=request.session["user"]["department_id"])
-    dic["wait"]["sign_for"] = wait_sign_for.count()
+    return {
+        "data_dic": dic,
+        "waybill_num_in_past_two_weeks": waybill_num_in_past_two_weeks,
+        "waybill_fee_in_past_two_weeks": waybill_fee_in_past_two_weeks,
+    }
+
+@login_required()
+def welcome(request):
+    # messages.debug(request, "Test debug message...")
+    # messages.info(request, "Test info message...")
+    # messages.success(request, "Test success message...")
+    # messages.warning(request, "Test warning message...")
+    # messages.error(request, "Test error message...")
+    logged_user_type = get_logged_user_type(request)
+    today_weekday = timezone.now().isoweekday()
+    weekdays = [
+        {1: "Mon", 2: "Tue", 3: "Wed", 4: "Thu", 5: "Fri", 6: "Sat", 7: "Sun"}.get(
+            today_weekday-i if today_weekday-i > 0 else today_weekday+7-i
+        )
+        for i in range(7)[::-1]
+    ]
+    welcome_data = _gen_welcome_data(
+        logged_user_type,
+        (
+            None if logged_user_type in (User.Types.Administrator, User.Types.Company)
+            else request.session["user"]["department_id"]
+        ),
+        timezone.localdate(),
+    )
+    waybill_num_in_past_two_weeks = welcome_data["waybill_num_in_past_two_weeks"]
+    waybill_fee_in_past_two_weeks = welcome_data["waybill_fee_in_past_two_weeks"]
 
     return render(
         request,
         "wuliu/welcome.html",
         {
-            "data_dic": dic,
+            "data_dic": welcome_data["data_dic"],
             "weekdays": weekdays,
             "waybill_num_last_week": waybill_num_in_past_two_weeks[:7],
             "waybill_num_this_week": waybill_num_in_past_two_weeks[7:],
@@ -281,4 +564,46 @@ def welcome(request):
         }
     )
 
+@login_required()
+@check_permission("add_waybill")
+def import_waybills(request):
+    """ Import waybills from an uploaded csv or xlsx file (see WaybillImporter)
+    The shipping department of all waybills is the department of the logged-in user, invalid rows are skipped and listed.
+    """
+    result = None
+    if request.method == "POST":
+        form = forms.ImportWaybillsForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload_file = form.cleaned_data["file"]
+            importer = WaybillImporter(
+                get_logged_user(request),
+                src_department_id=request.session["user"]["department_id"],
+                chunk_size=settings.WAYBILL_IMPORT_CHUNK_SIZE,
+                dry_run=form.cleaned_data["dry_run"],
+            )
+            try:
+                result = importer.import_rows(iter_table_rows(upload_file, upload_file.name))
+            except ValueError as exc:
+                messages.error(request, str(exc))
+            else:
+                if form.cleaned_data["dry_run"]:
+                    messages.info(request, "%d of %d rows are valid" % (result["valid_num"], result["total_num"]))
+                else:
+                    messages.success(
+                        request, "%d of %d waybills imported" % (len(result["waybill_ids"]), result["total_num"])
+                    )
+    else:
+        form = forms.ImportWaybillsForm()
+    return render(request, "wuliu/waybill/import_waybills.html", {"form": form, "result": result})
+
+@login_required(raise_404=True)
+@check_administrator
+def request_metrics(request):
+    """ Percentiles of the wall time, database time, query count and template rendering time of each view,
+    over the recent requests of the process serving this request (see utils.middleware.RequestMetricsMiddleware)
+    """
+    return JsonResponse(
+        {"pid": os.getpid(), "views": get_request_metrics_summary()}, encoder=UnescapedDjangoJSONEncoder,
+    )
+
 # ... (rest of the code unchanged except for Chinese comments/messages, which should be translated similarly)
@@ -0,0 +1,286 @@
+import itertools
+import math
+from collections import Counter
+
+from django.core.exceptions import ValidationError, NON_FIELD_ERRORS
+from django.db import connection, transaction
+from django.db.models import Max
+
+from .models import (
+    Waybill, WaybillRouting, Customer, User, DepartmentRegistry, DailyDepartmentStats, StandardFeeCalculator,
+)
+from .common import get_global_settings
+
+
+def _to_str(value) -> str:
+    if value is None:
+        return ""
+    # Excel stores phone numbers and ids typed into cells as numbers
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+def _to_int(value, label) -> int:
+    try:
+        if isinstance(value, float):
+            if not value.is_integer():
+                raise ValueError
+            return int(value)
+        return int(_to_str(value))
+    except ValueError:
+        raise ValueError("%s must be an integer: %s" % (label, _to_str(value)))
+
+def _to_float(value, label) -> float:
+    try:
+        value = float(_to_str(value))
+    except ValueError:
+        raise ValueError("%s must be a number: %s" % (label, _to_str(value)))
+    if not math.isfinite(value):
+        raise ValueError("%s must be a number: %s" % (label, value))
+    return value
+
+class WaybillImporter:
+
+    """ Bulk import of waybills from the rows of a table file (see utils.import_table.iter_table_rows)
+    The first row is the header, columns are matched by field name or verbose name, e.g. "dst_department" or "Receiving Department"
+    (see COLUMNS, other columns are ignored). Departments are given by name or id, freight types by label or value.
+    If the freight is empty, the standard freight is used (see StandardFeeCalculator).
+    Rows are read lazily and processed in chunks of chunk_size:
+    - departments are resolved through DepartmentRegistry, senders and receivers are linked to the customers
+      with the same phone number, loaded with one query per chunk
+    - every waybill is validated with full_clean (without the existence checks of the resolved foreign keys),
+      which does not query the database per row
+    - the valid waybills and their "Created" routings are created with bulk_create, in one transaction per chunk
+    Invalid rows are skipped and reported in errors, the other rows are imported.
+    Example:
+        importer = WaybillImporter(operation_user, src_department_id=operation_user.department_id)
+        result = importer.import_rows(iter_table_rows(file, file_name))
+    """
+
+    COLUMNS = (
+        "src_department", "dst_department",
+        "src_customer_name", "src_customer_phone", "src_customer_credential_num", "src_customer_address",
+        "dst_customer_name", "dst_customer_phone", "dst_customer_credential_num", "dst_customer_address",
+        "cargo_name", "cargo_num", "cargo_volume", "cargo_weight", "cargo_price",
+        "fee", "fee_type", "customer_remark", "company_remark",
+    )
+    REQUIRED_COLUMNS = (
+        "dst_department", "src_customer_name", "src_customer_phone", "dst_customer_name", "dst_customer_phone",
+        "cargo_name", "cargo_num", "cargo_volume", "cargo_weight", "fee_type",
+    )
+
+    # Foreign keys resolved through the lookup maps, full_clean would check their existence with one query each
+    _RESOLVED_FIELDS = ["src_department", "dst_department", "src_customer", "dst_customer"]
+
+    def __init__(self, operation_user: User, src_department_id: int = None, chunk_size=500, dry_run=False):
+        """
+        :param operation_user: User recorded in the routings
+        :param src_department_id: Shipping department of all waybills, if None it is read from the src_department column
+        :param chunk_size: Number of rows validated and created in one transaction
+        :param dry_run: Only validate the rows, nothing is created
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+        self.operation_user = operation_user
+        self.src_department_id = src_department_id
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.department_registry = DepartmentRegistry.current()
+        self.fee_calculator = StandardFeeCalculator.current()
+        self.handling_fee_ratio = get_global_settings().handling_fee_ratio
+        self._department_ids_by_name = {info.name: info.id for info in self.department_registry.departments.values()}
+        self._fee_types = {}
+        for fee_type in Waybill.FeeTypes:
+            for key in (fee_type.value, str(fee_type.value), fee_type.name.lower(), fee_type.label.lower()):
+                self._fee_types[key] = fee_type.value
+
+    def _parse_header(self, values) -> dict:
+        """ Return {column index: field name}, raise ValueError if a required column is missing """
+        labels = {}
+        for name in self.COLUMNS:
+            labels[name] = name
+            labels[str(Waybill._meta.get_field(name).verbose_name).lower()] = name
+        columns = {}
+        for index, value in enumerate(values):
+            name = labels.get(_to_str(value).lower())
+            if name is not None and name not in columns.values():
+                columns[index] = name
+        required = self.REQUIRED_COLUMNS if self.src_department_id else ("src_department", *self.REQUIRED_COLUMNS)
+        missing = [name for name in required if name not in columns.values()]
+        if missing:
+            raise ValueError("Missing columns: %s" % ", ".join(
+                str(Waybill._meta.get_field(name).verbose_name) for name in missing
+            ))
+        return columns
+
+    def _department_id(self, value, label) -> int:
+        value = _to_str(value)
+        dept_id = self._department_ids_by_name.get(value)
+        if dept_id is None and value.isdigit() and int(value) in self.department_registry.departments:
+            dept_id = int(value)
+        if dept_id is None:
+            raise ValueError("%s does not exist: %s" % (label, value))
+        return dept_id
+
+    def _build_waybill(self, row: dict, customers: dict) -> Waybill:
+        """ Create the (unsaved) waybill of a row, raise ValueError if a value cannot be converted """
+        src_department_id = self.src_department_id
+        if src_department_id is None or _to_str(row.get("src_department")):
+            src_department_id = self._department_id(row.get("src_department"), "Shipping department")
+            if self.src_department_id is not None and src_department_id != self.src_department_id:
+                raise ValueError("Shipping department must be %s" % self.department_registry.get(self.src_department_id).name)
+        dst_department_id = self._department_id(row["dst_department"], "Receiving department")
+        fee_type = self._fee_types.get(_to_str(row["fee_type"]).lower())
+        if fee_type is None:
+            raise ValueError("Unknown freight type: %s" % _to_str(row["fee_type"]))
+        cargo_volume = _to_float(row["cargo_volume"], "Volume")
+        cargo_weight = _to_float(row["cargo_weight"], "Weight")
+        cargo_price = _to_int(row["cargo_price"], "Cargo price") if _to_str(row.get("cargo_price")) else 0
+        if _to_str(row.get("fee")):
+            fee = _to_int(row["fee"], "Freight")
+        else:
+            try:
+                fee = self.fee_calculator.fee(src_department_id, dst_department_id, cargo_volume, cargo_weight)
+            except ValueError:
+                raise ValueError("Waybills cannot be shipped between these departments")
+        src_customer_phone = _to_str(row["src_customer_phone"])
+        dst_customer_phone = _to_str(row["dst_customer_phone"])
+        return Waybill(
+            src_department_id=src_department_id,
+            dst_department_id=dst_department_id,
+            src_customer=customers.get(src_customer_phone),
+            src_customer_name=_to_str(row["src_customer_name"]),
+            src_customer_phone=src_customer_phone,
+            src_customer_credential_num=_to_str(row.get("src_customer_credential_num")),
+            src_customer_address=_to_str(row.get("src_customer_address")),
+            dst_customer=customers.get(dst_customer_phone),
+            dst_customer_name=_to_str(row["dst_customer_name"]),
+            dst_customer_phone=dst_customer_phone,
+            dst_customer_credential_num=_to_str(row.get("dst_customer_credential_num")),
+            dst_customer_address=_to_str(row.get("dst_customer_address")),
+            cargo_name=_to_str(row["cargo_name"]),
+            cargo_num=_to_int(row["cargo_num"], "Quantity"),
+            cargo_volume=cargo_volume,
+            cargo_weight=cargo_weight,
+            cargo_price=cargo_price,
+            cargo_handling_fee=math.ceil(cargo_price * self.handling_fee_ratio) if cargo_price else 0,
+            fee=fee,
+            fee_type=fee_type,
+            customer_remark=_to_str(row.get("customer_remark")),
+            company_remark=_to_str(row.get("company_remark")),
+            cargo_price_status=(
+                Waybill.CargoPriceStatuses.NotPaid if cargo_price else Waybill.CargoPriceStatuses.No
+            ),
+        )
+
+    @staticmethod
+    def _format_validation_error(exc: ValidationError) -> str:
+        if not hasattr(exc, "error_dict"):
+            return "; ".join(exc.messages)
+        return "; ".join(
+            message if field == NON_FIELD_ERRORS else "%s: %s" % (Waybill._meta.get_field(field).verbose_name, message)
+            for field, messages in exc.message_dict.items() for message in messages
+        )
+
+    @staticmethod
+    def _bulk_insert_without_returning(waybills: list):
+        """ Bulk insert the waybills on backends which do not return the ids of bulk inserted rows (MySQL), and set their ids
+        The ids are read back with one query: the rows of this insert have ids above the largest id before the insert,
+        and are matched by the create_time set on each waybill by bulk_create (with the shipping department and receiver phone,
+        in case other connections insert waybills at the same time). The auto increment ids of one INSERT statement are
+        increasing in the order of the rows, so ordering by id gives the waybills in the order they were inserted.
+        Must be called in a transaction.
+        """
+        max_id = Waybill.objects.aggregate(max_id=Max("id"))["max_id"] or 0
+        Waybill.objects.bulk_create(waybills)
+        keys = Counter((wb.create_time, wb.src_department_id, wb.dst_customer_phone) for wb in waybills)
+        rows = Waybill.objects.filter(
+            id__gt=max_id,
+            create_time__range=(min(wb.create_time for wb in waybills), max(wb.create_time for wb in waybills)),
+        ).order_by("id").values_list("id", "create_time", "src_department_id", "dst_customer_phone")
+        ids = []
+        for wb_id, *key in rows:
+            key = tuple(key)
+            if keys[key] > 0:
+                keys[key] -= 1
+                ids.append(wb_id)
+        if len(ids) != len(waybills):
+            raise RuntimeError("Can not read back the ids of the inserted waybills")
+        for waybill, wb_id in zip(waybills, ids):
+            waybill.id = wb_id
+            waybill._state.adding = False
+            waybill._state.db = Waybill.objects.db
+
+    def _create(self, waybills: list) -> list:
+        """ Create the validated waybills and their "Created" routings in one transaction """
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                Waybill.objects.bulk_create(waybills)
+            else:
+                # The backend (MySQL) does not return the ids of bulk inserted rows, which are needed by the routings
+                self._bulk_insert_without_returning(waybills)
+            routings = [
+                WaybillRouting(
+                    waybill=waybill,
+                    time=waybill.create_time,
+                    operation_type=Waybill.Statuses.Created,
+                    operation_dept_id=self.operation_user.department_id,
+                    operation_user=self.operation_user,
+                )
+                for waybill in waybills
+            ]
+            WaybillRouting.objects.bulk_create(routings)
+            # bulk_create does not call Waybill.save and WaybillRouting.save, so count them here
+            DailyDepartmentStats.record_waybills_created(waybills)
+            DailyDepartmentStats.record_routings(routings)
+        return waybills
+
+    def _import_chunk(self, chunk: list, result: dict):
+        phones = set()
+        for _, row in chunk:
+            phones.add(_to_str(row["src_customer_phone"]))
+            phones.add(_to_str(row["dst_customer_phone"]))
+        phones.discard("")
+        customers = Customer.objects.in_bulk(phones, field_name="phone") if phones else {}
+        waybills = []
+        for row_number, row in chunk:
+            try:
+                waybill = self._build_waybill(row, customers)
+                waybill.full_clean(exclude=self._RESOLVED_FIELDS)
+            except ValueError as exc:
+                result["errors"].append((row_number, str(exc)))
+            except ValidationError as exc:
+                result["errors"].append((row_number, self._format_validation_error(exc)))
+            else:
+                waybills.append(waybill)
+        result["valid_num"] += len(waybills)
+        if waybills and not self.dry_run:
+            result["waybill_ids"].extend(waybill.id for waybill in self._create(waybills))
+
+    def import_rows(self, rows) -> dict:
+        """ Import the waybills of the rows
+        :param rows: Iterable of (row number, list of cell values), the first one is the header
+        :return: {
+            "total_num": number of rows (excluding the header),
+            "valid_num": number of rows passing validation,
+            "waybill_ids": ids of the created waybills (empty in dry run mode),
+            "errors": list of (row number, error message),
+        }
+        Raise ValueError if the header is invalid
+        """
+        rows = iter(rows)
+        try:
+            _, header = next(rows)
+        except StopIteration:
+            raise ValueError("The file is empty")
+        columns = self._parse_header(header)
+        result = {"total_num": 0, "valid_num": 0, "waybill_ids": [], "errors": []}
+        while True:
+            chunk = [
+                (row_number, {name: values[index] if index < len(values) else None for index, name in columns.items()})
+                for row_number, values in itertools.islice(rows, self.chunk_size)
+            ]
+            if not chunk:
+                return result
+            result["total_num"] += len(chunk)
+            self._import_chunk(chunk, result)